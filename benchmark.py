@@ -0,0 +1,404 @@
+#!/usr/bin/python
+
+"""
+    Measures how the farm scales without needing a real one. For every combination of encoder and task
+    counts asked for it starts a fresh central server (with its own name server and FTP server) on this
+    box, starts that many encoders pointed at stubhandbrake.py, adds that many tasks and waits for them
+    all to finish. Everything goes over the real Pyro and FTP paths, only handbrake is faked.
+
+    Each run happens in its own process so it gets its own ports, home dir and config. The numbers come
+    from the central server's metrics endpoint:
+        - tasks a minute, from the first task being added until the last one finishes
+        - dispatch latency, how long tasks sat in the queue on average before an encoder took them
+        - Pyro calls a second made to the central server
+        - the central server's CPU use, as a fraction of one core and in CPU seconds per task
+
+    i.e.
+        python benchmark.py --encoders 1,4,16 --tasks 50,200 --output after.json --compare before.json
+
+    --server-mode loop runs the central server on its event loop (see server_mode) instead. --cancel N
+    cancels N tasks once encoders are on them and checks each one really stopped, the server has it as
+    cancelled and its encoder has let go of it (give the stub a low --fps so there's time to)
+
+    --wire N skips all that and times sending N finished tasks (as getTasks hands them to the UI) through
+    each of Pyro's serializers, with the bytes each task takes on the wire and in memory
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import shutil
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1',0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def scrape(port):
+    """ The central server's metrics as {(name,labels): value}, labels being the raw text in the braces """
+    import urllib2
+    samples = {}
+    for line in urllib2.urlopen('http://127.0.0.1:{0}/metrics'.format(port),timeout=10).read().splitlines():
+        if not line or line.startswith('#'):
+            continue
+        series,value = line.rsplit(' ',1)
+        name,_,labels = series.partition('{')
+        samples[(name,labels.rstrip('}'))] = float(value)
+    return samples
+
+def metric(samples,name,labels=''):
+    return samples.get((name,labels),0.0)
+
+def cancelSome(central,encoders,count,deadline):
+    """ Cancel count tasks as the encoders get going on them, returns (task name,seconds cancelTask took,
+        whether it worked) for each. It only worked if within lease_time seconds the server has the task as
+        cancelled and none of the encoders are holding on to it
+    """
+    import encoder_cfg
+    results = []
+    while len(results) < count and time.time() < deadline:
+        tried = set(name for name,took,ok in results)
+        encoding = [name for name,(task,encoder,status) in central.getTasks().items()
+                    if status == 'Encoding' and name not in tried]
+        if not encoding:
+            time.sleep(0.2)
+            continue
+        name = encoding[0]
+        started = time.time()
+        try:
+            ok = central.cancelTask(name)
+        except Exception:
+            ok = False
+        took = time.time() - started
+        gone = time.time() + encoder_cfg.lease_time
+        while ok:
+            info = central.getTasks().get(name)
+            if info and info[2] == 'Cancelled' and not any(name in bench.getTasks() for bench in encoders):
+                break
+            if time.time() > gone:
+                ok = False
+                break
+            time.sleep(0.2)
+        results.append((name,took,ok))
+    return results
+
+def runOnce(settings):
+    """ Does a single run in this process, only ever called in a fresh process (see --run) """
+    root = tempfile.mkdtemp(prefix='handbrake-bench-')
+    serverHome = os.path.join(root,'server')
+    encoderHome = os.path.join(root,'encoders')
+    os.makedirs(os.path.join(serverHome,'master'))
+    os.makedirs(encoderHome)
+
+    # The config has to be in place before anything else reads it
+    import encoder_cfg
+    encoder_cfg.pyro_host = encoder_cfg.ftp_host = '127.0.0.1'
+    encoder_cfg.getLanIP = lambda: '127.0.0.1'
+    encoder_cfg.pyro_port = freePort()
+    encoder_cfg.ftp_port = freePort()
+    encoder_cfg.metrics_port = freePort()
+    encoder_cfg.encoder_metrics_port = None
+    encoder_cfg.storage_mode = 'ftp'
+    encoder_cfg.server_mode = settings.get('serverMode','threads')
+    encoder_cfg.encoder_slots = settings['slots']
+    # Every 'box' is this one, the load average and ramp up delay would only hold the slots back
+    encoder_cfg.max_load = float('inf')
+    encoder_cfg.slot_ramp_delay = 0
+    encoder_cfg.calibration_presets = []
+    if settings.get('speculative') is not None:
+        encoder_cfg.speculative_limit = settings['speculative']
+    if settings.get('grace') is not None:
+        encoder_cfg.straggler_grace = settings['grace']
+    # Tasks are pickled over Pyro, the same as the farm needs
+    os.environ['PYRO_SERIALIZER'] = 'pickle'
+    os.environ['PYRO_SERIALIZERS_ACCEPTED'] = 'pickle'
+    os.environ['STUB_FPS'] = str(settings['fps'])
+    os.environ['STUB_LENGTH'] = str(settings['length'])
+
+    import Pyro4
+    import distributedenc
+    import encoder
+
+    class BenchEncoder(encoder.Encoder):
+        """ Every encoder is on the same box, so they need names (and work dirs) of their own """
+        def __init__(self,name):
+            self.benchName = name
+            home = os.path.join(encoderHome,name)
+            os.makedirs(home)
+            encoder.Encoder.__init__(self,home)
+
+        def getName(self):
+            return self.benchName
+
+    processes = []
+    try:
+        os.environ['HOME'] = serverHome
+        if encoder_cfg.server_mode == 'loop':
+            servers = [(distributedenc.startEventLoop,[])]
+        else:
+            transfers = multiprocessing.Queue()
+            servers = [(distributedenc.startNameServer,['127.0.0.1',encoder_cfg.pyro_port]),
+                       (distributedenc.startFTPServer,[transfers]),
+                       (distributedenc.startCentralEncoder,[transfers])]
+        for target,args in servers:
+            process = multiprocessing.Process(target=target,args=args)
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        central = Pyro4.Proxy('PYRONAME:central.encoding@127.0.0.1:{0}'.format(encoder_cfg.pyro_port))
+        deadline = time.time() + 30
+        while True:
+            try:
+                central._pyroBind()
+                scrape(encoder_cfg.metrics_port)
+                break
+            except Exception:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+
+        os.environ['HOME'] = encoderHome
+        handbrake = settings['handbrake']
+        if handbrake.endswith('.py'):
+            # Run a python stub with this python, whatever its #! line says
+            handbrake = os.path.join(root,'handbrake')
+            with open(handbrake,'w') as f:
+                f.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable,settings['handbrake']))
+            os.chmod(handbrake,0755)
+        # The slow encoders' stubs go at a quarter of the speed
+        slow = os.path.join(root,'handbrake-slow')
+        with open(slow,'w') as f:
+            f.write('#!/bin/sh\nSTUB_FPS={0} exec "{1}" "$@"\n'.format(settings['fps'] / 4,handbrake))
+        os.chmod(slow,0755)
+        daemon = Pyro4.Daemon(host='127.0.0.1')
+        ns = Pyro4.locateNS(host='127.0.0.1',port=encoder_cfg.pyro_port)
+        encoders = []
+        for i in xrange(settings['encoders']):
+            # Encoders pick up which handbrake to run when they're created
+            encoder.handbrake_unix = slow if i < settings.get('slow',0) else handbrake
+            bench = BenchEncoder('encoder.bench{0:03d}'.format(i))
+            ns.register(bench.getName(),daemon.register(bench))
+            encoders.append(bench)
+        loop = threading.Thread(target=daemon.requestLoop)
+        loop.daemon = True
+        loop.start()
+
+        names = []
+        for i in xrange(settings['tasks']):
+            name = 'bench{0:05d}.mkv'.format(i)
+            with open(os.path.join(serverHome,'master',name),'wb') as f:
+                f.write('\0' * settings['size'])
+            names.append(name)
+
+        before = scrape(encoder_cfg.metrics_port)
+        started = time.time()
+        failed = central.addTasks([{'name':name} for name in names])
+        deadline = started + settings['timeout']
+        cancels = cancelSome(central,encoders,settings.get('cancel',0),deadline)
+        while True:
+            samples = scrape(encoder_cfg.metrics_port)
+            done = metric(samples,'handbrake_tasks','state="finished"') + metric(samples,'handbrake_tasks','state="error"') + \
+                   metric(samples,'handbrake_tasks','state="cancel"')
+            if done >= len(names) - len(failed) or time.time() > deadline:
+                break
+            time.sleep(0.2)
+        wall = time.time() - started
+        latency = metric(samples,'handbrake_dispatch_latency_seconds_count') - metric(before,'handbrake_dispatch_latency_seconds_count')
+        latencySum = metric(samples,'handbrake_dispatch_latency_seconds_sum') - metric(before,'handbrake_dispatch_latency_seconds_sum')
+        cpu = metric(samples,'process_cpu_seconds_total') - metric(before,'process_cpu_seconds_total')
+        rpc = metric(samples,'handbrake_rpc_total') - metric(before,'handbrake_rpc_total')
+        finished = metric(samples,'handbrake_tasks','state="finished"')
+        duplicates = metric(samples,'handbrake_duplicates_total','result="started"') - metric(before,'handbrake_duplicates_total','result="started"')
+        won = metric(samples,'handbrake_duplicates_total','result="won"') - metric(before,'handbrake_duplicates_total','result="won"')
+        return {'encoders':settings['encoders'],'tasks':settings['tasks'],'seconds':wall,
+                'finished':int(finished),'failed':int(metric(samples,'handbrake_tasks','state="error"')) + len(failed),
+                'timedOut':done < len(names) - len(failed),
+                'tasksPerMinute':finished / wall * 60 if wall else None,
+                'dispatchLatency':latencySum / latency if latency else None,
+                'rpcPerSecond':rpc / wall if wall else None,
+                'serverCpu':cpu / wall if wall else None,
+                'serverCpuPerTask':cpu / finished if finished else None,
+                'duplicates':int(duplicates),'duplicatesWon':int(won),
+                'cancels':len(cancels),'cancelsFailed':len([name for name,took,ok in cancels if not ok]),
+                'cancelSeconds':max([took for name,took,ok in cancels] or [None])}
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(root,True)
+
+def run(settings,log):
+    """ Does a run in a process of its own, returns its results """
+    handle,path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        ret = subprocess.call([sys.executable,os.path.abspath(__file__),'--run',json.dumps(settings),'--result',path],
+                              stdout=log,stderr=subprocess.STDOUT,cwd=here)
+        with open(path) as f:
+            data = f.read()
+        if ret != 0 or not data:
+            raise RuntimeError('Run with {0} encoders and {1} tasks failed, see {2}'.format(settings['encoders'],settings['tasks'],log.name))
+        return json.loads(data)
+    finally:
+        os.unlink(path)
+
+def compare(results,baseline):
+    """ Print how each run did against the same run in an earlier results file """
+    old = dict(((run['encoders'],run['tasks']),run) for run in baseline['runs'])
+    print
+    print 'Against {0}:'.format(baseline.get('started'))
+    for run in results['runs']:
+        before = old.get((run['encoders'],run['tasks']))
+        if not before or not before['tasksPerMinute'] or not run['tasksPerMinute']:
+            continue
+        change = (run['tasksPerMinute'] / before['tasksPerMinute'] - 1) * 100
+        print '  {0:>4} encoders {1:>6} tasks  {2:+6.1f}% tasks/min'.format(run['encoders'],run['tasks'],change)
+
+def sampleTasks(count):
+    """ count finished tasks with everything filled in, as big as tasks get """
+    from encoder_cfg import Task, phases
+    tasks = []
+    for i in xrange(count):
+        task = Task('Some Show S01E{0:05d}.mkv'.format(i),'x264','mp4',False,'20',priority=i % 3,
+                    digest='{0:040x}'.format(i))
+        task.setCost(2700.0 + i)
+        task.setSize(4 * 1024 ** 3 + i)
+        task.taskStarted()
+        task.setProgress(100,212.5,198.25,0)
+        task.taskFinished()
+        task.setOutputName('Some Show S01E{0:05d}.mp4'.format(i))
+        for phase,start,end in phases:
+            task.mark(start)
+            task.mark(end)
+        tasks.append(task)
+    return tasks
+
+def footprint(task):
+    """ Roughly how many bytes a task holds on to, itself and every value in it that isn't shared """
+    size = sys.getsizeof(task)
+    values = []
+    if hasattr(task,'__dict__'):
+        size += sys.getsizeof(task.__dict__)
+        values = task.__dict__.values()
+    else:
+        values = [getattr(task,field) for field in task.__slots__]
+    for value in values:
+        if value is None or isinstance(value,bool) or (isinstance(value,int) and -5 <= value <= 256):
+            continue
+        size += sys.getsizeof(value)
+        if isinstance(value,dict):
+            size += sum(sys.getsizeof(x) for x in value.values())
+    return size
+
+def wire(count):
+    """ Time count tasks through each of Pyro's serializers, as a getTasks reply """
+    import Pyro4.util
+    tasks = sampleTasks(count)
+    reply = dict((task.getName(),(task,'encoder.box1','Finished')) for task in tasks)
+    print '{0} tasks, {1:.0f} bytes each in memory'.format(count,sum(footprint(task) for task in tasks) / float(count))
+    print '{0:>10} {1:>12} {2:>12} {3:>12}'.format('serializer','bytes/task','encode','decode')
+    for name in ['pickle','marshal','json','serpent']:
+        try:
+            serializer = Pyro4.util.get_serializer(name)
+        except Exception:
+            print '{0:>10} not available'.format(name)
+            continue
+        try:
+            started = time.time()
+            data = serializer.dumps(reply)
+            encoded = time.time()
+            back = serializer.loads(data)
+            decoded = time.time()
+            # Make sure it came back as tasks rather than something that merely looks like them
+            back[tasks[-1].getName()][0].getTimes()
+        except Exception as e:
+            print '{0:>10} unable to send tasks ({1})'.format(name,e)
+            continue
+        print '{0:>10} {1:>12.1f} {2:>11.1f}ms {3:>11.1f}ms'.format(name,len(data) / float(count),
+                                                                     (encoded - started) * 1000,(decoded - encoded) * 1000)
+
+def numbers(value):
+    return [int(x) for x in value.split(',') if x]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the farm with stubbed out handbrakes')
+    parser.add_argument('--encoders',type=numbers,default=[1,4],help='Comma separated encoder counts to try')
+    parser.add_argument('--tasks',type=numbers,default=[20],help='Comma separated task counts to try')
+    parser.add_argument('--slots',type=int,default=1,help='Encode slots per encoder')
+    parser.add_argument('--fps',type=float,default=300,help='How fast the stub handbrake encodes')
+    parser.add_argument('--length',type=float,default=10,help='Seconds of video in each source')
+    parser.add_argument('--size',type=int,default=1024 * 1024,help='Bytes in each source')
+    parser.add_argument('--handbrake',default=os.path.join(here,'stubhandbrake.py'),help='What to run as handbrake')
+    parser.add_argument('--slow',type=int,default=0,help='How many of the encoders run at a quarter of the speed')
+    parser.add_argument('--speculative',type=int,help='Most duplicates of stragglers to run at once, 0 for none (default speculative_limit)')
+    parser.add_argument('--grace',type=float,help='Seconds a task runs before it can count as a straggler (default straggler_grace)')
+    parser.add_argument('--server-mode',choices=['threads','loop'],default='threads',help='How the central server runs, see server_mode')
+    parser.add_argument('--cancel',type=int,default=0,help='How many tasks to cancel once they\'re encoding')
+    parser.add_argument('--timeout',type=float,default=600,help='Give up on a run after this many seconds')
+    parser.add_argument('--output',default='benchmark.json',help='Where to save the results')
+    parser.add_argument('--compare',help='Earlier results to compare against')
+    parser.add_argument('--log',default='benchmark.log',help='Where the runs\' output goes')
+    parser.add_argument('--wire',type=int,help='Just time sending this many tasks through Pyro\'s serializers')
+    parser.add_argument('--run',help=argparse.SUPPRESS)
+    parser.add_argument('--result',help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.wire:
+        wire(args.wire)
+        return
+
+    if args.run:
+        result = runOnce(json.loads(args.run))
+        with open(args.result,'w') as f:
+            json.dump(result,f)
+        # The encoders' timers would keep us going forever
+        sys.stdout.flush()
+        os._exit(0)
+
+    results = {'started':time.strftime('%Y-%m-%d %H:%M:%S'),'host':socket.gethostname(),
+               'settings':{'slots':args.slots,'fps':args.fps,'length':args.length,'size':args.size,'handbrake':args.handbrake,
+                           'slow':args.slow,'speculative':args.speculative,'grace':args.grace,
+                           'serverMode':args.server_mode,'cancel':args.cancel},
+               'runs':[]}
+    print '{0:>8} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}'.format('encoders','tasks','seconds','tasks/min','dispatch','rpc/s','cpu')
+    with open(args.log,'w') as log:
+        for encoders in args.encoders:
+            for tasks in args.tasks:
+                settings = dict(results['settings'],encoders=encoders,tasks=tasks,timeout=args.timeout)
+                result = run(settings,log)
+                results['runs'].append(result)
+                notes = ''
+                if result['duplicates']:
+                    notes += ' ({0} duplicates, {1} won)'.format(result['duplicates'],result['duplicatesWon'])
+                if result.get('cancels'):
+                    notes += ' ({0} cancelled, {1} didn\'t stop, slowest call {2:.2f}s)'.format(
+                        result['cancels'],result['cancelsFailed'],result['cancelSeconds'])
+                if result['timedOut']:
+                    notes += ' (timed out)'
+                print '{0:>8} {1:>8} {2:>10.1f} {3:>10.1f} {4:>10} {5:>10.1f} {6:>10.2f}{7}'.format(
+                    encoders,tasks,result['seconds'],result['tasksPerMinute'] or 0,
+                    '{0:.2f}s'.format(result['dispatchLatency']) if result['dispatchLatency'] is not None else '-',
+                    result['rpcPerSecond'] or 0,result['serverCpu'] or 0,notes)
+                sys.stdout.flush()
+    with open(args.output,'w') as f:
+        json.dump(results,f,indent=2,sort_keys=True)
+    print 'Results saved to {0}'.format(args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+    if any(run.get('cancelsFailed') for run in results['runs']):
+        sys.exit('Some cancelled tasks didn\'t stop')
+
+if __name__ == '__main__':
+    main()
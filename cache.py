@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import hashlib
+import tempfile
+import logging
+import threading
+import collections
+from encoder_cfg import cache_size
+
+def copy(src,dst):
+    """ Copy src to dst under a hidden name next to it then rename it into place, so dst is never seen
+        half written. Never a hard link, an upload over an output writes into the file it's already got,
+        which would change the other copy with it
+    """
+    handle,partial = tempfile.mkstemp(prefix='.',suffix='.tmp',dir=os.path.dirname(dst))
+    os.close(handle)
+    try:
+        shutil.copyfile(src,partial)
+        if os.path.exists(dst):
+            # Windows won't rename over an existing file
+            os.unlink(dst)
+        os.rename(partial,dst)
+    except:
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+        raise
+
+class ResultCache(object):
+    """ Keeps finished outputs around so a video that's added again with the same settings doesn't
+        have to be encoded again
+            - Outputs are keyed on the sha1 of the source plus the settings that affect the output
+            - Once the cache is over limit bytes the least recently used outputs are dropped
+            - A limit of 0 turns the cache off
+            - Outputs are copied in and out, the slow part happens outside the lock so a big copy
+              doesn't hold up anyone asking for the stats
+    """
+    def __init__(self,root,limit=cache_size):
+        self.root = root
+        self.limit = limit
+        # key -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        # Pick up whatever was cached last time round, the modified time is bumped on every hit so
+        # it's as good as the last use
+        found = []
+        for name in os.listdir(self.root):
+            path = self.path(name)
+            if name.startswith('.'):
+                # A copy that never made it in
+                os.unlink(path)
+                continue
+            found.append((os.path.getmtime(path),name,os.path.getsize(path)))
+        for mtime,name,size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+        self.evict()
+
+    def enabled(self):
+        return self.limit > 0
+
+    def key(self,task):
+        """ The cache key for a task, None if we don't know what its source's hash is """
+        if not task.getDigest():
+            return None
+        settings = [task.getDigest(),task.getEncoder(),task.getFormat(),task.getQuality(),bool(task.getLarge())]
+        return hashlib.sha1('\0'.join(str(x) for x in settings)).hexdigest()
+
+    def path(self,key):
+        return os.path.join(self.root,key)
+
+    def fetch(self,task,output):
+        """ If we've already encoded this source with these settings put the result at output """
+        key = self.key(task)
+        if not self.enabled() or not key:
+            return False
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            # Most recently used goes to the back
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+            os.utime(self.path(key),None)
+        try:
+            copy(self.path(key),output)
+        except (IOError,OSError):
+            # Most likely evicted since we looked, it'll just have to be encoded again
+            logging.exception('Unable to serve {0} from the cache'.format(output))
+            return False
+        return True
+
+    def store(self,task,output):
+        """ Remember a task's finished output """
+        key = self.key(task)
+        if not self.enabled() or not key:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+        size = os.path.getsize(output)
+        if size > self.limit:
+            return
+        try:
+            copy(output,self.path(key))
+        except (IOError,OSError):
+            logging.exception('Unable to cache {0}'.format(output))
+            return
+        with self.lock:
+            if key in self.entries:
+                # Stored by someone else while we were copying, it's the same output either way
+                return
+            self.entries[key] = size
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        while self.size > self.limit and self.entries:
+            key,size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(self.path(key))
+            except OSError:
+                pass
+
+    def getStats(self):
+        with self.lock:
+            return {'hits':self.hits,'misses':self.misses,'entries':len(self.entries),'size':self.size,'limit':self.limit}
@@ -7,56 +7,554 @@ import threading
 import time
 import logging
 import os
+import re
+import subprocess
 import multiprocessing
 from threading import Timer
 from pyftpdlib import ftpserver
-from encoder_cfg import pyro_host, pyro_port, ftp_port, ftp_user, ftp_pass
-from encoder_cfg import RUNNING, Task, max_tries, getLanIP
+from encoder_cfg import pyro_host, pyro_port, ftp_port, ftp_user, ftp_pass, storage_mode
+from encoder_cfg import Task, phases, max_tries, getLanIP
+from encoder_cfg import segment_length, segment_min_length
+from encoder_cfg import preempt_margin, idle_window, pyro_threads, max_tombstones, pyro_timeout
+from encoder_cfg import speculative_limit, straggler_ratio, straggler_grace
+from encoder_cfg import speed_smoothing, calibration_drop, metrics_port
+from encoder_cfg import server_mode, offload_threads, offload_queue
+from scheduler import TaskQueue, TaskStore, Leases, ProgressHistory
+from metrics import registry, serve as serveMetrics
+from storage import SharedStorage, hashFile
+from cache import ResultCache
+from journal import Journal
+from eventloop import EventLoop
+import hashlib
+import collections
+import heapq
+
+# Used for splitting videos on keyframes and stitching the encoded segments back together
+ffprobe = 'ffprobe'
+ffmpeg = 'ffmpeg'
+
+def probeDuration(path):
+    """ Ask ffprobe for the length of the video in seconds, None if it can't tell us """
+    try:
+        out = subprocess.check_output([ffprobe,'-v','error','-show_entries','format=duration',
+                                       '-of','default=noprint_wrappers=1:nokey=1',path])
+        return float(out.strip())
+    except (OSError,subprocess.CalledProcessError,ValueError):
+        return None
+
+def nextKeyframe(path,at):
+    """ Find the time of the first video keyframe at or after 'at' seconds, only the frames
+        in a short window after 'at' are decoded so this is cheap even on huge files
+    """
+    try:
+        out = subprocess.check_output([ffprobe,'-v','error','-select_streams','v:0','-skip_frame','nokey',
+                                       '-read_intervals','{0}%+30'.format(at),
+                                       '-show_entries','frame=best_effort_timestamp_time','-of','csv=p=0',path])
+    except (OSError,subprocess.CalledProcessError):
+        return None
+    for line in out.split():
+        try:
+            time = float(line.strip(','))
+        except ValueError:
+            continue
+        if time >= at:
+            return time
+    return None
+
+def splitPoints(path):
+    """ Work out where to cut the video into segments, returns a list of (start,stop) pairs in seconds,
+        the last segment has a stop of None so it runs to the end of the video. Cuts land on keyframes
+        so the segments join back together without gaps or repeated frames. Returns None if the video
+        is too short to bother splitting or if we can't probe it.
+    """
+    duration = probeDuration(path)
+    if not duration or duration < segment_length * 2:
+        return None
+    cuts = [0.0]
+    at = segment_length
+    while at < duration - segment_min_length:
+        cut = nextKeyframe(path,at)
+        if cut is None:
+            break
+        if cut - cuts[-1] >= segment_min_length and duration - cut >= segment_min_length:
+            cuts.append(cut)
+        at = max(cut,at) + segment_length
+    if len(cuts) < 2:
+        return None
+    return zip(cuts,cuts[1:] + [None])
+
+def cutSegment(path,start,stop,output):
+    """ Copy the part of the video from start to stop (keyframes, a stop of None runs to the end) into
+        output without re-encoding it
+    """
+    args = [ffmpeg,'-v','error','-y','-ss',str(start),'-i',path]
+    if stop is not None:
+        args.extend(['-t',str(stop - start)])
+    args.extend(['-map','0','-c','copy',output])
+    try:
+        ret = subprocess.call(args)
+    except OSError:
+        ret = -1
+    return ret == 0 and os.path.exists(output)
+
+def joinSegments(parts,output):
+    """ Stitch the encoded segments (in order) into output without re-encoding them """
+    listFile = output + '.segments'
+    with open(listFile,'w') as f:
+        for part in parts:
+            f.write("file '{0}'\n".format(part.replace("'","'\\''")))
+    try:
+        ret = subprocess.call([ffmpeg,'-v','error','-y','-f','concat','-safe','0','-i',listFile,'-c','copy',output])
+    except OSError:
+        ret = -1
+    os.unlink(listFile)
+    return ret == 0 and os.path.exists(output)
+
+# How long tasks wait, in seconds, from a second up to a day
+wait_buckets = (1,5,15,30,60,300,900,1800,3600,7200,14400,43200,86400)
+
+dispatchLatency = registry.histogram('handbrake_dispatch_latency_seconds','How long tasks wait in the queue before an encoder takes them',
+                                     buckets=wait_buckets)
+stateTime = registry.histogram('handbrake_task_state_seconds','How long tasks spend in a state before moving on',['state'],
+                               buckets=wait_buckets)
+taskFailures = registry.counter('handbrake_task_failures_total','Tasks which failed, by why',['reason'])
+taskRetries = registry.counter('handbrake_task_retries_total','Failed or cancelled tasks which were put back in the queue')
+speculations = registry.counter('handbrake_duplicates_total','Duplicates run of straggling tasks, by how they turned out',['result'])
+rpcCalls = registry.counter('handbrake_rpc_total','Calls made to the central server over Pyro')
+# direction is from the encoders' point of view, 'download' for videos the FTP server sent out and 'upload' for ones it received
+ftpBytes = registry.counter('handbrake_ftp_bytes_total','Bytes moved by the FTP server',['direction'])
+ftpSeconds = registry.counter('handbrake_ftp_seconds_total','Seconds the FTP server spent moving files',['direction'])
+ftpFailures = registry.counter('handbrake_ftp_failures_total','FTP transfers which didn\'t finish',['direction'])
+ftpRate = registry.histogram('handbrake_ftp_transfer_mbps','How fast each FTP transfer went, in MB/s',['direction'],
+                             buckets=(1,5,10,25,50,100,250,500,1000))
+
+class CountingDaemon(Pyro4.Daemon):
+    """ A Pyro daemon which counts the calls it handles for the metrics """
+    def handleRequest(self,conn):
+        rpcCalls.inc()
+        return Pyro4.Daemon.handleRequest(self,conn)
+
+class MeteredFTPHandler(ftpserver.FTPHandler):
+    """ Hands every transfer over to the central server's metrics. report is called with each one, when the
+        FTP server has its own process that puts them on a multiprocessing queue
+    """
+    report = None
+
+    def log_transfer(self,cmd,filename,receive,completed,elapsed,bytes):
+        ftpserver.FTPHandler.log_transfer(self,cmd,filename,receive,completed,elapsed,bytes)
+        if self.report is not None:
+            self.report(('upload' if receive else 'download',completed,elapsed,bytes))
+
+# Sources are grouped by size for the phase report, (upper bound in bytes,label)
+size_buckets = [(100 * 1024 ** 2,'<100MB'),(500 * 1024 ** 2,'100-500MB'),(1024 ** 3,'500MB-1GB'),
+                (4 * 1024 ** 3,'1-4GB'),(16 * 1024 ** 3,'4-16GB'),(float('inf'),'>16GB')]
+
+def sizeBucket(size):
+    """ The size_buckets label for a source size, 'unknown' if we don't know it """
+    if size is None:
+        return 'unknown'
+    for bound,label in size_buckets:
+        if size < bound:
+            return label
+
+class PhaseTotals(object):
+    """ Adds up how long a group of tasks spent in each phase for getPhaseReport """
+    def __init__(self):
+        self.tasks = 0
+        self.seconds = dict((phase,0.0) for phase,start,end in phases)
+
+    def add(self,durations):
+        self.tasks += 1
+        for phase,seconds in durations.items():
+            self.seconds[phase] += seconds
+
+    def summary(self):
+        total = sum(self.seconds.values())
+        share = dict((phase,seconds / total if total else 0.0) for phase,seconds in self.seconds.items())
+        return {'tasks':self.tasks,'seconds':dict(self.seconds),'share':share}
+
+class EncoderProxies(object):
+    """ Proxies for talking to the encoders, kept around so each call doesn't have to go through the
+        name server and connect all over again
+            - A proxy is only ever used by one thread at a time, threads which want the same encoder at
+              the same time get a proxy each
+            - If a call can't get through, every idle proxy for that encoder is dropped (it's probably
+              been restarted) and the call gets one more go on a freshly looked up one
+            - Given the name server itself (when it runs in this process, see startEventLoop) encoders
+              are looked up in it directly, rather than over Pyro through an event loop which may be
+              stuck waiting on us
+    """
+    def __init__(self,nameserver=None):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.nameserver = nameserver
+
+    def checkout(self,name):
+        with self.lock:
+            if self.idle.get(name):
+                return self.idle[name].pop()
+        if self.nameserver:
+            proxy = Pyro4.Proxy(self.nameserver.lookup(name))
+        else:
+            proxy = Pyro4.Proxy('PYRONAME:{0}@{1}:{2}'.format(name,pyro_host,pyro_port))
+        # Don't let a hung encoder hang us too
+        proxy._pyroTimeout = pyro_timeout
+        return proxy
+
+    def checkin(self,name,proxy):
+        with self.lock:
+            self.idle.setdefault(name,[]).append(proxy)
+
+    def invalidate(self,name):
+        with self.lock:
+            proxies = self.idle.pop(name,[])
+        for proxy in proxies:
+            proxy._pyroRelease()
+
+    def call(self,name,method,*args):
+        """ Call method on encoder name """
+        for tries in (0,1):
+            proxy = self.checkout(name)
+            try:
+                result = getattr(proxy,method)(*args)
+            except Pyro4.errors.CommunicationError:
+                proxy._pyroRelease()
+                self.invalidate(name)
+                if tries:
+                    raise
+                continue
+            except Exception:
+                # The encoder raised, the connection itself is fine
+                self.checkin(name,proxy)
+                raise
+            self.checkin(name,proxy)
+            return result
         
 class CentralEncoding(object):
     """ The main server obect
             - Keeps tracks of tasks
-            - Periodically pings encoders of active tasks
-            - Moves tasks back to pending if encoder has died
+            - Moves tasks back to pending if their encoder stops reporting on them
             - Provides tasks and task information to all callers
     """
-    def __init__(self,maxTasks=None):
+    def __init__(self,maxTasks=None,transfers=None,loop=None,nameserver=None):
 
         # homeDir is the location where the server will store all videos
         # TODO -- make this configurable
         self.homeDir = os.path.join(os.path.expanduser("~"),'master')
         if not os.path.exists(self.homeDir):
             os.makedirs(self.homeDir)
+        # The master dir is local to us whichever way the encoders get at it
+        self.storage = SharedStorage(self.homeDir)
+
+        # Outputs we've already encoded, in case the same video comes round again
+        self.cache = ResultCache(os.path.join(self.homeDir,'cache'))
 
         # Optional task cap -- server will refuse additional
         # tasks once the cap has been reached
         self.maxTasks = maxTasks
 
-        # Task buckets -- pretty self explanatory
-        self.pending = {}
-        self.encoding = {}
-        self.finished = {}
-        self.cancel = {}
-        self.error = {}
+        # The event loop we run on in 'loop' mode (see server_mode), None when every call gets a thread
+        self.loop = loop
+
+        # Every task, with the state it's in -- pending, encoding, reserved (claimed by an encoder which is
+        # downloading it ahead of time, it moves to encoding once the encoder actually starts on it),
+        # segmented (videos which have been split up, the parent task never gets handed to an encoder, it
+        # just keeps track of its segments until they can be joined), joining (a split video whose segments
+        # are being stitched back together), finished, error and cancel
+        self.store = TaskStore()
+        # Order in which the pending tasks get handed out, every pending task has an entry here
+        self.queue = TaskQueue()
+        # Encoders which recently asked for work and didn't get any, name -> time they asked
+        self.idle = {}
+        # Encoders currently parked in getTask waiting for work
+        self.waiting = set()
+        # Tasks which have been added but are still being looked over (probed, hashed) before they're queued
+        self.preparing = set()
+
+        # Idle encoders wait on taskReady, queueing a task wakes one of them up. Anything which has to
+        # look at or move tasks in more than one step holds the store's lock while it does
+        self.lock = self.store.lock
+        self.taskReady = threading.Condition(self.lock)
+
+        # Every change to a task bumps the revision, so the UI can ask for just what changed since it last
+        # looked. revisions maps task name -> revision it last changed at, removed holds the same for
+        # tasks which have been cleared. Only the newest max_tombstones removals are remembered, anyone
+        # asking about changes from before horizon gets everything
+        self.revision = 0
+        self.revisions = {}
+        self.removed = {}
+        self.horizon = 0
+        # A crash loses whatever changes hadn't been journaled yet, so a revision a UI was given before a
+        # restart may never have made it to disk. UIs are handed (epoch,revision) and anyone asking with
+        # a revision from another run gets everything
+        self.epoch = time.time()
+        self.taskChanged = threading.Condition(self.lock)
+
+        # How fast each encoder gets through work (task cost per second), learned from the jobs they finish
+        self.speeds = {}
+
+        # Each encoder's last calibration results, see reportCalibration
+        self.calibrations = {}
+
+        # The batch of work we're currently getting through, and how the last few went, so the
+        # predicted and actual time it takes to empty the queue can be compared
+        self.batch = None
+        self.batches = collections.deque(maxlen=50)
+
+        # Connections to the encoders, for cancelling their tasks. On an event loop the name server is
+        # on the same loop, so it's handed to us to look the encoders up in directly
+        self.encoders = EncoderProxies(nameserver)
+
+        # Every encoding or reserved task has a lease which the encoder's progress reports keep renewing,
+        # if one runs out the task goes back in the queue
+        self.leases = Leases()
+
+        # Stragglers running a second copy on another encoder (see speculate), task name -> that encoder.
+        # The duplicates have leases of their own, the task's lease is always its original encoder's
+        self.duplicates = {}
+        self.duplicateLeases = Leases()
+        # The stragglers as of the last check, see _checkTasks
+        self.straggling = []
+
+        # Recent progress of every encoding task, for working out when they'll be done
+        self.history = ProgressHistory()
+
+        # Task name -> (the bucket it's in,when it got there), for timing how long tasks spend in each state
+        self.states = {}
+        registry.gauge('handbrake_tasks','Tasks in each state',['state'],self.taskCounts)
+        registry.gauge('handbrake_encode_fps','Frames per second each encoder is getting through, over all its encodes',
+                       ['encoder'],self.encoderFps)
+        registry.gauge('handbrake_encoders','Encoders which are working or recently asked for work',
+                       function=self.locked(lambda: len(self.encodersAround())))
+        registry.gauge('handbrake_queue_drain_seconds','How long until the queue should be empty',
+                       function=self.locked(self.predictDrain))
+        if transfers is not None:
+            self.transferCounter = threading.Thread(target=self.countTransfers,args=(transfers,),name='Transfers')
+            self.transferCounter.daemon = True
+            self.transferCounter.start()
+
+        # Pick up wherever we were before the last restart. Tasks which were encoding stay with their
+        # encoders, any the encoders don't still have get requeued the next time we check on them
+        self.journal = Journal(os.path.join(self.homeDir,'journal'))
+        revision,states = self.journal.load()
+        rejoin = []
+        finalize = []
+        for name,(bucket,entry) in states.iteritems():
+            if bucket == 'joining':
+                # The join never finished, start it again from the segments
+                bucket = 'segmented'
+                rejoin.append(name)
+            if bucket in self.bare:
+                self.store.add(entry,bucket)
+            else:
+                self.store.add(entry[0],bucket,entry[1])
+            if bucket == 'pending':
+                self.queue.push(entry)
+            elif bucket == 'finished' and 'finishing' in entry[0].getTimes() and 'finalized' not in entry[0].getTimes():
+                # Finished, but we went down before it was cleaned up after
+                finalize.append(entry[0])
+            elif bucket in ('encoding','reserved'):
+                # Give the encoders a chance to tell us they've still got it
+                self.leases.grant(name)
+        # Carry on counting from where the journal got to, the epoch makes anyone who was watching before
+        # the restart get sent everything again
+        self.revision = revision
+        self.journal.start(self,revision,states)
+        for name in rejoin:
+            self.offload(self.segmentDone,name)
+        for task in finalize:
+            self.offload(self.finalizeTask,task)
 
-        # Check up on the tasks every minute
-        self.timer = Timer(60,self._checkTasks)
-        self.timer.start()
+        # Check for expired leases every second
+        self.schedule(1,self._checkTasks)
         
+    def schedule(self,delay,function):
+        """ Call function in delay seconds, on the event loop if we're on one """
+        if self.loop:
+            self.loop.callLater(delay,function)
+        else:
+            self.timer = Timer(delay,function)
+            self.timer.start()
+
+    def offload(self,function,*args):
+        """ Slow disk work (copying into the cache, joining segments) is handed to the event loop's worker
+            threads so it doesn't hold everything else up. If they're backed up it's done here and now,
+            which slows the loop down until they catch up. Without a loop it's always done here
+        """
+        if not self.loop or not self.loop.pool.submit(function,*args):
+            function(*args)
+
+    def markChanged(self,name):
+        """ Record that something about a task changed and wake up anyone waiting on getTaskChanges """
+        with self.taskChanged:
+            self.revision += 1
+            self.revisions[name] = self.revision
+            self.removed.pop(name,None)
+            self.trackState(name)
+            self.taskChanged.notifyAll()
+        self.journal.mark(name)
+
+    def markRemoved(self,name):
+        """ Record that a task is gone for good """
+        with self.taskChanged:
+            self.revision += 1
+            self.revisions.pop(name,None)
+            self.removed[name] = self.revision
+            if len(self.removed) > max_tombstones:
+                # Forget the oldest half of the removals
+                oldest = sorted(self.removed.values())[len(self.removed) // 2]
+                self.removed = dict((name,rev) for name,rev in self.removed.iteritems() if rev > oldest)
+                self.horizon = oldest
+            self.trackState(name)
+            self.taskChanged.notifyAll()
+        self.journal.mark(name)
+
+    def trackState(self,name):
+        """ Called with the lock held whenever a task changes, times how long it spent in its last bucket
+            if it's moved on
+        """
+        bucket = self.store.state(name)
+        previous = self.states.get(name)
+        if previous and previous[0] == bucket:
+            return
+        now = time.time()
+        if previous:
+            stateTime.observe(now - previous[1],state=previous[0])
+            if previous[0] == 'pending' and bucket in ('reserved','encoding'):
+                dispatchLatency.observe(now - previous[1])
+        if bucket in ('pending','reserved','encoding','segmented','joining'):
+            self.states[name] = (bucket,now)
+        else:
+            self.states.pop(name,None)
+
+    def locked(self,function):
+        """ Wraps function so it's called with the lock held, for metrics worked out when they're scraped """
+        def call():
+            with self.lock:
+                return function()
+        return call
+
+    def taskCounts(self):
+        """ Used by the metrics, how many tasks are in each state """
+        return self.store.counts()
+
+    def encoderFps(self):
+        """ Used by the metrics, encoder name -> total fps over its running encodes """
+        with self.lock:
+            fps = {}
+            for task,name in self.store.entries('encoding'):
+                fps[name] = fps.get(name,0.0) + (task.getFps() or 0.0)
+            return fps
+
+    def countTransfers(self,transfers):
+        """ Runs on its own thread, feeds the FTP server's transfers into the metrics """
+        while True:
+            self.countTransfer(transfers.get())
+
+    def countTransfer(self,transfer):
+        """ Feed one of the FTP server's transfers into the metrics """
+        direction,completed,elapsed,size = transfer
+        ftpBytes.inc(size,direction=direction)
+        ftpSeconds.inc(elapsed,direction=direction)
+        if not completed:
+            ftpFailures.inc(direction=direction)
+        elif elapsed > 0:
+            ftpRate.observe(size / elapsed / 1e6,direction=direction)
+
+    # The journal keeps each task as (state,entry), entry being the bare task for these states and
+    # (task,encoder name) for the rest
+    bare = ('pending','segmented','joining','cancel')
+
+    # What the UI calls each state
+    statuses = {'pending':'Pending','encoding':'Encoding','reserved':'Reserved','segmented':'Encoding',
+                'joining':'Joining','finished':'Finished','error':'Error','cancel':'Cancelled'}
+
+    def journalState(self,name):
+        """ (state,entry) for a task, None if it's gone """
+        entry = self.store.get(name)
+        if not entry:
+            return None
+        bucket,task,encoder = entry
+        return (bucket,task if bucket in self.bare else (task,encoder))
+
+    def journalStates(self,names):
+        """ Used by the journal, the current revision and the state of each named task """
+        with self.lock:
+            return self.revision,[(name,self.journalState(name)) for name in names]
+
+    def journalSnapshot(self):
+        """ Used by the journal, the current revision and the state of every task """
+        with self.lock:
+            return self.revision,dict((name,self.journalState(name)) for name in self.store.names())
+
+    def getTaskChanges(self,since,timeout=0):
+        """ External call point for the UI, returns (revision,changed,removed) where changed maps task name
+            -> (task,encoder,status) for every task which changed after revision since, and removed lists
+            the names of tasks cleared since then. If nothing has changed yet this waits up to timeout seconds
+            for something to happen. If since is too old to work out what was removed, or from before the
+            server was last started, removed is None and changed holds every task.
+
+            The UI should treat revisions as opaque, passing back the last one it was given (0 the first time)
+        """
+        if self.loop:
+            # Nothing else would get done while we waited
+            timeout = 0
+        deadline = time.time() + timeout
+        with self.taskChanged:
+            # Serializers which don't do tuples send it back as a list
+            current = isinstance(since,(tuple,list)) and since[0] == self.epoch
+            since = since[1] if current else -1
+            while self.revision <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.taskChanged.wait(remaining)
+            revision = (self.epoch,self.revision)
+            if not current or since < self.horizon:
+                return revision,self.getTasks(),None
+            changed = {}
+            for name,rev in self.revisions.iteritems():
+                if rev > since:
+                    info = self.taskInfo(name)
+                    if info:
+                        changed[name] = info
+            removed = [name for name,rev in self.removed.iteritems() if rev > since]
+            return revision,changed,removed
+
+    def taskInfo(self,name):
+        """ (task,encoder,status) for a single task, None if it doesn't exist """
+        entry = self.store.get(name)
+        if not entry:
+            return None
+        bucket,task,encoder = entry
+        if bucket in ('segmented','joining'):
+            task.setCompleted(round(self.segmentProgress(task),2))
+            encoder = '{0} segments'.format(len(task.getSegments()))
+        return (task,encoder,self.statuses[bucket])
+
     def getTasks(self):
-        """ Pull in a list of all the tasks from all the task buckets """
-        tasks = {}
-        for task in self.pending.values():
-            tasks[task.getName()] = (task,None,'Pending')
-        for task,name in self.encoding.values():
-            tasks[task.getName()] = (task,name,'Encoding')
-        for task,name in self.finished.values():
-            tasks[task.getName()] = (task,name,'Finished')
-        for task,name in self.error.values():
-            tasks[task.getName()] = (task,name,'Error')
-        for task in self.cancel.values():
-            tasks[task.getName()] = (task,None,'Cancelled')
-        return tasks
+        """ Every task, name -> (task,encoder,status) """
+        with self.lock:
+            return dict((name,self.taskInfo(name)) for name in self.store.names())
+
+    def findTask(self,name):
+        """ Find a task whatever state it's in, returns None if it doesn't exist """
+        return self.store.task(name)
+
+    def segmentProgress(self,parent):
+        """ Overall completion of a split video, finished segments count as 100 """
+        total = 0.0
+        for name in parent.getSegments():
+            if self.store.state(name) == 'finished':
+                total += 100
+            else:
+                task = self.findTask(name)
+                if task:
+                    try:
+                        total += float(task.getCompleted())
+                    except ValueError:
+                        pass
+        return total / len(parent.getSegments())
 
     def createTask(self,name,encoder,format,large,quality):
         """ Worthless function for creating a task -- probably had a purpose before, doesn't now """
@@ -64,157 +562,996 @@ class CentralEncoding(object):
     
     def cancelTask(self,name):
         """ Cancel a task, if the task is active, talk to the encoder, if it's pending, just kill it
+            On an event loop the encoder is told from a worker thread, so for an active task this only
+            says the cancel is on its way
         """
-        if name in self.pending.keys():
-            self.cancel[name] = self.pending[name]
-            self.pending[name] = None
-            del self.pending[name]
+        duplicate = None
+        with self.lock:
+            entry = self.store.get(name)
+            if not entry:
+                return False
+            bucket,task,nsname = entry
+            if bucket == 'pending':
+                self.unqueueTask(name)
+                self.store.add(task,'cancel')
+                self.markChanged(name)
+            elif bucket == 'segmented':
+                # Cancel the parent first so cancelling the segments doesn't try to join or fail it
+                self.store.move(name,'cancel')
+                self.markChanged(name)
+            elif bucket not in ('encoding','reserved'):
+                return False
+            duplicate = self.dropDuplicate(name)
+        if duplicate:
+            speculations.inc(result='dropped')
+            self.offload(self.cancelDuplicate,name,duplicate)
+        if bucket == 'segmented':
+            for segment in task.getSegments():
+                if self.isActive(segment):
+                    try:
+                        self.cancelTask(segment)
+                    except Exception:
+                        # Carry on with the rest, if its encoder has gone the segment's lease runs out
+                        logging.exception('Unable to cancel {0}'.format(segment))
             return True
-        if name in self.encoding.keys():
-            task,nsname = self.encoding[name]
-            encoder = Pyro4.Proxy('PYRONAME:{0}@{1}:{2}'.format(nsname,pyro_host,pyro_port))
-            if encoder.cancel(name):
-                self.cancel[name] = task
-                self.encoding[name] = None
-                del self.encoding[name]
+        if bucket != 'pending':
+            if self.loop:
+                # The encoder could hold the whole loop up for pyro_timeout seconds
+                self.offload(self.stopTask,task,nsname)
                 return True
-        return False
+            return self.stopTask(task,nsname)
+        if task.isSegment():
+            self.segmentDone(task.getParent())
+        return True
+
+    def stopTask(self,task,nsname):
+        """ The rest of cancelTask for an active task, tell encoder nsname to stop on it and move it to cancel
+            once it has
+        """
+        name = task.getName()
+        # Don't hold everyone else up while we talk to the encoder
+        if not self.encoders.call(nsname,'cancel',name):
+            return False
+        with self.lock:
+            # It may have finished or been handed back while we were asking
+            if self.store.encoder(name) != nsname or not self.store.move(name,'cancel',expect=('encoding','reserved')):
+                return False
+            self.markChanged(name)
+        if task.isSegment():
+            self.segmentDone(task.getParent())
+        return True
 
     def clearTask(self,name):
         """ Clear the given inactive task, just delete the reference, 'nuff said
+            Clearing a split video clears whatever is left of its segments too
         """
-        if name in self.error.keys():
-            del self.error[name]
-            return True
-        elif name in self.cancel.keys():
-            del self.cancel[name]
-            return True
-        elif name in self.finished.keys():
-            del self.finished[name]
-            return True
-        return False
+        with self.lock:
+            entry = self.store.get(name)
+            if not entry:
+                return False
+            bucket,task,nsname = entry
+            if task.getSegments() and bucket in ('error','cancel','finished'):
+                for segment in task.getSegments():
+                    self.clearTask(segment)
+            if self.store.remove(name,expect=('error','cancel','finished')):
+                self.markRemoved(name)
+                self.removePiece(task)
+                return True
+            return False
 
-    def retry(self,key,taskDict):
-        """ Retry the given error'ed or cancelled tasks, just reset the task and move it to the pending bucket
+    def retryTask(self,name):
+        """ External call point for retrying an errored or cancelled task, just reset the task and move it
+            to pending
         """
-        if key in taskDict.keys():
-            try:
-                task,nsname = taskDict[key]
-            except TypeError:
-                task = taskDict[key]
+        rejoin = False
+        with self.lock:
+            entry = self.store.get(name)
+            if not entry or entry[0] not in ('error','cancel'):
+                return False
+            task = entry[1]
             task.reset()
-            self.pending[key] = task
-            taskDict[key] = None
-            del taskDict[key]
-            return True
-        return False
+            if task.getSegments():
+                # Retrying a split video only requeues the segments which didn't make it, if they all did
+                # it was the join which failed so that gets another go
+                task.setOutputName(self.joinedName(task))
+                self.store.add(task,'segmented')
+                self.markChanged(name)
+                for segment in task.getSegments():
+                    self.retryTask(segment)
+                rejoin = not any(self.isActive(segment) for segment in task.getSegments())
+            else:
+                self.queueTask(task)
+                taskRetries.inc()
+                if task.isSegment() and self.store.move(task.getParent(),'segmented',expect='error'):
+                    # The parent failed because of this segment, bring it back to life
+                    self.markChanged(task.getParent())
+        if rejoin:
+            # The join is slow, so it's done without the lock
+            self.offload(self.segmentDone,name)
+        return True
 
-    def retryTask(self,name):
-        """ External call point for retrying a task, finds out which, if any, bucket the inactive task is in
-        """
-        if name in self.error.keys():
-            return self.retry(name,self.error)
-        elif name in self.cancel.keys():
-            return self.retry(name,self.cancel)
-        return False
-    
     def uniqueNameCheck(self,name):
         """ Since we identify based on video name, we probably don't want multiple active tasks that have the same
-        name, so this ensures no keys exist in the active buckets which equal name
+        name, so this ensures no active task (or split video, or task still being added) is called name
+        """
+        return name not in self.preparing and self.store.state(name) not in ('pending','encoding','reserved','segmented','joining')
+
+    def isActive(self,name):
+        """ Is the task waiting for or assigned to an encoder """
+        return self.store.state(name) in ('pending','encoding','reserved')
+
+    def queueTask(self,task):
+        """ Put a task in the pending bucket and in line to be handed out, if any encoders
+            are waiting for work, wake one of them up to take it
+        """
+        with self.taskReady:
+            if 'queued' not in task.getTimes():
+                # Moving a task around the queue doesn't count as queueing it again
+                task.mark('queued')
+            self.store.add(task,'pending')
+            self.queue.push(task)
+            self.taskReady.notify()
+        self.markChanged(task.getName())
+
+    def unqueueTask(self,name):
+        """ Take a task out of pending, returns the task """
+        with self.lock:
+            self.queue.remove(name)
+            return self.store.remove(name,expect='pending')
+
+    def setTaskPriority(self,name,priority):
+        """ External call point for bumping a pending task up or down the queue """
+        with self.lock:
+            if self.store.state(name) != 'pending':
+                return False
+            task = self.store.task(name)
+            task.setPriority(priority)
+            self.queueTask(task)
+        # Preempting means talking to an encoder, which mustn't hold up an event loop
+        self.offload(self.preemptFor,task)
+        return True
+
+    def preemptFor(self,task):
+        """ If task is next in line but every encoder is busy with much less important work, kill the
+            least important encode (the one that's made the least progress if there's a tie) and put it
+            back in the queue so task gets the encoder
         """
-        if name in self.pending.keys() + self.encoding.keys():
+        if preempt_margin is None:
+            return False
+        with self.lock:
+            if self.queue.peek() != task.getName():
+                return False
+            # Someone's idle, they'll pick the task up on their own shortly
+            if self.waiting:
+                return False
+            now = time.time()
+            for when in self.idle.values():
+                if now - when < idle_window:
+                    return False
+            victims = [(victim,nsname) for victim,nsname in self.store.entries('encoding')
+                       if task.getPriority() - victim.getPriority() >= preempt_margin]
+            if not victims:
+                return False
+            victim,nsname = min(victims,key=lambda x: (x[0].getPriority(),float(x[0].getCompleted() or 0)))
+        try:
+            if not self.encoders.call(nsname,'cancel',victim.getName()):
+                return False
+        except Exception:
+            logging.exception('Unable to preempt {0} on {1}'.format(victim.getName(),nsname))
             return False
+        with self.lock:
+            if self.store.state(victim.getName()) != 'encoding' or self.store.encoder(victim.getName()) != nsname:
+                # Finished or went back in the queue while we were at it
+                return False
+            logging.info('Preempted {0} on {1} for {2}'.format(victim.getName(),nsname,task.getName()))
+            duplicate = self.dropDuplicate(victim.getName())
+            victim.reset()
+            self.queueTask(victim)
+        if duplicate:
+            speculations.inc(result='dropped')
+            self.offload(self.cancelDuplicate,victim.getName(),duplicate)
         return True
-        
-    def addTask(self,name,encoder='x264',format='mp4',large=False,quality='20'):
+
+    def addTask(self,name,encoder='x264',format='mp4',large=False,quality='20',segmented=False,priority=0,digest=None):
         """ Called externally to add new tasks
+            If segmented is set the video is split into keyframe aligned pieces which are encoded
+            in parallel by whichever encoders are free, then joined back together when they're all done
+            digest is the sha1 of the video as the UI sent it, encoders check their copy against it
+            Doesn't return until the task is safely in the journal (raises JournalError if it can't be put
+            there), unless we're on an event loop, where it's journaled as soon as it has been looked over
+            and queued
+        """
+        added = self.newTask(name,encoder,format,large,quality,segmented,priority,digest)
+        if not self.loop:
+            self.trackBatch()
+            self.journal.sync()
+        return added
+
+    def addTasks(self,tasks):
+        """ Called externally to add a batch of tasks in one go, tasks is a list of dicts of addTask's
+            arguments. Returns the names of the ones which couldn't be added
+        """
+        failed = [spec['name'] for spec in tasks if not self.newTask(**spec)]
+        if not self.loop:
+            self.trackBatch()
+            self.journal.sync()
+        return failed
+
+    def newTask(self,name,encoder='x264',format='mp4',large=False,quality='20',segmented=False,priority=0,digest=None):
+        """ Does the work for addTask and addTasks, on an event loop the slow part is left to the worker
+            threads and the task is turned away if they're too far behind
         """
         # TODO -- should probably put in some validation to verify the video 'name' already exists in homedir
         logging.info('Adding video {0}'.format(name))
-        if self.maxTasks:
-            if len(self.pending) >= self.maxTasks:
+        with self.lock:
+            if self.maxTasks:
+                if self.store.count('pending') + len(self.preparing) >= self.maxTasks:
+                    return False
+            if not self.uniqueNameCheck(name):
                 return False
-        if not self.uniqueNameCheck(name):
-            return False
-        # Clear any identical task names from the inactive buckets, inactive tasks are second-class citizens
-        # so we simply erase them without warning
-        self.clearTask(name)
+            # Clear any identical inactive task, inactive tasks are second-class citizens so we simply
+            # erase them without warning
+            self.clearTask(name)
+            self.preparing.add(name)
         task = self.createTask(name,encoder,format,large,quality)
-        self.pending[task.getName()] = task
+        task.setPriority(priority)
+        task.setDigest(digest)
+        if not self.loop:
+            self.prepareTask(task,segmented)
+        elif not self.loop.pool.submit(self.prepareTask,task,segmented):
+            logging.warning('Turning {0} away, {1} tasks are waiting to be looked over'.format(name,self.loop.pool.backlog()))
+            with self.lock:
+                self.preparing.discard(name)
+            return False
         return True
-        
-    def getTask(self,name):
-        """ External call point for getting a new task, used by remote encoders
-            Tasks are selected based on the time they were added, FIFO
-        """
+
+    def prepareTask(self,task,segmented):
+        """ The slow part of adding a task, probing (and maybe hashing) the video, then queueing it """
+        name = task.getName()
         try:
-            task = sorted(self.pending.values(),key=lambda x: x.getAdded())[0]
-            print 'getTask',name
-            self.pending[task.getName()] = None
-            del self.pending[task.getName()]
-            self.encoding[task.getName()] = (task,name)
+            if self.serveCached(task):
+                return
+            task.setCost(self.estimateCost(name))
+            if self.storage.exists(name):
+                task.setSize(os.path.getsize(self.storage.path(name)))
+            if segmented:
+                points = splitPoints(os.path.join(self.homeDir,name))
+                if points and self.splitTask(task,points):
+                    return
+                # Too short or we couldn't probe or cut it, just encode it in one go
+                logging.info('Not splitting {0}'.format(name))
+            self.queueTask(task)
+        finally:
+            with self.lock:
+                self.preparing.discard(name)
+        self.preemptFor(task)
+        if self.loop:
+            self.trackBatch()
+
+    def estimateCost(self,name):
+        """ How much work encoding a video will be, its length in seconds, or its size in megabytes if
+            ffprobe can't tell us
+        """
+        path = self.storage.path(name)
+        duration = probeDuration(path)
+        if duration:
+            return duration
+        if os.path.exists(path):
+            return os.path.getsize(path) / 1e6
+        return None
+
+    def encoderSpeed(self,name):
+        """ How much work an encoder gets through a second, encoders we don't know about yet are
+            assumed to be average
+        """
+        if name in self.speeds:
+            return self.speeds[name]
+        if self.speeds:
+            return sum(self.speeds.values()) / len(self.speeds)
+        return 1.0
+
+    def learnSpeed(self,task,name):
+        """ Fold how long a finished task took into its encoder's speed """
+        if not task.getCost() or not task.getStarted() or not task.getFinished():
+            return
+        seconds = task.duration()
+        if seconds <= 0:
+            return
+        speed = task.getCost() / seconds
+        if name in self.speeds:
+            speed = speed_smoothing * speed + (1 - speed_smoothing) * self.speeds[name]
+        self.speeds[name] = speed
+
+    def reportCalibration(self,name,results):
+        """ External call point, an encoder's timings of its calibration encodes (a list of dicts with
+            the encoder, quality, fps and speed). An encoder which hasn't finished any real work yet is
+            scheduled on its calibrated speed, one that has gets its learned speed scaled by however
+            much its calibration has changed. Encoders which have slowed down a lot get flagged
+        """
+        with self.lock:
+            previous = dict(((result['encoder'],result['quality']),result) for result in self.calibrations.get(name,[]))
+            ratios = []
+            for result in results:
+                last = previous.get((result['encoder'],result['quality']))
+                if not last:
+                    continue
+                ratio = result['speed'] / last['speed']
+                ratios.append(ratio)
+                result['throttled'] = ratio < 1 - calibration_drop
+                if result['throttled']:
+                    logging.warning('{0} encoded {1} at q{2} {3:.0f}% slower than its last calibration, it may be throttling'.format(
+                        name,result['encoder'],result['quality'],(1 - ratio) * 100))
+            self.calibrations[name] = results
+            if not results:
+                return
+            if name not in self.speeds:
+                self.speeds[name] = sum(result['speed'] for result in results) / len(results)
+            elif ratios:
+                self.speeds[name] *= sum(ratios) / len(ratios)
+
+    def encodersAround(self):
+        """ Encoder name -> how many tasks it's on, for every encoder which is working or recently
+            asked for work. Call with the lock held
+        """
+        now = time.time()
+        around = dict((name,0) for name in self.waiting)
+        around.update((name,0) for name,when in self.idle.items() if now - when < idle_window)
+        for task,name in self.store.entries('encoding') + self.store.entries('reserved'):
+            around[name] = around.get(name,0) + 1
+        for name in self.duplicates.values():
+            around[name] = around.get(name,0) + 1
+        return around
+
+    def speedRank(self,name):
+        """ Where encoder name sits among the encoders which are around, 0 for the fastest up to 1 for
+            the slowest
+        """
+        if self.queue.mode != 'lpt':
+            return 0.0
+        around = set(self.encodersAround())
+        around.add(name)
+        if len(around) < 2:
+            return 0.0
+        speeds = sorted((self.encoderSpeed(encoder) for encoder in around),reverse=True)
+        return speeds.index(self.encoderSpeed(name)) / float(len(speeds) - 1)
+
+    def stragglers(self,around):
+        """ Encoding tasks (and the encoder on each) going at less than straggler_ratio of the farm's median
+            speed, slowest first. Speeds are in task cost a second, the running tasks' going by how far
+            they've got over the last eta_window seconds and idle encoders' by what they've learned.
+            Tasks which haven't been going for straggler_grace seconds or already have a duplicate are
+            left alone
+        """
+        now = time.time()
+        speeds = []
+        candidates = []
+        for task,name in self.store.entries('encoding'):
+            rate = self.history.rate(task.getName())
+            if rate is None or not task.getCost():
+                continue
+            speed = task.getCost() * rate / 100
+            speeds.append(speed)
+            if task.getName() not in self.duplicates and now - (task.getStarted() or now) >= straggler_grace:
+                candidates.append((speed,task,name))
+        speeds.extend(self.speeds[name] for name,count in around.items() if not count and name in self.speeds)
+        if not candidates:
+            return []
+        median = sorted(speeds)[len(speeds) // 2]
+        return [(task,name) for speed,task,name in sorted(candidates,key=lambda x: x[0])
+                if speed < straggler_ratio * median]
+
+    def speculate(self,name):
+        """ Once the queue is empty, pick a straggler for idle encoder name to run a duplicate of, one it
+            should get all the way through before the straggler's encoder gets to the end. Returns the
+            task, or None if there's nothing worth doing twice
+        """
+        if not self.straggling or len(self.duplicates) >= speculative_limit or len(self.queue):
+            return None
+        if self.encodersAround().get(name):
+            # Only encoders with nothing else on
+            return None
+        for task,slow in self.straggling:
+            if task.getName() in self.duplicates or self.store.state(task.getName()) != 'encoding' or \
+               self.store.encoder(task.getName()) != slow:
+                # Finished, handed back or already duplicated since we last looked
+                continue
+            eta = self.history.eta(task.getName())
+            if eta is not None and task.getCost() / self.encoderSpeed(name) >= eta:
+                continue
+            logging.info('{0} is straggling on {1}, running a duplicate on {2}'.format(task.getName(),slow,name))
+            self.duplicates[task.getName()] = name
+            self.duplicateLeases.grant(task.getName())
+            speculations.inc(result='started')
             return task
-        except IndexError:
+        return None
+
+    def dropDuplicate(self,taskName):
+        """ Forget about a task's duplicate, returns the encoder running it (None if there isn't one) """
+        self.duplicateLeases.release(taskName)
+        return self.duplicates.pop(taskName,None)
+
+    def promoteDuplicate(self,taskName):
+        """ A straggler's original copy is gone (failed, its encoder went quiet), the duplicate carries on
+            as the only one
+        """
+        encoder = self.dropDuplicate(taskName)
+        self.store.move(taskName,'encoding',encoder)
+        self.leases.renew(taskName)
+        self.history.forget(taskName)
+        self.markChanged(taskName)
+        return encoder
+
+    def cancelDuplicate(self,taskName,encoder):
+        """ Tell encoder to stop on the copy of a task it no longer needs to finish. If the call doesn't get
+            through the encoder still drops it the next time it reports its progress
+        """
+        try:
+            self.encoders.call(encoder,'cancel',taskName)
+        except Exception:
+            logging.exception('Unable to cancel {0} on {1}'.format(taskName,encoder))
+
+    def predictDrain(self):
+        """ Seconds until everything queued or running should be done going by the encoders' learned
+            speeds, None if we haven't learned any yet or there's no one around to do the work. Call with
+            the lock held
+        """
+        if not self.speeds:
+            return None
+        remaining = sum(task.getCost() or 0 for task,_ in self.store.entries('pending'))
+        for task,name in self.store.entries('encoding') + self.store.entries('reserved'):
+            remaining += (task.getCost() or 0) * (1 - float(task.getCompleted() or 0) / 100)
+        # Idle encoders count for one job's worth
+        capacity = sum(self.encoderSpeed(name) * max(count,1) for name,count in self.encodersAround().items())
+        if not capacity:
+            return None
+        return remaining / capacity
+
+    def remainingTime(self,task,name):
+        """ Seconds of work left on a task for encoder name going by its learned speed, None if we
+            don't know how big the task is
+        """
+        if not task.getCost():
             return None
+        try:
+            completed = float(task.getCompleted() or 0)
+        except ValueError:
+            completed = 0.0
+        return task.getCost() * (1 - completed / 100) / self.encoderSpeed(name)
+
+    def getForecast(self):
+        """ External call point, seconds until each unfinished task should be done and until the whole
+            queue is (None where there's nothing to go on), plus how far out the ETAs of recently
+            finished tasks were (see ProgressHistory.getErrors).
+
+            Running tasks go by how they've been getting on. Queued tasks are handed out in queue order
+            to whichever encoder will be free first, and take as long as that encoder's learned speed says
+        """
+        with self.lock:
+            etas = {}
+            # Encoder name -> seconds until each of the tasks it's on is done, idle encoders are free now
+            slots = dict((name,[]) for name in self.encodersAround())
+            for task,name in self.store.entries('encoding'):
+                eta = self.history.eta(task.getName())
+                if eta is None:
+                    eta = self.remainingTime(task,name)
+                etas[task.getName()] = eta
+                heapq.heappush(slots.setdefault(name,[]),eta or 0.0)
+            # Reserved tasks are still downloading, they start once one of their encoder's encodes is done
+            for task,name in self.store.entries('reserved'):
+                mine = slots.setdefault(name,[])
+                start = mine[0] if mine else 0.0
+                eta = self.remainingTime(task,name)
+                etas[task.getName()] = None if eta is None else start + eta
+                if mine:
+                    heapq.heapreplace(mine,start + (eta or 0.0))
+                else:
+                    heapq.heappush(mine,eta or 0.0)
+            free = [(when,name) for name,whens in slots.items() for when in whens or [0.0]]
+            heapq.heapify(free)
+            pending = [self.store.task(name) for name in self.queue.ordered()]
+            # Videos ffprobe couldn't size are taken to be average
+            costs = [task.getCost() for task in pending if task.getCost()]
+            average = sum(costs) / len(costs) if costs else 0.0
+            for task in pending:
+                if not free or not self.speeds:
+                    etas[task.getName()] = None
+                    continue
+                when,name = heapq.heappop(free)
+                when += (task.getCost() or average) / self.encoderSpeed(name)
+                etas[task.getName()] = when
+                heapq.heappush(free,(when,name))
+            # A split video is done when its last segment is
+            for parent,_ in self.store.entries('segmented'):
+                name = parent.getName()
+                segments = [etas[segment] for segment in parent.getSegments() if segment in etas]
+                etas[name] = None if None in segments else max(segments or [0.0])
+            drain = 0.0
+            if etas:
+                drain = None if None in etas.values() else max(etas.values())
+            return {'tasks':etas,'drain':drain,'errors':self.history.getErrors()}
+
+    def trackBatch(self):
+        """ Called as tasks are added, starts a new batch if the queue was empty and updates the
+            prediction of when the queue will be empty again
+        """
+        # The encoders' calls change the batch and everything the prediction looks at as we go
+        with self.lock:
+            now = time.time()
+            if not self.batch:
+                self.batch = {'mode':self.queue.mode,'started':now,'predicted':None,'finished':None}
+            drain = self.predictDrain()
+            if drain is not None:
+                self.batch['predicted'] = now + drain
+
+    def checkBatch(self):
+        """ Close off the current batch once everything in it is done """
+        if not self.batch:
+            return
+        if self.batch['predicted'] is None:
+            # We didn't know enough to guess when it was added, have another go now
+            drain = self.predictDrain()
+            if drain is not None:
+                self.batch['predicted'] = time.time() + drain
+        if self.store.count('pending','encoding','reserved','segmented','joining'):
+            return
+        self.batch['finished'] = time.time()
+        batch = self.batch
+        self.batches.append(batch)
+        self.batch = None
+        predicted = 'unknown'
+        if batch['predicted']:
+            predicted = '{0:.0f}s'.format(batch['predicted'] - batch['started'])
+        logging.info('Queue emptied in {0:.0f}s, predicted {1} ({2})'.format(batch['finished'] - batch['started'],predicted,batch['mode']))
+
+    def setScheduleMode(self,mode):
+        """ External call point for switching between 'fifo' and 'lpt' scheduling, see schedule_mode """
+        if mode not in ('fifo','lpt'):
+            return False
+        with self.lock:
+            self.queue.setMode(mode)
+        return True
+
+    def getScheduleReport(self):
+        """ External call point, the scheduling mode, the encoders' learned speeds and calibrations, how long the queue
+            should take to empty now, predicted vs actual times (in seconds) for the last few batches and which
+            encoders are running duplicates of which tasks
+        """
+        with self.lock:
+            batches = []
+            for batch in list(self.batches) + ([self.batch] if self.batch else []):
+                predicted = actual = None
+                if batch['predicted']:
+                    predicted = batch['predicted'] - batch['started']
+                if batch['finished']:
+                    actual = batch['finished'] - batch['started']
+                batches.append({'mode':batch['mode'],'started':batch['started'],'predicted':predicted,'actual':actual})
+            return {'mode':self.queue.mode,'speeds':dict(self.speeds),'calibrations':dict(self.calibrations),
+                    'drain':self.predictDrain(),'batches':batches,'duplicates':dict(self.duplicates)}
+
+    def getPhaseReport(self):
+        """ External call point, where the time goes for finished tasks. Totals the seconds spent in each
+            phase (see encoder_cfg.phases) over every finished task, by encoder and by source size, each
+            with the share of the time that phase took. Split videos show up under the encoder
+            'segmented', only their joining (finalize) time is theirs, the rest is down to their segments
+        """
+        finished = self.store.entries('finished')
+        report = {'total':PhaseTotals(),'byEncoder':{},'bySize':{}}
+        for task,name in finished:
+            durations = task.phaseDurations()
+            if not durations:
+                continue
+            report['total'].add(durations)
+            report['byEncoder'].setdefault(name,PhaseTotals()).add(durations)
+            report['bySize'].setdefault(sizeBucket(task.getSize()),PhaseTotals()).add(durations)
+        report['total'] = report['total'].summary()
+        for group in ['byEncoder','bySize']:
+            report[group] = dict((key,totals.summary()) for key,totals in report[group].items())
+        return report
+
+    def serveCached(self,task):
+        """ If we've encoded this video with these settings before and still have the output, skip
+            straight to finished. Hashes the video if the UI didn't do it for us
+        """
+        if not self.cache.enabled():
+            return False
+        name = task.getName()
+        if not task.getDigest() and self.storage.exists(name):
+            task.setDigest(hashFile(self.storage.path(name),hashlib.sha1()).hexdigest())
+        output = re.sub('\.\w*$','.{0}'.format(task.getFormat()),name)
+        if not self.cache.fetch(task,self.storage.path(output)):
+            return False
+        logging.info('Serving {0} from the cache'.format(name))
+        task.setOutputName(output)
+        task.taskStarted()
+        task.taskFinished()
+        task.setCompleted(100)
+        self.store.add(task,'finished','cache')
+        self.markChanged(name)
+        if output != task.getSource():
+            self.storage.remove(task.getSource())
+        return True
+
+    def getCacheStats(self):
+        """ External call point, how the result cache is doing """
+        return self.cache.getStats()
+
+    def splitTask(self,task,points):
+        """ Create a pending task for each segment of a split video, False if it couldn't be split """
+        name = task.getName()
+        base,ext = os.path.splitext(name)
+        segments = ['{0}.part{1:03d}{2}'.format(base,i,ext) for i in range(len(points))]
+        # Anything left over from splitting a video of the same name before, pieces and all
+        for segment in segments:
+            self.clearTask(segment)
+        sources = self.segmentSources(task,points)
+        if sources is None:
+            return False
+        for segment,(start,stop),(source,startAt,stopAt,digest) in zip(segments,points,sources):
+            segment = Task(segment,task.getEncoder(),task.getFormat(),task.getLarge(),task.getQuality(),
+                           source=source,startAt=startAt,stopAt=stopAt,parent=name,priority=task.getPriority(),
+                           digest=digest)
+            if task.getCost():
+                segment.setCost((stop or task.getCost()) - start)
+            segment.setSize(os.path.getsize(self.storage.path(source)) if source != name else task.getSize())
+            self.queueTask(segment)
+        task.setSegments(segments)
+        task.setOutputName(self.joinedName(task))
+        self.store.add(task,'segmented')
+        self.markChanged(name)
+        logging.info('Split {0} into {1} segments'.format(name,len(segments)))
+        return True
+
+    def segmentSources(self,task,points):
+        """ (source,startAt,stopAt,digest) for each segment of a split video. Over FTP each segment gets
+            its own piece cut out of the source so its encoder only downloads the part it encodes, with
+            shared storage they all read their part of the one source. None if the pieces couldn't be cut
+        """
+        name = task.getName()
+        if storage_mode != 'ftp':
+            return [(name,start,stop,task.getDigest()) for start,stop in points]
+        base,ext = os.path.splitext(name)
+        pieces = []
+        for i,(start,stop) in enumerate(points):
+            piece = '{0}.part{1:03d}.src{2}'.format(base,i,ext)
+            pieces.append(piece)
+            if not cutSegment(self.storage.path(name),start,stop,self.storage.path(piece)):
+                logging.warning('Unable to cut {0} out of {1}'.format(piece,name))
+                for piece in pieces:
+                    self.storage.remove(piece)
+                return None
+        # The encoders check what they download against the digest, if the source had one
+        return [(piece,None,None,hashFile(self.storage.path(piece),hashlib.sha1()).hexdigest() if task.getDigest() else None)
+                for piece in pieces]
+
+    def removePiece(self,task):
+        """ Delete the piece of the source a segment was given, once nothing needs it """
+        if task.isSegment() and task.getSource() != task.getParent():
+            self.storage.remove(task.getSource())
+
+    def joinedName(self,task):
+        """ What a split video's segments get joined into """
+        return re.sub('\.\w*$','.{0}'.format(task.getFormat()),task.getName())
+
+    def segmentDone(self,name):
+        """ Called whenever one of a split video's segments stops being active. Once none of them
+            are left running we either join the pieces into the final video or fail the whole thing
+        """
+        with self.lock:
+            if self.store.state(name) != 'segmented':
+                return
+            task = self.store.task(name)
+            segments = task.getSegments()
+            for segment in segments:
+                if self.isActive(segment):
+                    return
+            if not all(self.store.state(segment) == 'finished' for segment in segments):
+                task.setErrors('One or more segments failed')
+                self.store.move(name,'error')
+                self.markChanged(name)
+                return
+            # Whoever moves it to joining gets to join it, it stays in the store so nothing else can take
+            # its name while the join runs
+            self.store.move(name,'joining')
+            self.markChanged(name)
+            task.mark('finishing')
+            parts = [self.store.task(segment).getOutputName() for segment in segments]
+        joined = False
+        try:
+            joined = joinSegments([os.path.join(self.homeDir,part) for part in parts],os.path.join(self.homeDir,task.getOutputName()))
+            if joined:
+                with self.lock:
+                    for segment in segments:
+                        self.store.remove(segment)
+                        self.markRemoved(segment)
+                    task.taskFinished()
+                    task.setCompleted(100)
+                    self.store.move(name,'finished','segmented',expect='joining')
+                    self.markChanged(name)
+        finally:
+            if not joined:
+                # Whatever went wrong it has to come out of joining, or it could never be retried
+                with self.lock:
+                    task.setErrors('Unable to join segments')
+                    self.store.move(name,'error',expect='joining')
+                    self.markChanged(name)
+        for part in parts:
+            os.unlink(os.path.join(self.homeDir,part))
+        self.finalizeTask(task)
+
+    def getTask(self,name,timeout=0):
+        """ External call point for getting a new task, used by remote encoders
+            Tasks are selected by priority, then by the time they were added, see TaskQueue
+            If there's nothing to do the call waits up to timeout seconds for a task to be queued
+        """
+        return self.takeTask(name,timeout,'encoding')
+
+    def reserveTask(self,name,timeout=0):
+        """ External call point for encoders which download their next task while they're still busy,
+            works like getTask but the task is only reserved until the encoder calls startTask
+        """
+        return self.takeTask(name,timeout,'reserved')
+
+    def startTask(self,name,taskName):
+        """ External call point for encoders to say they've started encoding a task they reserved, returns
+            False if the task isn't reserved for them any more (cancelled or reclaimed)
+        """
+        with self.lock:
+            if self.duplicates.get(taskName) == name:
+                self.duplicateLeases.renew(taskName)
+                return True
+            if self.store.encoder(taskName) != name:
+                return False
+            # A duplicate which took over from the original before it got started is encoding already
+            if self.store.state(taskName) != 'encoding' and not self.store.move(taskName,'encoding',name,expect='reserved'):
+                return False
+            self.leases.renew(taskName)
+        self.markChanged(taskName)
+        return True
+
+    def takeTask(self,name,timeout,state):
+        """ Pop the next task off the queue and move it to state (encoding or reserved) against encoder name """
+        if self.loop:
+            # Nothing else would get done while we waited
+            timeout = 0
+        deadline = time.time() + timeout
+        with self.taskReady:
+            rank = self.speedRank(name)
+            taskName = self.queue.pop(rank)
+            while taskName is None:
+                duplicate = self.speculate(name)
+                if duplicate:
+                    self.idle.pop(name,None)
+                    return duplicate
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.idle[name] = time.time()
+                    return None
+                self.waiting.add(name)
+                try:
+                    self.taskReady.wait(remaining)
+                finally:
+                    self.waiting.discard(name)
+                taskName = self.queue.pop(rank)
+            self.idle.pop(name,None)
+            print 'getTask',name
+            task = self.store.move(taskName,state,name,expect='pending')
+            task.mark('assigned')
+            self.leases.grant(task.getName())
+        self.markChanged(task.getName())
+        return task
     
     def _checkTasks(self):
-        logging.info('Checking tasks...')
-        for task,name in self.encoding.values():
-            try:
-                encoder = Pyro4.Proxy('PYRONAME:{0}@{1}:{2}'.format(name,pyro_host,pyro_port))
-                # If the encoder is not running but we think the task is active, then odds may be
-                # that the encoder has been reset, we should probably reset the task to pending
-                if encoder.getStatus() != RUNNING:
-                    self.pending.put(task)
-                    self.encoding[task.getName()] = None
-                    del self.encoding[task.getName()]
-            except:
-                # If we get an exception it probably means the encoder is down, so we should
-                # reset the task to pending
-                # TODO -- Pin down the correct exception to catch, general except is ugly / hackish
-                task.reset()
-                self.pending[task.getName()]=task
-                self.encoding[task.getName()]=None
-                del self.encoding[task.getName()]
+        """ Put any task whose encoder has stopped reporting on it back in the queue, the encoder has
+            either died or lost track of it. Nothing here talks to the encoders so a hung one can't
+            hold anything up. Also notices when the queue has been emptied
+        """
+        with self.lock:
+            for taskName in self.duplicateLeases.expired():
+                encoder = self.duplicates.pop(taskName,None)
+                if encoder:
+                    logging.info('Dropping the duplicate of {0}, {1} has gone quiet'.format(taskName,encoder))
+                    speculations.inc(result='failed')
+            for taskName in self.leases.expired():
+                entry = self.store.get(taskName)
+                if entry and entry[0] in ('encoding','reserved'):
+                    bucket,task,name = entry
+                    logging.info('Lease on {0} expired, {1} has gone quiet'.format(taskName,name))
+                    taskFailures.inc(reason='lease')
+                    if taskName in self.duplicates:
+                        self.promoteDuplicate(taskName)
+                        continue
+                    task.reset()
+                    self.queueTask(task)
+            self.history.prune(self.store.names('encoding'))
+            self.checkBatch()
+            # Worked out once a second rather than every time an idle encoder asks for work
+            self.straggling = []
+            if speculative_limit and len(self.duplicates) < speculative_limit and not len(self.queue):
+                self.straggling = self.stragglers(self.encodersAround())
+                if self.straggling and self.waiting:
+                    # Encoders waiting on the empty queue might be able to take one on
+                    self.taskReady.notifyAll()
 
         # Reschedule the timer since they only execute once
-        self.timer = Timer(60,self._checkTasks)
-        self.timer.start()
+        self.schedule(1,self._checkTasks)
         
+    def reportProgress(self,name,progress):
+        """
+            External call point for encoders to tell the server how their tasks are coming along, progress is
+            a list of (task name,percent completed,fps,eta in seconds) tuples, one for every task the encoder is
+            working on. Only the progress fields of our own copy of the task get touched.
+
+            Returns the names of any reported tasks which aren't assigned to that encoder any more (cancelled,
+            preempted, given to someone else) so the encoder can drop them
+        """
+        lost = []
+        with self.lock:
+            for taskName,completed,fps,eta in progress:
+                if self.duplicates.get(taskName) == name:
+                    # Our copy of the task follows the original, the duplicate just needs to stay alive
+                    self.duplicateLeases.renew(taskName)
+                    continue
+                entry = self.store.get(taskName)
+                if not entry or entry[0] not in ('encoding','reserved') or entry[2] != name:
+                    lost.append(taskName)
+                    continue
+                bucket,task,_ = entry
+                self.leases.renew(taskName)
+                if bucket == 'reserved':
+                    # Still downloading, nothing to update yet
+                    continue
+                # Handbrake's ETA swings about, the one everyone else sees is smoothed out
+                eta = self.history.record(taskName,completed,eta)
+                if not task.getStarted():
+                    task.taskStarted()
+                task.setProgress(completed,fps,task.getAvgFps(),eta)
+                self.markChanged(taskName)
+                if task.isSegment():
+                    self.markChanged(task.getParent())
+        return lost
+
     def updateTask(self,taskIn):
         """
             External call point to update a given task, used by encoders to provide update views of tasks to the
             server -- i.e. what percent completed the tasks is in HB
+
+            Superseded by reportProgress, only kept around for encoders which haven't been upgraded yet
         """
-        task,name = self.encoding[taskIn.getName()]
-        try:
-            self.encoding[taskIn.getName()] = (taskIn,name)
+        with self.lock:
+            entry = self.store.get(taskIn.getName())
+            if not entry or entry[0] != 'encoding':
+                return False
+            self.store.add(taskIn,'encoding',entry[2])
+            self.leases.renew(taskIn.getName())
+            self.history.record(taskIn.getName(),taskIn.getCompleted(),taskIn.getEta())
+            self.markChanged(taskIn.getName())
+            if taskIn.isSegment():
+                self.markChanged(taskIn.getParent())
             return True
-        except KeyError:
-            return False
     
-    def finishTask(self,taskIn):
+    def finishTask(self,taskIn,encoder=None):
         """
             External call point to let the server know that a task has been completed, if the video
             doesn't exist in homedir, then we assume that this finish call was actually an error,
             depending on the situation move the task to the correct inactive bucket
 
+            encoder is the one finishing it, older encoders don't say and are taken to be the one the task
+            was given to. If a straggler has a duplicate running the first copy to succeed wins and the other
+            is cancelled, a copy which fails just leaves the other one to carry on. Encoders upload under a
+            staging name of their own, only the winner's output is moved into place and anything uploaded
+            for a task which isn't that encoder's to finish any more is thrown away
+
             Deletes the original video for cleanup if we were successful
         """
-        task,name = self.encoding[taskIn.getName()]
-        task = taskIn
-        if os.path.exists(os.path.join(self.homeDir,task.getOutputName())):
-            self.finished[task.getName()] = (taskIn,name)
-            self.encoding[task.getName()] = None
-            del self.encoding[task.getName()]
-            os.unlink(os.path.join(self.homeDir,task.getName()))
+        loser = None
+        with self.lock:
+            # A reserved task is one the encoder gave up on before it got started, i.e. the download failed
+            entry = self.store.get(taskIn.getName())
+            if not entry or entry[0] not in ('encoding','reserved'):
+                # Cancelled or requeued while it was being finished, or the other copy of a duplicated
+                # task got there first
+                self.discardStaged(taskIn)
+                return False
+            bucket,task,name = entry
+            duplicate = self.duplicates.get(task.getName())
+            encoder = encoder or name
+            if encoder not in (name,duplicate):
+                # A duplicate we've stopped waiting on
+                self.discardStaged(taskIn)
+                return False
+            if duplicate:
+                if not self.delivered(taskIn):
+                    logging.info('{0} failed on {1}, leaving it to {2}'.format(task.getName(),encoder,
+                                                                               duplicate if encoder == name else name))
+                    self.discardStaged(taskIn)
+                    if encoder == name:
+                        self.promoteDuplicate(task.getName())
+                    else:
+                        self.dropDuplicate(task.getName())
+                    speculations.inc(result='failed')
+                    return False
+                self.dropDuplicate(task.getName())
+                loser = duplicate if encoder == name else name
+                speculations.inc(result='won' if encoder == duplicate else 'lost')
+                name = encoder
+            self.leases.release(task.getName())
+            # Our copy is the one that counts, just take the results the encoder knows about
+            task.copyResults(taskIn)
+            task.mark('finishing')
+            # Moved into place while we hold the lock, so it's only ever the one copy
+            succeeded = self.delivered(task) and self.placeOutput(task)
+            self.store.move(task.getName(),'finished' if succeeded else 'error',name)
+            self.markChanged(task.getName())
+            if succeeded:
+                self.learnSpeed(task,name)
+                self.history.finish(task.getName(),name)
+            else:
+                taskFailures.inc(reason='encode')
+        if succeeded:
+            self.offload(self.finalizeTask,task)
+            if task.isSegment():
+                self.offload(self.segmentDone,task.getParent())
+            if loser:
+                self.offload(self.cancelDuplicate,task.getName(),loser)
             return True
         else:
-            self.error[task.getName()] = (taskIn,name)
-            self.encoding[task.getName()] = None
-            del self.encoding[task.getName()]
+            self.discardOutput(task)
+            if task.isSegment():
+                self.segmentDone(task.getParent())
             return False
         
+    def delivered(self,task):
+        """ Did the encoder get a task's output to us, anything it says went wrong (i.e. an upload which gave
+            up part way) counts whatever made it into the master dir
+        """
+        if task.getErrors() or not task.getOutputName():
+            return False
+        return self.storage.exists(task.getStaged() or task.getOutputName())
+
+    def placeOutput(self,task):
+        """ Move a finished task's output into place from where its encoder staged it """
+        if not task.getStaged():
+            # An older encoder which uploaded it straight into place
+            return True
+        try:
+            self.storage.place(task.getStaged(),task.getOutputName())
+        except OSError:
+            logging.exception('Unable to move {0} into place'.format(task.getOutputName()))
+            return False
+        task.setStaged(None)
+        return True
+
+    def discardStaged(self,task):
+        """ Throw away an output uploaded for a task that's no longer that encoder's to finish """
+        if task.getStaged():
+            self.storage.remove(task.getStaged())
+
+    def discardOutput(self,task):
+        """ Throw away whatever part of its output a failed task left in the master dir, so it can't be
+            taken for a finished one later on
+        """
+        output = task.getOutputName()
+        if task.getStaged():
+            self.storage.remove(task.getStaged())
+        elif output and output != task.getSource():
+            self.storage.remove(output)
+
+    def finalizeTask(self,task):
+        """ Keep a finished task's output in the cache and clean up its source. The mark goes in the journal
+            so it isn't done again after a restart
+        """
+        if task.isSegment():
+            # The other segments still need the source, it's cleaned up once they're joined
+            self.removePiece(task)
+        else:
+            self.cache.store(task,self.storage.path(task.getOutputName()))
+            if task.getSource() != task.getOutputName():
+                self.storage.remove(task.getSource())
+        with self.lock:
+            task.mark('finalized')
+            if self.store.task(task.getName()) is task:
+                self.markChanged(task.getName())
+
 def startNameServer(host,port):
     """
         Start Pyro naming server for the server and encoders to register and look up with
@@ -224,29 +1561,44 @@ def startNameServer(host,port):
     print host,port
     Pyro4.naming.startNSloop(host, port)
     
-def startFTPServer():
+def createFTPServer(report=None):
     """
-        Starts an FTP server so that the encoders, ui, and server can swap files back and forth
+        The FTP server the encoders, ui, and server swap files back and forth through, report is called
+        with each finished transfer for the central server's metrics
     """
     homeDir = os.path.join(os.path.expanduser("~"),'master')
     if not os.path.exists(homeDir):
-        os.makedirs(self.homeDir)
+        os.makedirs(homeDir)
     print homeDir
     auth = ftpserver.DummyAuthorizer()
     auth.add_user(ftp_user,ftp_pass,homeDir,perm='elrwda')
-    
-    handler = ftpserver.FTPHandler
+
+    handler = MeteredFTPHandler
     handler.authorizer = auth
+    handler.report = report
     address = ("0.0.0.0",ftp_port)
-    ftpd = ftpserver.FTPServer(address,handler)
+    return ftpserver.FTPServer(address,handler)
+
+def startFTPServer(transfers=None):
+    """
+        Starts an FTP server so that the encoders, ui, and server can swap files back and forth,
+        finished transfers are put on transfers (a queue) for the central server's metrics
+    """
+    ftpd = createFTPServer(transfers.put if transfers is not None else None)
     ftpd.serve_forever()
     
-def startCentralEncoder():
+def startCentralEncoder(transfers=None):
     """
         Start the central server and register it with Pyro
     """
-    central = CentralEncoding()
-    daemon = Pyro4.Daemon(host=getLanIP())
+    central = CentralEncoding(transfers=transfers)
+    serveMetrics(metrics_port)
+    # Older Pyro4 releases size the pool with THREADPOOL_MAXTHREADS, newer ones with THREADPOOL_SIZE
+    if hasattr(Pyro4.config,'THREADPOOL_SIZE'):
+        Pyro4.config.THREADPOOL_SIZE = max(Pyro4.config.THREADPOOL_SIZE,pyro_threads)
+    elif hasattr(Pyro4.config,'THREADPOOL_MAXTHREADS'):
+        Pyro4.config.THREADPOOL_MAXTHREADS = max(Pyro4.config.THREADPOOL_MAXTHREADS,pyro_threads)
+    daemon = CountingDaemon(host=getLanIP())
     uri = daemon.register(central)
     tries = 0
     while(tries < max_tries):
@@ -263,14 +1615,48 @@ def startCentralEncoder():
     ns.register('central.encoding',uri)
     daemon.requestLoop()
     
+def startEventLoop():
+    """
+        Runs the name server, the FTP server, the central server and the metrics all on this thread
+        off one select loop, see server_mode
+    """
+    Pyro4.config.SERVERTYPE = 'multiplex'
+    loop = EventLoop(offload_threads,offload_queue)
+    nsUri,nsDaemon,broadcast = Pyro4.naming.startNS(pyro_host,pyro_port)
+    loop.addDaemon(nsDaemon)
+    if broadcast:
+        loop.addReader(broadcast,broadcast.processRequest)
+    central = CentralEncoding(loop=loop,nameserver=nsDaemon.nameserver)
+    if storage_mode == 'ftp':
+        # Nobody needs FTP when everyone's working off the shared master dir
+        ftpd = createFTPServer(central.countTransfer)
+        # A single pass over the FTP server's sockets (and its timers) every time round the loop
+        loop.addPoller(lambda: ftpd.serve_forever(timeout=0,count=1))
+    metrics = serveMetrics(metrics_port,thread=False)
+    if metrics:
+        loop.addReader(metrics,metrics.handle_request)
+    daemon = CountingDaemon(host=getLanIP())
+    # The name server is ours and can't answer until the loop's running, so go straight to it
+    nsDaemon.nameserver.register('central.encoding',daemon.register(central))
+    loop.addDaemon(daemon)
+    loop.run()
+
 def main():
+    if server_mode == 'loop':
+        startEventLoop()
+        return
     nameServer = multiprocessing.Process(target=startNameServer,name='Pyro-Naming',args=[pyro_host,pyro_port])
-    ftpServer = multiprocessing.Process(target=startFTPServer,name='FTP-Server')
-    central = threading.Thread(target=startCentralEncoder,name='Central')
     nameServer.daemon = True
-    ftpServer.daemon = True
     nameServer.start()
-    ftpServer.start()
+    # The FTP server hands its transfers to the central server for the metrics through here
+    transfers = None
+    if storage_mode == 'ftp':
+        # Nobody needs FTP when everyone's working off the shared master dir
+        transfers = multiprocessing.Queue()
+        ftpServer = multiprocessing.Process(target=startFTPServer,name='FTP-Server',args=[transfers])
+        ftpServer.daemon = True
+        ftpServer.start()
+    central = threading.Thread(target=startCentralEncoder,name='Central',args=[transfers])
     central.start()
     
 if __name__ == "__main__":
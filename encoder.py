@@ -5,29 +5,241 @@ import os
 import platform
 import re
 import logging
+import time
+import threading
+import collections
+import multiprocessing
+import shutil
+import Queue
 from threading import Timer
 import subprocess
-from encoder_cfg import pyro_host, pyro_port, ftp_host, ftp_port, ftp_user, ftp_pass
-from encoder_cfg import IDLE, RUNNING, Task, getLanIP
-from ftplib import FTP
+from encoder_cfg import pyro_host, pyro_port
+from encoder_cfg import IDLE, RUNNING, Task, getLanIP, dispatch_timeout
+from encoder_cfg import encoder_slots, cores_per_slot, max_load, slot_ramp_delay, prefetch_count
+from encoder_cfg import calibration_presets, calibration_interval, calibration_length, encoder_metrics_port
+from storage import getStorage
+from metrics import registry, serve as serveMetrics
 import socket
     
 handbrake_unix = '/usr/bin/HandBrakeCLI'
 handbrake_win32 = 'C:\\Program Files\\Handbrake\\HandBrakeCLI.exe'
 handbrake_win64 = 'C:\\Program Files (x86)\\Handbrake\\HandBrakeCLI.exe'
+ffmpeg = 'ffmpeg'
+
+# The calibration clip is ffmpeg's test pattern at this size and frame rate
+calibration_size = '1280x720'
+calibration_rate = 30
+
+# Handbrake's progress lines look like
+#   Encoding: task 1 of 1, 45.67 % (123.45 fps, avg 110.23 fps, ETA 00h05m12s)
+# the part in brackets only shows up once it's been going for a few seconds
+progress_regex = re.compile(r'(\d+\.\d+) %(?: \((\d+\.\d+) fps, avg (\d+\.\d+) fps, ETA (\d+)h(\d+)m(\d+)s\))?')
+
+encodes = registry.counter('handbrake_encoder_encodes_total','Encodes this encoder has finished, by how they went',['result'])
+
+def processCpu(pid):
+    """ CPU seconds a running process has used so far, None if we can't tell (no /proc) """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            # The command name is in brackets and can have spaces in it
+            fields = f.read().rsplit(')',1)[1].split()
+    except (IOError,OSError,IndexError):
+        return None
+    # utime and stime, the 14th and 15th fields counting the pid as the first
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+class ProgressReader(object):
+    """
+        Drains a handbrake process's stdout and stderr on a pair of long lived threads. Handbrake updates
+        its progress in place with \r's, so we read whatever is available in big chunks, split them on
+        \r/\n and only bother parsing the newest progress line in each chunk. stderr has to be read too,
+        otherwise handbrake blocks once the pipe fills up -- we hang on to the tail of it for error reports
+    """
+    def __init__(self,proc,task):
+        self.task = task
+        self.errors = collections.deque(maxlen=20)
+        self.threads = [threading.Thread(target=self.read,args=(proc.stdout,self.progress,True)),
+                        threading.Thread(target=self.read,args=(proc.stderr,self.errors.append,False))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def read(self,pipe,handleLine,latestOnly):
+        fd = pipe.fileno()
+        pending = ''
+        while True:
+            chunk = os.read(fd,65536)
+            if not chunk:
+                break
+            lines = re.split('[\r\n]',pending + chunk)
+            # Whatever is after the last separator is a partial line, hang on to it for next time
+            pending = lines.pop()
+            lines = [line for line in lines if line]
+            if latestOnly:
+                lines = lines[-1:]
+            for line in lines:
+                handleLine(line)
+        if pending:
+            handleLine(pending)
+        pipe.close()
+
+    def progress(self,line):
+        match = progress_regex.search(line)
+        if match:
+            completed,fps,avgFps,hours,minutes,seconds = match.groups()
+            eta = None
+            if hours is not None:
+                eta = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+            self.task.setProgress(float(completed),fps and float(fps),avgFps and float(avgFps),eta)
+
+    def join(self,timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def getErrors(self):
+        return '\n'.join(self.errors)
+
+class EncoderSlot(object):
+    """
+        A single handbrake job, the encoder runs one of these per slot so several
+        encodes can share a box that one encode can't keep busy
+    """
+    def __init__(self,encoder,index):
+        self.encoder = encoder
+        self.handbrake = encoder.handbrake
+        self.index = index
+
+        # Guards the slot's task/process since the central server can cancel us from a Pyro thread
+        self.lock = threading.RLock()
+
+        self.task = None
+
+        # Reference the external handbrake process and the reader parsing its output
+        self.encodeProc = None
+        self.reader = None
+
+    def isBusy(self):
+        return self.task is not None
+
+    def getTaskName(self):
+        task = self.task
+        if task:
+            return task.getName()
+        return None
+
+    def start(self,task):
+        """
+            Take on a new task whose video has already been downloaded and begin the encode process
+        """
+        with self.lock:
+            self.task = task
+            self.encodeVid()
+
+    def check(self):
+        """
+            Check up on the handbrake process, if it's done hand the video over to be uploaded, otherwise
+            return our progress so the encoder can pass it on to the central server
+        """
+        with self.lock:
+            if not self.task:
+                return None
+            if not self.encodeProc:
+                # Don't know why we think we're running -- probably a corner case here, but let's go back to IDLE
+                self.encoder.cleanUp(self.task)
+                self.release()
+                return None
+            if self.encodeProc.poll() is not None:
+                # Handbrake has exited, let the reader catch up on whatever it printed last
+                self.reader.join(5)
+                if self.encodeProc.returncode != 0:
+                    self.task.setErrors('Handbrake exited with {0}\n{1}'.format(self.encodeProc.returncode,self.reader.getErrors()))
+                    encodes.inc(result='error')
+                else:
+                    encodes.inc(result='ok')
+                self.task.taskFinished()
+                self.task.mark('encodeEnd')
+                self.task.setCompleted(100)
+                # The upload happens in the background, the slot is free for the next encode right away
+                self.encoder.upload(self.task)
+                self.release()
+                return None
+            # We're not done yet, but handbrake is running
+            return self.task.getProgress()
+
+    def release(self):
+        """
+            Free up the slot
+        """
+        self.reader = None
+        self.encodeProc = None
+        self.task = None
+
+    def cancel(self,name):
+        """
+            Kills the handbrake process and cleans up if we're working on the named task
+        """
+        with self.lock:
+            if self.task:
+                if self.task.getName() == name:
+                    if self.encodeProc:
+                        self.encodeProc.kill()
+                        self.encoder.cleanUp(self.task)
+                        self.release()
+                        return True
+        return False
+
+    def encodeVid(self):
+        """
+            Kick off the handbrake process with the various settings found in the task as arguements
+            Also starts the reader which will parse the handbrake output for completion percentages
+        """
+        self.task.setOutputName(re.sub('\.\w*$','.{0}'.format(self.task.getFormat()),self.task.getName()))
+        self.task.taskStarted()
+        self.task.mark('encodeStart')
+        args = [self.handbrake]
+        if self.task.getEncoder():
+            args.extend(['-e',self.task.getEncoder()])
+        if self.task.getFormat():
+            args.extend(['-f',self.task.getFormat()])
+        if self.task.getQuality():
+            args.extend(['-q',self.task.getQuality()])
+        if self.task.getLarge():
+            args.append('-4')
+        if self.task.getStartAt():
+            args.extend(['--start-at','duration:{0}'.format(self.task.getStartAt())])
+        if self.task.getStopAt():
+            # Handbrake counts the stop point from wherever it started, not from the start of the video
+            args.extend(['--stop-at','duration:{0}'.format(self.task.getStopAt() - (self.task.getStartAt() or 0))])
+        args.extend(['-i',self.encoder.sourcePath(self.task),'-o',self.encoder.outputPath(self.task)])
+        self.encodeProc = subprocess.Popen(args,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        self.reader = ProgressReader(self.encodeProc,self.task)
 
 class Encoder(object):
     """
-        Main encoder object
+        Main encoder object, works as a three stage pipeline so the box isn't sat idle waiting on the network
+            - The fetcher reserves tasks from the central server and downloads their videos ahead of time
+            - The slots run handbrake on downloaded videos
+            - The uploader sends finished videos back to the central server
     """
-    def __init__(self):
+    def __init__(self,homedir=None):
         # The dir which the encoder uses to store video filess it grabs from the central server
-        # and files which it generates via handbrake
+        # and files which it generates via handbrake, the user's home unless we're given one
         # TODO -- make this configurable
-        self.homedir = os.path.expanduser("~")
+        self.homedir = homedir or os.path.expanduser("~")
+
+        # The name used to register with Pyro Naming
+        # TODO -- Might want to use a better naming scheme, lazy linux users may not set hostnames
+        # on all their hosts, meaning we could have multiple encoder.localhost's stepping on eachother
+        self.name = 'encoder.{0}'.format(platform.node())
 
-        # Look up the central server
-        self.central = Pyro4.Proxy('PYRONAME:central.encoding@{0}:{1}'.format(pyro_host,pyro_port))
+        # How videos get to and from the central server, our outputs are staged under our name and pid
+        # so another encoder on the same box can't write over them
+        self.storage = getStorage('{0}.{1}'.format(self.getName(),os.getpid()))
+
+        # Look up the central server, this proxy is used from both the fetcher (via startReady) and the
+        # timer threads, centralLock makes them take turns with it
+        self.central = self.centralProxy()
+        self.centralLock = threading.Lock()
 
         # Determine the handbrake path
         # TODO -- This should probably be configurable too
@@ -39,179 +251,434 @@ class Encoder(object):
         elif os.path.exists(handbrake_win64):
             self.handbrake = handbrake_win64
 
-        self.status = IDLE
+        # How many encodes we can run at once, unless told otherwise give each one a few cores
+        self.cores = multiprocessing.cpu_count()
+        slots = encoder_slots or max(1,self.cores // cores_per_slot)
+        self.slots = [EncoderSlot(self,i) for i in xrange(slots)]
 
-        # The name used to register with Pyro Naming
-        # TODO -- Might want to use a better naming scheme, lazy linux users may not set hostnames
-        # on all their hosts, meaning we could have multiple encoder.localhost's stepping on eachother
-        self.name = 'encoder.{0}'.format(platform.node())
+        # When we last started an encode, the load average takes a while to catch up
+        self.lastStart = 0
 
-        # Reference the external handbrake process
-        self.encodeProc = None
+        # Guards the hand offs between the stages
+        self.lock = threading.RLock()
+
+        # Tasks reserved from the server which are downloading or downloaded and waiting for a slot
+        self.downloading = None
+        self.ready = collections.deque()
 
-        # This timer will check on the encoder's status every ten seconds
-        self.timer = Timer(10,self.checkForTask)
+        # Tasks whose video is being (or waiting to be) sent back to the central server
+        self.uploading = {}
+        self.uploads = Queue.Queue()
+
+        # Names of reserved tasks the central server cancelled while they were downloading
+        self.cancelled = set()
+
+        # Wakes the fetcher up when a slot frees up
+        self.wantWork = threading.Event()
+
+        # Set while the calibration encodes run, nothing else gets started so they have the box to themselves
+        self.calibrating = bool(calibration_presets)
+
+        self.fetcher = threading.Thread(target=self.fetchTasks,name='Fetcher')
+        self.fetcher.daemon = True
+        self.fetcher.start()
+        self.uploader = threading.Thread(target=self.uploadVideos,name='Uploader')
+        self.uploader.daemon = True
+        self.uploader.start()
+        if calibration_presets:
+            self.calibrator = threading.Thread(target=self.calibrateLoop,name='Calibrator')
+            self.calibrator.daemon = True
+            self.calibrator.start()
+
+        registry.gauge('handbrake_encoder_slots','Encode slots, by whether they\'re running an encode',['state'],self.slotCounts)
+        registry.gauge('handbrake_encoder_slot_utilization','Fraction of the encode slots running an encode',
+                       function=lambda: self.slotCounts()['busy'] / float(len(self.slots)))
+        registry.gauge('handbrake_encoder_cores','CPU cores on this box',function=lambda: self.cores)
+        registry.gauge('handbrake_encoder_fps','Frames per second over all the running encodes',function=self.totalFps)
+        registry.callbackCounter('handbrake_encoder_cpu_seconds_total','CPU seconds used by handbrake (and the calibration runs)',
+                                 function=self.cpuSeconds)
+
+        # This timer will check on the encoder's status every two seconds, the progress reports it
+        # sends are what tell the central server we're still alive
+        self.timer = Timer(2,self.checkForTask)
         self.timer.start()
     
     def getName(self):
         return self.name
-    
-    def getLine(self):
+
+    def slotCounts(self):
+        """ Used by the metrics, how many slots are busy and idle """
+        busy = len([slot for slot in self.slots if slot.isBusy()])
+        return {'busy':busy,'idle':len(self.slots) - busy}
+
+    def totalFps(self):
+        """ Used by the metrics, handbrake's fps summed over the running encodes """
+        fps = 0.0
+        for slot in self.slots:
+            task = slot.task
+            if task:
+                fps += task.getFps() or 0.0
+        return fps
+
+    def cpuSeconds(self):
+        """ Used by the metrics, CPU time of the handbrake processes which have finished plus what the
+            running ones have used so far
+        """
+        times = os.times()
+        total = times[2] + times[3]
+        for slot in self.slots:
+            proc = slot.encodeProc
+            if proc and proc.returncode is None:
+                total += processCpu(proc.pid) or 0.0
+        return total
+
+    def centralProxy(self):
+        """
+            Each stage talks to the central server from its own thread, so each gets its own proxy,
+            otherwise a progress report would be stuck behind the fetcher waiting on the server for work
+        """
+        return Pyro4.Proxy('PYRONAME:central.encoding@{0}:{1}'.format(pyro_host,pyro_port))
+
+    def workDir(self,task):
+        """
+            Every task gets its own dir for its source and output, so two segments of the same
+            video on the one box don't trip over each other's copy of the source
+        """
+        path = os.path.join(self.homedir,'encoding',task.getName())
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def sourcePath(self,task):
+        return self.storage.sourcePath(task.getSource(),self.workDir(task))
+
+    def outputPath(self,task):
+        return self.storage.outputPath(task.getOutputName(),self.workDir(task))
+
+    def cleanUp(self,task):
+        """
+            Delete the video files, we shouldn't need them by now
+        """
+        if task.getOutputName():
+            self.storage.discard(task.getOutputName(),self.workDir(task))
+        shutil.rmtree(os.path.join(self.homedir,'encoding',task.getName()),True)
+
+    def canTakeMore(self,busy):
+        """
+            Decide whether to start another encode alongside the ones already running. If the box
+            is already loaded (by us or by someone else) we hold off, so encodes that don't scale
+            across all the cores get company and shared workstations aren't swamped
+        """
+        if not busy:
+            return True
+        if time.time() - self.lastStart < slot_ramp_delay:
+            return False
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError,OSError):
+            # No load average on windows, just fill the slots
+            return True
+        return load < self.cores * max_load
+
+    def wanted(self):
+        """
+            How many more tasks the fetcher should reserve, enough to fill whichever slots we could
+            start right now plus prefetch_count more to download while the slots are busy
+        """
+        with self.lock:
+            if self.calibrating:
+                return 0
+            free = [slot for slot in self.slots if not slot.isBusy()]
+            busy = len(self.slots) - len(free)
+            target = prefetch_count
+            if self.canTakeMore(busy):
+                target += len(free)
+            have = len(self.ready) + (1 if self.downloading else 0)
+            return target - have
+
+    def fetchTasks(self):
         """
-            Read from the handbrake process's stdout one char at a time
-            until we hit a \r -- this is a needed because if you try
-            a readline it'll hang until it hits \n -- which won't happen
-            until handbrake exits -- it updates the vid progress in place
-            with multiple \r messages
+            Fetch stage, runs on its own thread. Reserves tasks from the central server and downloads their
+            videos so they're ready to go the moment a slot frees up. When there's nothing to do this waits
+            on the server for up to dispatch_timeout seconds so we hear about new tasks the moment they're added
         """
-        line = ''
+        central = self.centralProxy()
         while True:
-            out = self.encodeProc.stdout.read(1)
-            if out:
-                if out == '\r':
-                    break
-            if not out:
-                break
-            line += out
-        return line
-    
-    def checkForTask(self):
-        if self.status == RUNNING:
-            # We (think) we're doing something
-            if self.encodeProc:
-                # Handbrake process reference exists
-                if self.encodeProc.poll() is not None:
-                    # Handbrake has exited
-                    # TODO -- we should do some validation on the handbrake exit code, just checking that the
-                    # output file exists is pretty weak
-                    if os.path.exists(os.path.join(self.homedir,self.task.getOutputName())):
-                        # Since this file exists we assume things succeeded, FTP the video to the central server
-                        if not self.sendVideo():
-                            self.task.setErrors('Unable to send video')
-
-                    # Complete the task and inform the central server that we're done
-                    self.task.taskFinished()
-                    self.task.setCompleted(100)
-                    self.central.finishTask(self.task)
-                    self.cleanUp()
-                    return
-                else:
-                    # We're not done yet, but handbrake is running, update the central server on our progress
-                    if not self.central.updateTask(self.task):
-                        self.cancel(self.task.getName())
+            if self.wanted() <= 0:
+                self.wantWork.wait(2)
+                self.wantWork.clear()
+                continue
+            try:
+                asked = time.time()
+                task = central.reserveTask(self.getName(),dispatch_timeout)
+            except Exception:
+                logging.exception('Unable to reserve a task')
+                time.sleep(2)
+                continue
+            if not task:
+                if time.time() - asked < dispatch_timeout:
+                    # The server didn't wait for us, don't hammer it
+                    time.sleep(2)
+                continue
+            with self.lock:
+                self.downloading = task
+            task.mark('downloadStart')
+            ok = self.getVideo(task)
+            task.mark('downloadEnd')
+            with self.lock:
+                self.downloading = None
+                if task.getName() in self.cancelled:
+                    self.cancelled.discard(task.getName())
+                    self.cleanUp(task)
+                    continue
+                if ok:
+                    self.ready.append(task)
+            if ok:
+                self.startReady()
             else:
-                # Don't know why we think we're running -- probably a corner case here, but let's go back to IDLE
-                self.status = IDLE
-        else:
-            failed = False
-            # Try to get at ask from the central server
-            self.task = self.central.getTask(self.getName())
-            if self.task:
-                # We got a task, set our status to running, grab the video via FTP from the server and begin the encode
-                # process
-                self.status = RUNNING
-                if self.getVideo(self.task.getName()):
-                    self.encodeVid()
+                # Something bad happened getting the video, fail the task and tell the server
+                task.setErrors('Unable to get video')
+                try:
+                    central.finishTask(task,self.getName())
+                except Exception:
+                    # The server hands it to someone else once its lease runs out
+                    logging.exception('Unable to fail {0}'.format(task.getName()))
+                self.cleanUp(task)
+
+    def startReady(self):
+        """
+            Move downloaded tasks into any free slots
+        """
+        with self.lock:
+            # Anything the fetcher had already asked for when calibration started waits until it's done
+            while self.ready and not self.calibrating:
+                free = [slot for slot in self.slots if not slot.isBusy()]
+                if not free or not self.canTakeMore(len(self.slots) - len(free)):
+                    return
+                task = self.ready.popleft()
+                # Let the server know we've actually started on it, if it's been cancelled or handed to
+                # someone else in the meantime the server says no and we drop it
+                try:
+                    with self.centralLock:
+                        started = self.central.startTask(self.getName(),task.getName())
+                except Exception:
+                    # Server's probably restarting, keep the task and try again next time round
+                    logging.exception('Unable to start {0}'.format(task.getName()))
+                    self.ready.appendleft(task)
+                    return
+                if started:
+                    self.lastStart = time.time()
+                    free[0].start(task)
                 else:
-                    failed = True
-            if failed:
-                # Something bad happened with FTP, fail the task and tell the server
-                self.central.finishTask(self.task)
-                self.status = IDLE
-        # Reschedule the task so we'll check our state again in two seconds
-        self.timer = Timer(2,self.checkForTask)
-        self.timer.start()
-        
-    def cleanUp(self):
-        """
-            Various clean up operations that need to be performed
-                - Delete the video files, we shouldn't need them by now
-                - Cancel the update timer if it's still active since HB has exited
-                - Go back to IDLE
-                - Reschedule the main method timer
-        """
-        if os.path.exists(os.path.join(self.homedir,self.task.getOutputName())):
-                os.unlink(os.path.join(self.homedir,self.task.getOutputName()))
-        if os.path.exists(os.path.join(self.homedir,self.task.getName())):
-                os.unlink(os.path.join(self.homedir,self.task.getName()))
-        self.updateTimer.cancel()
-        self.timer.cancel()
-        self.task = None
-        self.status = IDLE
-        self.timer = Timer(2,self.checkForTask)
-        self.timer.start()
+                    self.cleanUp(task)
+
+    def calibrationClip(self):
+        """
+            The clip the calibration encodes run on, generated by ffmpeg the first time it's needed.
+            Returns None if ffmpeg isn't around
+        """
+        path = os.path.join(self.homedir,'encoding','calibration','clip-{0}.mkv'.format(calibration_length))
+        if os.path.exists(path):
+            return path
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        partial = path + '.tmp.mkv'
+        source = 'testsrc=duration={0}:size={1}:rate={2}'.format(calibration_length,calibration_size,calibration_rate)
+        try:
+            ret = subprocess.call([ffmpeg,'-v','error','-y','-f','lavfi','-i',source,'-c:v','mpeg4','-q:v','2',partial])
+        except OSError:
+            logging.warning('Unable to run ffmpeg, skipping calibration')
+            return None
+        if ret != 0:
+            logging.warning('ffmpeg exited with {0} making the calibration clip'.format(ret))
+            return None
+        os.rename(partial,path)
+        return path
+
+    def calibrate(self):
+        """
+            Time handbrake encoding the calibration clip with each of the calibration presets. Returns
+            a list of dicts with the encoder, quality, frames per second and speed (seconds of video
+            per second, the same as the central server's task costs) for each preset that worked
+        """
+        if not self.handbrake:
+            return []
+        clip = self.calibrationClip()
+        if not clip:
+            return []
+        output = os.path.join(os.path.dirname(clip),'output.mkv')
+        results = []
+        for encoder,quality in calibration_presets:
+            started = time.time()
+            with open(os.devnull,'wb') as null:
+                ret = subprocess.call([self.handbrake,'-e',encoder,'-q',quality,'-i',clip,'-o',output],stdout=null,stderr=null)
+            # Wall clock time rather than handbrake's own fps, startup costs count against real encodes too
+            elapsed = time.time() - started
+            if os.path.exists(output):
+                os.unlink(output)
+            if ret != 0 or elapsed <= 0:
+                logging.warning('Calibration encode with {0} at q{1} failed'.format(encoder,quality))
+                continue
+            results.append({'encoder':encoder,'quality':quality,'fps':calibration_length * calibration_rate / elapsed,
+                            'speed':calibration_length / elapsed,'when':time.time()})
+            logging.info('Calibrated {0} at q{1}: {2:.1f} fps'.format(encoder,quality,results[-1]['fps']))
+        return results
+
+    def calibrateLoop(self):
+        """
+            Calibration stage, runs on its own thread. Calibrates before the first task is taken on, then
+            again every calibration_interval seconds, waiting until the box is idle so our own encodes
+            don't skew the results
+        """
+        central = self.centralProxy()
+        while True:
+            try:
+                results = self.calibrate()
+            except Exception:
+                logging.exception('Unable to calibrate')
+                results = []
+            with self.lock:
+                self.calibrating = False
+            self.wantWork.set()
+            if results:
+                try:
+                    central.reportCalibration(self.getName(),results)
+                except Exception:
+                    logging.exception('Unable to report calibration')
+            time.sleep(calibration_interval)
+            while True:
+                with self.lock:
+                    if not self.getTasks():
+                        self.calibrating = True
+                        break
+                time.sleep(60)
+
+    def upload(self,task):
+        """
+            Hand a finished task to the upload stage
+        """
+        with self.lock:
+            self.uploading[task.getName()] = task
+        self.uploads.put(task)
+        self.wantWork.set()
+
+    def uploadVideos(self):
+        """
+            Upload stage, runs on its own thread. Sends finished videos back to the central server and lets
+            it know the task is done
+        """
+        central = self.centralProxy()
+        while True:
+            task = self.uploads.get()
+            try:
+                if not task.getErrors() and task.getOutputName() and os.path.exists(self.outputPath(task)):
+                    # Since this file exists we assume things succeeded, send the video to the central server
+                    task.mark('uploadStart')
+                    if not self.sendVideo(task):
+                        task.setErrors('Unable to send video')
+                    task.mark('uploadEnd')
+                # Complete the task and inform the central server that we're done
+                central.finishTask(task,self.getName())
+            except Exception:
+                logging.exception('Unable to finish {0}'.format(task.getName()))
+            finally:
+                self.cleanUp(task)
+                with self.lock:
+                    self.uploading.pop(task.getName(),None)
+    
+    def checkForTask(self):
+        try:
+            progress = []
+            for slot in self.slots:
+                if slot.isBusy():
+                    report = slot.check()
+                    if report:
+                        progress.append(report)
+            with self.lock:
+                # Tasks in the other stages still belong to us, the server needs to know we haven't forgotten them
+                waiting = list(self.ready) + ([self.downloading] if self.downloading else []) + self.uploading.values()
+            progress.extend(task.getProgress() for task in waiting)
+            if progress:
+                # One call covers all our tasks, anything the server says isn't ours any more gets dropped
+                try:
+                    with self.centralLock:
+                        lost = self.central.reportProgress(self.getName(),progress)
+                except Exception:
+                    # Server's probably restarting, keep going and try again next time round
+                    logging.exception('Unable to report progress')
+                    lost = []
+                for name in lost:
+                    self.cancel(name)
+            self.startReady()
+            if self.wanted() > 0:
+                self.wantWork.set()
+        except Exception:
+            logging.exception('Unable to check on our tasks')
+        finally:
+            # Reschedule the task so we'll check our state again in two seconds, whatever went wrong this
+            # time, the progress reports are what keep our leases alive
+            self.timer = Timer(2,self.checkForTask)
+            self.timer.start()
         
     def cancel(self,name):
         """
-            External call point to cancel the active task, used by the central server upon user request,
-            kills the handbrake process and cleans up
+            External call point to cancel an active task, used by the central server upon user request,
+            kills the handbrake process and cleans up. Tasks which are still downloading are dropped once
+            the download finishes, tasks which are already uploading can't be cancelled
         """
-        if self.task:
-            if self.task.getName() == name:
-                if self.encodeProc:
-                    self.encodeProc.kill()
-                    self.cleanUp()
+        for slot in self.slots:
+            if slot.cancel(name):
+                return True
+        with self.lock:
+            for task in self.ready:
+                if task.getName() == name:
+                    self.ready.remove(task)
+                    self.cleanUp(task)
                     return True
+            if self.downloading and self.downloading.getName() == name:
+                self.cancelled.add(name)
+                return True
         return False
-        
-    def updateCompleted(self):
-        """
-            Timed method which gets the percentage completed from the handbrake stdout and updates the task
-        """
-        out = self.getLine()
-        if out:
-            match = re.search('(\d+\.\d+)\s\%',out)
-            if match:
-                completed = match.group(1)
-                self.task.setCompleted(completed)
-        if self.encodeProc:
-            if self.encodeProc.poll() is None:
-                self.updateTimer = Timer(.1,self.updateCompleted)
-                self.updateTimer.start()
 
     def getStatus(self):
-        return self.status
-    
-    def sendVideo(self):
+        if self.getTasks():
+            return RUNNING
+        return IDLE
+
+    def getTasks(self):
         """
-            Sends the encoded video back to the central server
+            External call point for the central server, the names of the tasks we're holding in any stage
         """
-        ftp = FTP()
-        ftp.connect(ftp_host,ftp_port)
-        ftp.login(ftp_user, ftp_pass)
-        ftp.storbinary('STOR {0}'.format(self.task.getOutputName()),open(os.path.join(self.homedir,self.task.getOutputName()),'rb'))
-        return True
-            
-    def getVideo(self,video):
+        with self.lock:
+            names = [task.getName() for task in self.ready] + self.uploading.keys()
+            if self.downloading:
+                names.append(self.downloading.getName())
+        return names + [name for name in [slot.getTaskName() for slot in self.slots] if name]
+
+    def sendVideo(self,task):
         """
-            Grabs the passed video from the central server
+            Sends the encoded video back to the central server, the task says where it's been staged so
+            the server can move it into place
         """
-        ftp = FTP()
-        ftp.connect(ftp_host,ftp_port)
-        ftp.login(ftp_user, ftp_pass)
-        ftp.retrbinary('RETR {0}'.format(video), open(os.path.join(self.homedir,video),'wb').write)
+        try:
+            staged = self.storage.store(task.getOutputName(),self.workDir(task))
+        except Exception:
+            logging.exception('Unable to send {0}'.format(task.getOutputName()))
+            return False
+        if not staged:
+            return False
+        task.setStaged(staged)
         return True
-        
-    def encodeVid(self):
+            
+    def getVideo(self,task):
         """
-            Kick off the handbrake process with the various settings found in the task as arguements
-            Also starts the timer which will parse the handbrake output for completion percentages
+            Grabs the task's video from the central server
         """
-        self.task.setOutputName(re.sub('\.\w*$','.{0}'.format(self.task.getFormat()),self.task.getName()))
-        self.task.taskStarted()
-        args = [self.handbrake]
-        if self.task.getEncoder():
-            args.extend(['-e',self.task.getEncoder()])
-        if self.task.getFormat():
-            args.extend(['-f',self.task.getFormat()])
-        if self.task.getQuality():
-            args.extend(['-q',self.task.getQuality()])
-        if self.task.getLarge():
-            args.append('-4')
-        args.extend(['-i',os.path.join(self.homedir,self.task.getName()),'-o',os.path.join(self.homedir,self.task.getOutputName())])
-        self.encodeProc = subprocess.Popen(args,stdout=subprocess.PIPE)
-        self.updateTimer = Timer(.1,self.updateCompleted)
-        self.updateTimer.start()
+        try:
+            return self.storage.fetch(task.getSource(),self.workDir(task),task.getDigest())
+        except Exception:
+            logging.exception('Unable to get {0}'.format(task.getSource()))
+            return False
 
 def main():
     encoder = Encoder()
@@ -226,6 +693,7 @@ def main():
     except:
         pass
     ns.register(encoder.getName(),uri)
+    serveMetrics(encoder_metrics_port)
     daemon.requestLoop()
     
 if __name__ == "__main__":
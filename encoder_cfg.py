@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import datetime
+import time
 import socket
 import re
 
@@ -17,6 +18,38 @@ ftp_port = 9004
 ftp_user = 'dist'
 ftp_pass = 'encoder'
 
+# How videos get between the boxes
+#   'ftp'    -- copied to and from the central server's ~/master over FTP
+#   'shared' -- every box mounts the central server's ~/master at shared_path (NFS, SMB, ...) and
+#               handbrake works on it directly, nothing is copied at all
+storage_mode = 'ftp'
+shared_path = '/mnt/master'
+
+# How many logged in FTP sessions each box keeps open between transfers
+ftp_sessions = 4
+
+# Failed transfers are retried this many times, waiting transfer_backoff seconds before the first
+# retry and twice as long before each one after that
+transfer_retries = 5
+transfer_backoff = 2
+
+# The central server keeps up to this many bytes of finished outputs in ~/master/cache, a video that's
+# added again with the same settings is served from there rather than encoded again (0 turns it off)
+cache_size = 50 * 1024 ** 3
+
+# The central server journals task changes to ~/master/journal at most journal_interval seconds after
+# they happen, and rewrites the journal from scratch once it holds journal_compact task states
+journal_interval = 0.2
+journal_compact = 100000
+
+# The central server and the encoders serve Prometheus style metrics on http://<box>:<port>/metrics,
+# None turns them off
+metrics_port = 9006
+encoder_metrics_port = 9007
+
+# How many videos the UI sends to the central server at once when adding a batch
+upload_workers = 4
+
 # Valid engine states
 IDLE = 'idle'
 RUNNING = 'running'
@@ -24,6 +57,111 @@ RUNNING = 'running'
 #max number of times to find pyro naming
 max_tries = 5
 
+# Idle encoders wait on the server for up to this many seconds for a task to show up instead of
+# polling every couple of seconds (0 goes back to plain polling)
+dispatch_timeout = 30
+
+# How many cleared tasks the server remembers so UIs can be told they're gone, a UI which
+# has been away longer than that just gets sent the whole task list again
+max_tombstones = 1000
+
+# How many encodes each encoder runs at once, None works it out from the number of cores
+# (one encode per cores_per_slot cores)
+encoder_slots = None
+cores_per_slot = 8
+
+# An encoder won't start another encode alongside its running ones while the load average is
+# above max_load per core, and it gives the load average slot_ramp_delay seconds to catch up
+# after starting one
+max_load = 0.9
+slot_ramp_delay = 60
+
+# How many tasks an encoder downloads ahead, on top of the ones it's about to start, so its next
+# video is already there when an encode finishes
+prefetch_count = 1
+
+# Encoders time an encode of a generated test clip calibration_length seconds long for each
+# (encoder, quality) in calibration_presets when they start, and again every calibration_interval
+# seconds when they're idle, and tell the central server how fast they went. An empty list turns
+# calibration off
+calibration_presets = [('x264','20')]
+calibration_interval = 6 * 3600
+calibration_length = 10
+
+# The central server warns about an encoder whose calibration comes out this much slower than its
+# last one (0-1), something like a box throttling itself because it's running hot
+calibration_drop = 0.25
+
+# Encoders report on their tasks every couple of seconds, if the central server hasn't heard about a
+# task for lease_time seconds it decides the encoder has died and hands the task to someone else
+lease_time = 10
+
+# How long the central server waits on an encoder before giving up on a call
+pyro_timeout = 10
+
+# Every idle encoder ties up one of the server's Pyro worker threads while it waits,
+# so the pool needs to be at least as big as the farm
+pyro_threads = 200
+
+# How the central server runs
+#   'threads' -- the name server and the FTP server get a process each, and every connection to the
+#                central server a thread of its own (up to pyro_threads)
+#   'loop'    -- the name server, the FTP server, the central server and its timers all run on one
+#                thread off a single select loop, however big the farm gets. Calls never wait (idle
+#                encoders and UIs poll rather than waiting on the server for something to happen) and
+#                slow disk work is handed to offload_threads threads. Once offload_queue jobs are
+#                backed up new tasks are turned away until the threads catch up
+server_mode = 'threads'
+offload_threads = 4
+offload_queue = 200
+
+# Segmented encoding -- sources which are split across multiple encoders are
+# cut into pieces roughly this many seconds long
+segment_length = 600
+# Segments shorter than this are merged into their neighbour rather than
+# being handed out on their own
+segment_min_length = 60
+
+# Scheduling -- every aging_interval seconds a task spends waiting in the queue counts as one
+# extra priority level so low priority work still gets done eventually (0 disables aging)
+aging_interval = 600
+
+# How the central server picks the next task for an encoder
+#   'fifo' -- highest priority first, then oldest first (see aging_interval)
+#   'lpt'  -- highest priority first, then the biggest jobs go to the fastest encoders and the smallest
+#             to the slowest, so the whole queue gets done sooner. Encoder speeds are learned from the
+#             jobs they finish
+# It can be switched while the server's running with setScheduleMode
+schedule_mode = 'fifo'
+
+# How much each finished job moves an encoder's learned speed (0-1, higher forgets faster)
+speed_smoothing = 0.3
+
+# A running task's ETA goes by how far it got over the last eta_window seconds, and how far out the
+# ETAs were is kept for the last eta_history finished tasks
+eta_window = 120
+eta_history = 200
+
+# How often the UI asks the central server for ETAs, in seconds
+forecast_interval = 5
+
+# Preemption -- a newly added task at least this many priority levels above a running task will
+# kill that encode and send it back to the queue, None disables preemption
+preempt_margin = None
+
+# Encoders which asked for work in the last idle_window seconds and got none are considered idle,
+# nothing gets preempted while an idle encoder is around to pick the task up
+idle_window = 10
+
+# Speculative execution -- once the queue is empty, a task whose encoder is getting through it at less
+# than straggler_ratio of the farm's median speed gets a duplicate on an idle encoder which should beat
+# it. Whichever copy finishes first wins and the other is cancelled. Tasks get straggler_grace seconds
+# to get going before they're judged, and at most speculative_limit duplicates run at once, None
+# turns them off
+speculative_limit = 2
+straggler_ratio = 0.5
+straggler_grace = 60
+
 def getLanIP():
     """
         Used to attempt to grab the system's non 127.0.0.1 IP using the lan_regex property
@@ -32,12 +170,65 @@ def getLanIP():
         if re.search(lan_regex,ip):
             return ip
 
+# The steps in a task's life, and the phases between them as (phase,step it starts at,step it ends at).
+# The central server marks queued, assigned, finishing and finalized, the encoder everything in between
+# (so phases which span the two, like assigned -> downloadStart, aren't measured, the clocks may not agree)
+phases = [('queued','queued','assigned'),
+          ('download','downloadStart','downloadEnd'),
+          ('slotWait','downloadEnd','encodeStart'),
+          ('encode','encodeStart','encodeEnd'),
+          ('uploadWait','encodeEnd','uploadStart'),
+          ('upload','uploadStart','uploadEnd'),
+          ('finalize','finishing','finalized')]
+
+# Version of the tuple a Task goes over the wire and into the journal as, see Task.pack. Fields are only
+# ever added on the end, bump this whenever one is and add it to Task.versions
+task_version = 2
+
+def epoch(when):
+    """ Seconds since the epoch for a datetime, tasks pickled before they kept epoch times had datetimes """
+    if isinstance(when,datetime.datetime):
+        return time.mktime(when.timetuple()) + when.microsecond / 1e6
+    return when
+
 class Task(object):
     """
         The common task object which all the components use
+
+        The server holds on to every task it's ever been given and sends them about in bulk, so tasks are
+        slotted and go over the wire (and into the journal) as a flat versioned tuple of plain values
+        instead of a pickled object dict. Times are seconds since the epoch
     """
-    def __init__(self,name,encoder,format,large,quality):
+    # In the order pack puts them in, new ones go on the end
+    fields = ('name','priority','source','digest','cost','size','startAt','stopAt','parent','segments',
+              'encoder','format','large','quality','started','finished','errors','output','added',
+              'completed','fps','avgFps','eta','times','staged')
+    __slots__ = fields
+    # The fields each version of pack puts out, ones an older version didn't have are left at None
+    versions = {1:fields[:-1],
+                2:fields}
+
+    def __init__(self,name,encoder,format,large,quality,source=None,startAt=None,stopAt=None,parent=None,priority=0,digest=None):
         self.name = name
+        # Higher priority tasks are handed out first
+        self.priority = priority
+        # The video file on the server which the task encodes, for normal tasks this is the
+        # same as the name, segments of a split video all share their parent's source
+        self.source = source or name
+        # sha1 of the source, taken by the UI as it sent it, encoders check their copy against it
+        self.digest = digest
+        # Rough idea of how much work the task is, seconds of video (or megabytes if the server
+        # couldn't probe it), used for scheduling
+        self.cost = None
+        # Size of the source in bytes
+        self.size = None
+        # Segment boundaries in seconds, None means encode the whole source
+        self.startAt = startAt
+        self.stopAt = stopAt
+        # Name of the task this segment belongs to
+        self.parent = parent
+        # Names of the segment tasks if this video has been split up
+        self.segments = None
         self.encoder = encoder
         self.format = format
         self.large = large
@@ -46,8 +237,59 @@ class Task(object):
         self.finished = None
         self.errors = None
         self.output = None
-        self.added = datetime.datetime.now()
+        self.added = time.time()
         self.completed = 0
+        # Latest numbers from handbrake's progress output, eta is in seconds
+        self.fps = None
+        self.avgFps = None
+        self.eta = None
+        # step -> when the task got there (seconds since the epoch), see phases
+        self.times = {}
+        # Where the encoder left the output in the master dir for the central server to move into
+        # place, None if it put it there itself (older encoders)
+        self.staged = None
+
+    def pack(self):
+        """ The task as (task_version,field values...), everything in it is a plain value which any
+            serializer can handle
+        """
+        return (task_version,) + tuple(getattr(self,field) for field in self.fields)
+
+    @classmethod
+    def unpack(cls,data):
+        """ A task from what pack gave, whichever version it was """
+        task = cls.__new__(cls)
+        task.__setstate__(data)
+        return task
+
+    def __getstate__(self):
+        return self.pack()
+
+    def __setstate__(self,state):
+        if isinstance(state,dict):
+            # Pickled before tasks were slotted
+            values = dict((field,epoch(value)) for field,value in state.items())
+        else:
+            values = dict(zip(self.fieldsFor(state),state[1:]))
+        for field in self.fields:
+            setattr(self,field,values.get(field))
+        if self.priority is None:
+            self.priority = 0
+        if self.completed is None:
+            self.completed = 0
+        if self.times is None:
+            self.times = {}
+
+    @classmethod
+    def fieldsFor(cls,state):
+        """ The fields in a packed task. One from a newer version has everything we know about followed by
+            fields we don't, which are dropped
+        """
+        version = state[0]
+        fields = cls.versions.get(version,cls.fields)
+        if len(state) - 1 != len(fields) and (version in cls.versions or len(state) - 1 < len(fields)):
+            raise ValueError('Version {0} task with {1} fields, expected {2}'.format(version,len(state) - 1,len(fields)))
+        return fields
 
     def getAdded(self):
         return self.added
@@ -63,6 +305,51 @@ class Task(object):
 
     def getQuality(self):
         return self.quality
+
+    def getPriority(self):
+        return self.priority
+
+    def setPriority(self,priority):
+        self.priority = priority
+
+    def getSource(self):
+        return self.source
+
+    def getCost(self):
+        return self.cost
+
+    def setCost(self,cost):
+        self.cost = cost
+
+    def getSize(self):
+        return self.size
+
+    def setSize(self,size):
+        self.size = size
+
+    def getDigest(self):
+        return self.digest
+
+    def setDigest(self,digest):
+        self.digest = digest
+
+    def getStartAt(self):
+        return self.startAt
+
+    def getStopAt(self):
+        return self.stopAt
+
+    def getParent(self):
+        return self.parent
+
+    def isSegment(self):
+        return self.parent is not None
+
+    def setSegments(self,segments):
+        self.segments = segments
+
+    def getSegments(self):
+        return self.segments
         
     def reset(self):
         self.started = None
@@ -70,27 +357,67 @@ class Task(object):
         self.errors = None
         self.output = None
         self.completed = 0
+        self.fps = None
+        self.avgFps = None
+        self.eta = None
+        self.times = {}
+        self.staged = None
         
     def setCompleted(self,completed):
         self.completed = completed
         
     def getCompleted(self):
         return self.completed
+
+    def setProgress(self,completed,fps=None,avgFps=None,eta=None):
+        self.completed = completed
+        self.fps = fps
+        self.avgFps = avgFps
+        self.eta = eta
+
+    def copyResults(self,other):
+        """ Take the fields an encoder fills in from its copy of the task """
+        self.output = other.output
+        self.staged = other.staged
+        self.errors = other.errors
+        self.started = other.started
+        self.finished = other.finished
+        self.times.update(other.times)
+        self.setProgress(other.completed,other.fps,other.avgFps,other.eta)
+
+    def getProgress(self):
+        """ Compact progress report for the central server, see CentralEncoding.reportProgress """
+        return (self.name,self.completed,self.fps,self.eta)
+
+    def getFps(self):
+        return self.fps
+
+    def getAvgFps(self):
+        return self.avgFps
+
+    def getEta(self):
+        return self.eta
         
     def setOutputName(self,name):
         self.output = name
         
     def getOutputName(self):
         return self.output
+
+    def setStaged(self,name):
+        self.staged = name
+
+    def getStaged(self):
+        return self.staged
         
     def getName(self):
         return self.name
     
     def taskStarted(self):
-        self.started = datetime.datetime.now()
+        self.started = time.time()
         
     def taskFinished(self):
-        self.finished = datetime.datetime.now()
+        self.finished = time.time()
             
     def getStarted(self):
         return self.started
@@ -105,6 +432,32 @@ class Task(object):
         return self.errors
     
     def duration(self):
+        """ Seconds from starting to finishing """
         if self.started and self.finished:
-            return self.started - self.finished
-        return None
\ No newline at end of file
+            return self.finished - self.started
+        return None
+
+    def mark(self,step):
+        """ Note that the task has just reached a step, see phases """
+        self.times[step] = time.time()
+
+    def getTimes(self):
+        return self.times
+
+    def phaseDurations(self):
+        """ Seconds the task spent in each of the phases it's been all the way through """
+        durations = {}
+        for phase,start,end in phases:
+            if start in self.times and end in self.times:
+                durations[phase] = max(0.0,self.times[end] - self.times[start])
+        return durations
+
+# Pickle goes through __getstate__, Pyro's other serializers (serpent and json) are told how to carry a
+# task here so the farm doesn't have to use pickle at all
+try:
+    from Pyro4.util import SerializerBase
+except ImportError:
+    pass
+else:
+    SerializerBase.register_class_to_dict(Task,lambda task: {'__class__':'encoder_cfg.Task','task':task.pack()})
+    SerializerBase.register_dict_to_class('encoder_cfg.Task',lambda classname,data: Task.unpack(data['task']))
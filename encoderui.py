@@ -5,19 +5,38 @@ import wx.grid
 import wx.lib.agw.aui as aui
 import Pyro4
 import os
+import time
 import threading
-from encoder_cfg import pyro_host, pyro_port, ftp_host, ftp_port, ftp_user, ftp_pass
-from ftplib import FTP
+import Queue
+from encoder_cfg import pyro_host, pyro_port, upload_workers, forecast_interval
+from storage import getStorage, TransferCancelled
 import textwrap
 
 statusMapping = {
         'Encoding':'a',
-        'Pending':'b',
-        'Finished':'c',
-        'Cancelled':'d',
-        'Error':'e',
+        'Joining':'a',
+        'Reserved':'b',
+        'Pending':'c',
+        'Finished':'d',
+        'Cancelled':'e',
+        'Error':'f',
 }
 
+def formatTime(when):
+    """ A task's time (seconds since the epoch) for showing, ' ' if it hasn't happened """
+    if not when:
+        return ' '
+    return time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(when))
+
+def formatEta(seconds):
+    """ A number of seconds as something like 1h05m or 3m20s, blank if we don't know """
+    if seconds is None:
+        return ' '
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '{0}h{1:02d}m'.format(seconds // 3600,seconds % 3600 // 60)
+    return '{0}m{1:02d}s'.format(seconds // 60,seconds % 60)
+
 class TaskTable(wx.grid.PyGridTableBase):
     def __init__(self, data, rowLabels=None, colLabels=None):
         wx.grid.PyGridTableBase.__init__(self)
@@ -25,17 +44,34 @@ class TaskTable(wx.grid.PyGridTableBase):
 
         #Mapping to keep track of which task occupies which row
         self.rowMapping = {}
+
+        # Latest row for every task we know about, keyed by task name, kept
+        # up to date with the changes the central server sends us
+        self.rows = {}
         
         self.rowLabels = rowLabels
         self.colLabels = colLabels
 
     def sortData(self,data):
-        # Sorting goes Encoding Tasks > Pending Tasks > Finished > Cancelled > Error
+        # Sorting goes Encoding Tasks > Reserved > Pending Tasks > Finished > Cancelled > Error
         # Tasks in the same state are then compared by the datetime they were added
         # to the server.
-        data =  sorted(data, key=lambda x: statusMapping[x[1]]+str(x[6]))
+        data =  sorted(data, key=lambda x: statusMapping[x[1]]+str(x[7]))
         return data
         
+    def applyChanges(self,changed,removed,grid):
+        """ Merge a set of changed rows (name -> row) into the table and drop the
+            removed task names. If removed is None, changed holds every task and replaces
+            whatever we had
+        """
+        if removed is None:
+            self.rows = {}
+        else:
+            for name in removed:
+                self.rows.pop(name,None)
+        self.rows.update(changed)
+        self.updateData(self.rows.values(),grid)
+
     def updateData(self,data,grid):
         # Old number of rows
         start = len(self.data)
@@ -71,7 +107,7 @@ class TaskTable(wx.grid.PyGridTableBase):
             else:
                 self.data[row] = info
             # Map this row onto the grid
-            for i in xrange(0,6):
+            for i in xrange(0,7):
                 self.SetValue(row,i,info[i])
         # Grid updates done, end the batch
         grid.EndBatch()
@@ -151,8 +187,9 @@ class TaskGrid(wx.grid.Grid):
         self.SetColSize(1,50)
         self.SetColSize(2,150)
         self.SetColSize(3,70)
-        self.SetColSize(4,150)
+        self.SetColSize(4,70)
         self.SetColSize(5,150)
+        self.SetColSize(6,150)
 
         # We have no row labels and they take up a good amount of space by default
         self.SetRowLabelSize(0)
@@ -172,6 +209,10 @@ class TaskGrid(wx.grid.Grid):
         # Grid will not reflect changes made until forcerefresh is called
         self.ForceRefresh()
 
+    def ApplyChanges(self,changed,removed):
+        self.GetTable().applyChanges(changed,removed,self)
+        self.ForceRefresh()
+
 class taskViewDialog(wx.Dialog):
     """ A quick dialog to that gives a detailed view of selected task(s)
         This view provides extra data compared to that displayed directly
@@ -195,12 +236,8 @@ class taskViewDialog(wx.Dialog):
         rows = table.getRows(rows)
         tasks = []
 
-        # Grab the global list of tasks from the central server
-        # TODO -- This is a little hackish, maybe the table could
-        # hold a mapping that contains the actual task objects
-        # that way we could avoid the extra call to the server
-        # which is already happening every few seconds anyway
-        tasksIn = self._parent.central.getTasks()
+        # The frame keeps its own copy of every task up to date, no need to ask the server
+        tasksIn = self._parent.tasks
 
         # Grab the task objects matching the selected rows
         for row in rows:
@@ -221,7 +258,7 @@ class taskViewDialog(wx.Dialog):
 
         # General Task Info
         taskPanel = wx.Panel(self,-1)
-        taskSizer = wx.FlexGridSizer(rows=12,cols=2,hgap=10,vgap=5)
+        taskSizer = wx.FlexGridSizer(rows=13,cols=2,hgap=10,vgap=5)
         taskNameLabel = wx.StaticText(taskPanel,label='Name:')
         self.taskName = wx.StaticText(taskPanel,label='')
         taskOutNameLabel = wx.StaticText(taskPanel,label='Output Name:')
@@ -234,6 +271,8 @@ class taskViewDialog(wx.Dialog):
         self.taskEncoder = wx.StaticText(taskPanel,label='')
         taskCompletedLabel = wx.StaticText(taskPanel,label='Completed:')
         self.taskCompleted = wx.StaticText(taskPanel,label='')
+        taskEtaLabel = wx.StaticText(taskPanel,label='ETA:')
+        self.taskEta = wx.StaticText(taskPanel,label='')
         taskStartedLabel = wx.StaticText(taskPanel,label='Started:')
         self.taskStarted = wx.StaticText(taskPanel,label='')
         taskFinishedLabel = wx.StaticText(taskPanel,label='Finished:')
@@ -250,7 +289,7 @@ class taskViewDialog(wx.Dialog):
         taskSizer.AddMany([taskNameLabel,self.taskName,taskOutNameLabel,self.taskOutName,
                            taskAddedLabel,self.taskAdded,
                            taskStatusLabel,self.taskStatus,taskEncoderLabel,self.taskEncoder,
-                           taskCompletedLabel,self.taskCompleted,
+                           taskCompletedLabel,self.taskCompleted,taskEtaLabel,self.taskEta,
                            taskStartedLabel,self.taskStarted,taskFinishedLabel,self.taskFinished,
                            taskEncLabel,self.taskEnc,taskFormatLabel,self.taskFormat,
                            taskLargeLabel,self.taskLarge,taskQualityLabel,self.taskQuality,
@@ -284,15 +323,16 @@ class taskViewDialog(wx.Dialog):
         self.taskName.SetLabel('\n'.join(textwrap.wrap(id,35)))
         if task.getOutputName():
             self.taskOutName.SetLabel('\n'.join(textwrap.wrap(task.getOutputName(),35)))
-        self.taskAdded.SetLabel(str(task.getAdded()))
+        self.taskAdded.SetLabel(formatTime(task.getAdded()))
         self.taskStatus.SetLabel(status)
         if encoder:
             self.taskEncoder.SetLabel(encoder)
         self.taskCompleted.SetLabel(str(task.getCompleted()))
+        self.taskEta.SetLabel(self._parent.getEta(task,status))
         if task.getStarted():
-            self.taskStarted.SetLabel(str(task.getStarted()))
+            self.taskStarted.SetLabel(formatTime(task.getStarted()))
         if task.getFinished():
-            self.taskFinished.SetLabel(str(task.getFinished()))
+            self.taskFinished.SetLabel(formatTime(task.getFinished()))
         self.taskEnc.SetLabel(task.getEncoder())
         self.taskFormat.SetLabel(task.getFormat())
         self.taskLarge.SetLabel(str(task.getLarge()))
@@ -333,7 +373,7 @@ class addEncodeDialog(wx.Dialog):
         mainBox = wx.BoxSizer(wx.VERTICAL)
 
         encodePanel = wx.Panel(self,-1)
-        formSizer = wx.FlexGridSizer(rows=4,cols=2,hgap=10,vgap=5)
+        formSizer = wx.FlexGridSizer(rows=6,cols=2,hgap=10,vgap=5)
         encoderLabel = wx.StaticText(encodePanel,label='Encoder')
         self.encoder = wx.ComboBox(encodePanel,-1,value='x264',choices=['x264','ffmpeg','theora'],style=wx.CB_READONLY|wx.CB_SORT|wx.CB_DROPDOWN)
         formatLabel = wx.StaticText(encodePanel,label='Format')
@@ -343,8 +383,13 @@ class addEncodeDialog(wx.Dialog):
         qualityLabel = wx.StaticText(encodePanel,label='Quality')
         choices = [str(x) for x in xrange(0,52)]
         self.quality = wx.ComboBox(encodePanel,-1,value='20',choices=choices,style=wx.CB_READONLY|wx.CB_SORT|wx.CB_DROPDOWN)
+        segmentedLabel = wx.StaticText(encodePanel,label='Segments')
+        self.segmented = wx.CheckBox(encodePanel,-1,'Split across encoders')
+        priorityLabel = wx.StaticText(encodePanel,label='Priority')
+        self.priority = wx.SpinCtrl(encodePanel,-1,value='0',min=-10,max=10)
         formSizer.AddMany([encoderLabel,self.encoder,formatLabel,
-                           self.format,largeLabel,self.large,qualityLabel,self.quality])
+                           self.format,largeLabel,self.large,qualityLabel,self.quality,
+                           segmentedLabel,self.segmented,priorityLabel,self.priority])
         encodePanel.SetSizer(formSizer)
         buttonBox = wx.BoxSizer(wx.HORIZONTAL)
         buttonBox.Add(add,0,wx.BOTTOM|wx.RIGHT|wx.TOP,5)
@@ -373,11 +418,13 @@ class addEncodeDialog(wx.Dialog):
         format = self.format.GetValue()
         large = self.large.IsChecked()
         quality = self.quality.GetValue()
+        segmented = self.segmented.IsChecked()
+        priority = self.priority.GetValue()
         files = self.vids
         dir = self.dir
         self.Close()
         if self.vids and self.dir:
-            self._parent.addVideos(encoder,format,large,quality,files,dir)
+            self._parent.addVideos(encoder,format,large,quality,files,dir,segmented,priority)
 
     def addVid(self,event):
         # TODO -- This currently clears out any videos already selected, it would probably
@@ -422,7 +469,6 @@ class EncoderFrame(wx.Frame):
                     'taskList': wx.NewId(),
                     'addFolder': wx.NewId(),
                     'addVideo': wx.NewId(),
-                    'taskTimer': wx.NewId(),
                     'add': wx.NewId(),
                     'cancel': wx.NewId(),
                     'view': wx.NewId(),
@@ -430,24 +476,45 @@ class EncoderFrame(wx.Frame):
                     'retry': wx.NewId(),
                     }
 
-        # Our working dialog for display when we're busy FTP'ing files around
+        # Our working dialog for display when we're busy sending files around, and the timer
+        # which keeps it up to date
         self.workingDiag = None
+        self.workingTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER,self.updateWorking,self.workingTimer)
 
-        # Thread reference to the thread which will perform the actual FTP operations
-        self.currThread = None
-
-        # Counts the videos we've FTP'ed so far -- assuming we've added multiple videos
+        # How many of the videos we're adding have been dealt with, out of how many, and how many
+        # bytes that was
         self.workingTotal = 0
+        self.workingFiles = 0
+        self.workingSent = 0
+        self.workingBytes = 0
 
-        # Would be used for cancelling adding -- if that were implemented
-        # TODO -- Implement cancelling of FTP / Add Task Operation
+        # Set when the user cancels adding, the upload threads stop as soon as they notice
         self.needCancel = False
 
-        # List of video files we still need to FTP and add tasks for
-        self.pendingSends = []
+        # Queue of (dir,video) the upload threads still need to send, the number of upload threads
+        # still going, and how far along each video being sent is
+        self.pendingSends = Queue.Queue()
+        self.sendThreads = 0
+        self.sendProgress = {}
+        self.sendLock = threading.Lock()
+
+        # Tasks for videos which have arrived at the central server but haven't been added yet,
+        # and the videos which couldn't be sent or added
+        self.toAdd = []
+        self.workingFailed = []
+
+        # Our copy of every task the server knows about, name -> (task,encoder,status), and the
+        # revision of the server's task list that copy is up to date with (whatever the server last
+        # gave us, it's only ever handed back)
+        self.tasks = {}
+        self.revision = 0
+
+        # The central server's latest forecast, see CentralEncoding.getForecast
+        self.forecast = {'tasks':{},'drain':None,'errors':None}
 
         # The main table display which contains all the tasks
-        self.taskList = TaskGrid(taskPanel,self.getData(),rowLabels=None,colLabels=['Task Name','Status','Assigned Encoder','Completed','Started','Finished'])
+        self.taskList = TaskGrid(taskPanel,[],rowLabels=None,colLabels=['Task Name','Status','Assigned Encoder','Completed','ETA','Started','Finished'])
         
         taskBox.Add(self.taskList,1,wx.EXPAND|wx.ALL)
 
@@ -466,14 +533,19 @@ class EncoderFrame(wx.Frame):
         self.mgr.AddPane(taskPanel, aui.AuiPaneInfo().Center().Floatable(False).MaximizeButton(False).CaptionVisible(False).CloseButton(False))
         self.mgr.SetDockSizeConstraint(.5,.5)
         self.mgr.Update()
+        self.CreateStatusBar()
         self.Centre()
 
-        # This timer will update the table with the latest and greatest list of tasks
-        # from the central server every 4000ms
-        self.timer = wx.Timer(self,self.ids['taskTimer'])
-        self.timer.Start(4000)
-        
-        wx.EVT_TIMER(self,self.ids['taskTimer'],self.refreshList)
+        # Fill the table, then have a thread wait on the central server for changes and push them
+        # to the table as they happen
+        self.refreshList()
+        self.watcher = threading.Thread(target=self.watchTasks,name='Task-Watcher')
+        self.watcher.daemon = True
+        self.watcher.start()
+        self.forecaster = threading.Thread(target=self.watchForecast,name='Forecast-Watcher')
+        self.forecaster.daemon = True
+        self.forecaster.start()
+
         wx.EVT_TOOL(self,self.ids['cancel'],self.cancel)
         wx.EVT_TOOL(self,self.ids['add'],self.add)
         wx.EVT_TOOL(self,self.ids['view'],self.view)
@@ -484,26 +556,45 @@ class EncoderFrame(wx.Frame):
     def view(self,evt=None):
         taskViewDialog(self,self.taskList.GetSelectedRows(),self.taskList).ShowModal()
 
-    def createSettings(self,encoder,format,large,quality):
+    def createSettings(self,encoder,format,large,quality,segmented=False,priority=0):
         settings = {
                 'encoder':encoder,
                 'format':format,
                 'large':large,
                 'quality':quality,
+                'segmented':segmented,
+                'priority':priority,
         }
         return settings
 
-    def addVideos(self,encoder,format,large,quality,files,dir):
-        """ Kick off the first FTP thread and show a progress dialog
+    def addVideos(self,encoder,format,large,quality,files,dir,segmented=False,priority=0):
+        """ Kick off a few upload threads to send the videos to the central server and show a
+            progress dialog. Each video is added as a task as soon as it's arrived
         """
-        self.pendingSends = zip([dir]*len(files),files)
-        if not self.pendingSends:
+        if not files:
             return
-        args = [self.createSettings(encoder,format,large,quality)] + list(self.pendingSends[0])
-        self.currThread = threading.Thread(target=self.threadedSend,args=args)
-        self.currThread.start()
+        settings = self.createSettings(encoder,format,large,quality,segmented,priority)
+        self.needCancel = False
+        self.pendingSends = Queue.Queue()
+        self.sendProgress = {}
+        self.toAdd = []
+        self.workingFailed = []
         self.workingTotal = 0
-        self.workingDiag = wx.ProgressDialog('Transfering','Transfering videos to central server',len(files),self,style=wx.PD_ELAPSED_TIME|wx.PD_SMOOTH|wx.PD_AUTO_HIDE)
+        self.workingFiles = len(files)
+        self.workingSent = 0
+        self.workingBytes = 0
+        for vid in files:
+            self.pendingSends.put((dir,vid))
+            self.workingBytes += os.path.getsize(os.path.join(dir,vid))
+        self.sendThreads = min(upload_workers,len(files))
+        for i in xrange(self.sendThreads):
+            thread = threading.Thread(target=self.threadedSend,args=[settings],name='Upload-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+        # Leave room in the message for a line per upload thread
+        message = 'Transfering videos to central server' + '\n' * (self.sendThreads + 1)
+        self.workingDiag = wx.ProgressDialog('Transfering',message,1000,self,style=wx.PD_ELAPSED_TIME|wx.PD_SMOOTH|wx.PD_AUTO_HIDE|wx.PD_CAN_ABORT)
+        self.workingTimer.Start(250)
         self.workingDiag.ShowModal()
 
     def getClosestRow(self,row):
@@ -565,7 +656,7 @@ class EncoderFrame(wx.Frame):
         """ Cancel selected pending/active tasks from the server
         """
         for task in self.taskList.getRows(self.taskList.GetSelectedRows()):
-            if task[1] in ['Pending','Encoding']:
+            if task[1] in ['Pending','Reserved','Encoding']:
                 if not self.central.cancelTask(task[0]):
                     wx.MessageBox('Could not cancel task, did it finish already?','Error',style=wx.OK|wx.ICON_WARNING)
                     break
@@ -590,58 +681,197 @@ class EncoderFrame(wx.Frame):
         diag = addEncodeDialog(self)
         diag.ShowModal()
     
-    def threadDone(self,settings,vid,evt=None):
+    def threadDone(self,settings,vid,size,digest,cancelled=False,evt=None):
+        """
+            Called by an upload thread each time it's done with a video, if it made it
+            to the central server it's queued up to be added
+        """
+        with self.sendLock:
+            self.sendProgress.pop(vid,None)
+        self.workingTotal += 1
+        self.workingSent += size
+        if digest is False:
+            self.workingFailed.append(vid)
+        elif not cancelled:
+            spec = dict(settings)
+            spec.update(name=vid,digest=digest)
+            self.toAdd.append(spec)
+
+    def workerDone(self,evt=None):
         """
-            Called by FTP thread upon completion, if we have more videos to send
-            kick off the next thread and update the progress dialog so the user knows
-            what's going on
+            Called by each upload thread as it exits, once they're all gone add whatever's
+            left, close the progress dialog and let the user know if anything went wrong
         """
-        # TODO -- This is where we need to check for a signal that a cancellation has been requested
-        self.currThread.join()
-        self.currThread = None
-        self.central.addTask(vid,**settings)
-        del self.pendingSends[0]
+        self.sendThreads -= 1
+        if self.sendThreads:
+            return
+        self.workingTimer.Stop()
+        self.flushAdds()
         if self.workingDiag.IsShown():
-            self.workingTotal += 1
-            self.workingDiag.Update(self.workingTotal)
-            if not self.pendingSends:
-                self.workingDiag.EndModal(wx.ID_OK)
-            else:
-                args = [settings] + list(self.pendingSends[0])
-                self.currThread = threading.Thread(target=self.threadedSend,args=args)
-                self.currThread.start()
-                
-    def threadedSend(self,settings,dir,vid):
+            self.workingDiag.EndModal(wx.ID_OK)
+        self.workingDiag.Destroy()
+        if self.workingFailed:
+            wx.MessageBox('Could not add {0}'.format(', '.join(self.workingFailed)),'Error',style=wx.OK|wx.ICON_WARNING)
+
+    def flushAdds(self):
+        """
+            Add every video which has arrived since last time with one call to the central server
+        """
+        if not self.toAdd:
+            return
+        batch,self.toAdd = self.toAdd,[]
+        try:
+            self.workingFailed.extend(self.central.addTasks(batch))
+        except Exception:
+            self.workingFailed.extend(spec['name'] for spec in batch)
+
+    def updateWorking(self,evt=None):
+        """
+            Runs every quarter second while videos are being added, adds whatever has arrived
+            and updates the progress dialog
         """
-            Fire up an FTP connection to the central server
-            and upload the videos from the localhost that need
-            to be encoded
+        self.flushAdds()
+        with self.sendLock:
+            progress = self.sendProgress.items()
+        sent = self.workingSent + sum(done for vid,(done,size) in progress)
+        lines = ['Sent {0} of {1} videos'.format(self.workingTotal,self.workingFiles)]
+        for vid,(done,size) in sorted(progress):
+            lines.append('{0} {1}%'.format(vid,100 * done // max(size,1)))
+        # Keep the dialog's maximum for when everything's done, otherwise it hides itself early
+        value = min(999,1000 * sent // max(self.workingBytes,1))
+        keepGoing = self.workingDiag.Update(value,'\n'.join(lines))
+        # Newer wx versions return (keepGoing,skip)
+        if isinstance(keepGoing,tuple):
+            keepGoing = keepGoing[0]
+        if not keepGoing:
+            self.needCancel = True
+
+    def threadedSend(self,settings):
         """
-        ftp = FTP()
-        ftp.connect(ftp_host,ftp_port)
-        ftp.login(ftp_user, ftp_pass)
-        if not dir.endswith(os.sep):
-            dir += os.sep
-        ftp.storbinary('STOR {0}'.format(vid),open(os.path.join(dir,vid),'rb'))
-        wx.CallAfter(self.threadDone,settings,vid)
+            Upload thread, sends videos from the localhost that
+            need to be encoded to the central server until there
+            are none left or the user cancels. In shared mode
+            they're copied straight into the master dir (or left
+            alone if they're already there). Dropped transfers are
+            resumed and the video's sha1 goes along with the task
+        """
+        storage = getStorage()
+        while not self.needCancel:
+            try:
+                dir,vid = self.pendingSends.get_nowait()
+            except Queue.Empty:
+                break
+            path = os.path.join(dir,vid)
+            size = 0
+            def progress(done):
+                if self.needCancel:
+                    raise TransferCancelled()
+                with self.sendLock:
+                    self.sendProgress[vid] = (done,size)
+            try:
+                size = os.path.getsize(path)
+                digest = storage.put(path,vid,progress)
+                wx.CallAfter(self.threadDone,settings,vid,size,digest)
+            except TransferCancelled:
+                wx.CallAfter(self.threadDone,settings,vid,size,None,True)
+            except Exception:
+                wx.CallAfter(self.threadDone,settings,vid,size,False)
+        wx.CallAfter(self.workerDone)
     
-    def getData(self):
+    def getRow(self,task,name,status):
         """
-            Grab the list of tasks from the central server and put them into a more
-            grid friendly form factor
+            Put a task into a more grid friendly form factor
         """
-        tasks = self.central.getTasks()
-        data = []
-        for task,name,status in tasks.values():
-            row = [task.getName(),status,name,str(task.getCompleted()),task.getStarted() or ' ',task.getFinished() or ' ',task.getAdded()]
-            data.append(row)
-        return data
+        return [task.getName(),status,name,str(task.getCompleted()),self.getEta(task,status),formatTime(task.getStarted()),formatTime(task.getFinished()),formatTime(task.getAdded())]
+
+    def getEta(self,task,status):
+        """
+            How long until a task's done, the server smooths out running tasks' ETAs and sends them with
+            the task's progress, anything else comes from the last forecast
+        """
+        if status in ('Finished','Cancelled','Error'):
+            return ' '
+        if status == 'Encoding' and task.getEta() is not None:
+            return formatEta(task.getEta())
+        return formatEta(self.forecast['tasks'].get(task.getName()))
+
+    def watchTasks(self):
+        """
+            Runs on its own thread, waits on the central server for tasks to change and hands
+            the changes to the GUI thread. This gets its own proxy so it doesn't hold up the
+            GUI's calls to the server while it waits
+        """
+        central = Pyro4.Proxy('PYRONAME:central.encoding@{0}:{1}'.format(pyro_host,pyro_port))
+        while True:
+            try:
+                asked = time.time()
+                revision,changed,removed = central.getTaskChanges(self.revision,30)
+            except Exception:
+                # Server's probably restarting, give it a few seconds
+                time.sleep(4)
+                continue
+            if revision == self.revision and time.time() - asked < 30:
+                # The server didn't wait for us, don't hammer it
+                time.sleep(2)
+            if revision != self.revision:
+                wx.CallAfter(self.applyChanges,revision,changed,removed)
+                # Next time round we only want what's changed since this lot
+                self.revision = revision
+
+    def watchForecast(self):
+        """
+            Runs on its own thread, asks the central server for its forecast every forecast_interval
+            seconds and hands it to the GUI thread
+        """
+        central = Pyro4.Proxy('PYRONAME:central.encoding@{0}:{1}'.format(pyro_host,pyro_port))
+        while True:
+            try:
+                wx.CallAfter(self.applyForecast,central.getForecast())
+            except Exception:
+                pass
+            time.sleep(forecast_interval)
+
+    def applyForecast(self,forecast):
+        """
+            Show a new forecast, only rows whose ETA reads differently are touched
+        """
+        old = self.forecast['tasks']
+        self.forecast = forecast
+        rows = {}
+        for name,eta in forecast['tasks'].iteritems():
+            if formatEta(old.get(name)) != formatEta(eta) and name in self.tasks:
+                rows[name] = self.getRow(*self.tasks[name])
+        if rows:
+            self.taskList.ApplyChanges(rows,[])
+        drain = forecast['drain']
+        if drain is None:
+            self.SetStatusText('Queue finishes: unknown')
+        elif not drain:
+            self.SetStatusText('Queue empty')
+        else:
+            finish = time.strftime('%H:%M',time.localtime(time.time() + drain))
+            self.SetStatusText('Queue finishes in {0} (around {1})'.format(formatEta(drain),finish))
+
+    def applyChanges(self,revision,changed,removed):
+        """
+            Push task changes from the central server to the grid
+        """
+        if removed is None:
+            self.tasks = {}
+        else:
+            for name in removed:
+                self.tasks.pop(name,None)
+        self.tasks.update(changed)
+        rows = dict((name,self.getRow(*info)) for name,info in changed.iteritems())
+        self.taskList.ApplyChanges(rows,removed)
 
     def refreshList(self,evt=None):
         """
-            Push the latest task info to the grid
+            Pull the whole task list from the central server and push it to the grid
         """
-        self.taskList.SetData(self.getData())
+        revision,tasks,removed = self.central.getTaskChanges(0)
+        self.revision = revision
+        self.applyChanges(revision,tasks,None)
 
 class EncoderApp(wx.App):
     def OnInit(self):
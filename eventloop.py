@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+import time
+import heapq
+import errno
+import select
+import asyncore
+import logging
+import threading
+import itertools
+import Queue
+
+class WorkerPool(object):
+    """ A fixed set of threads for blocking work (disk, ffmpeg) so it doesn't hold up the event loop
+            - At most limit jobs wait for a thread, submit turns anything more away rather than letting
+              the backlog grow without end, so the caller can push back on whoever is giving it work
+    """
+    def __init__(self,threads,limit):
+        self.jobs = Queue.Queue(limit)
+        self.threads = []
+        for i in xrange(threads):
+            thread = threading.Thread(target=self.work,name='Offload-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self,function,*args):
+        """ Queue function(*args) for one of the threads, False if too much is waiting already """
+        try:
+            self.jobs.put_nowait((function,args))
+            return True
+        except Queue.Full:
+            return False
+
+    def backlog(self):
+        return self.jobs.qsize()
+
+    def work(self):
+        while True:
+            function,args = self.jobs.get()
+            try:
+                function(*args)
+            except Exception:
+                logging.exception('Offloaded job failed')
+
+# Most sockets a single select looks at when it's all we've got (Windows stops at 512)
+select_chunk = 500
+
+class EventLoop(object):
+    """ Runs everything the central server serves off a single poll (or select) loop on one thread
+            - Pyro daemons, which have to be created with Pyro4.config.SERVERTYPE = 'multiplex'
+            - asyncore dispatchers (the FTP server), their sockets wake the loop up and pollers
+              added with addPoller are called every time round to handle them
+            - Anything else with a fileno, added with addReader along with what to call when it's readable
+            - Timers, see callLater
+        Whatever it calls has to be quick, anything slow goes to the pool
+    """
+    def __init__(self,threads,limit):
+        self.daemons = []
+        self.readers = {}
+        self.pollers = []
+        # (when,tie breaker,function,args)
+        self.timers = []
+        self.counter = itertools.count()
+        self.pool = WorkerPool(threads,limit)
+        # The longest the loop sleeps for, pollers get called at least this often
+        self.tick = 1.0
+
+    def addDaemon(self,daemon):
+        self.daemons.append(daemon)
+
+    def addReader(self,source,callback):
+        self.readers[source] = callback
+
+    def addPoller(self,poller):
+        self.pollers.append(poller)
+
+    def callLater(self,delay,function,*args):
+        """ Call function(*args) on the loop in delay seconds """
+        heapq.heappush(self.timers,(time.time() + delay,next(self.counter),function,args))
+
+    def runTimers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when,_,function,args = heapq.heappop(self.timers)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception('Timer failed')
+
+    def wait(self):
+        """ How long poll can sleep for before the next timer is due """
+        if not self.timers:
+            return self.tick
+        return max(0.0,min(self.tick,self.timers[0][0] - time.time()))
+
+    def step(self):
+        """ Go round the loop once """
+        self.runTimers()
+        owners = {}
+        readers = list(self.readers)
+        for daemon in self.daemons:
+            for sock in daemon.sockets:
+                owners[sock] = daemon
+                readers.append(sock)
+        writers = []
+        for dispatcher in asyncore.socket_map.values():
+            if dispatcher.readable():
+                readers.append(dispatcher)
+            if dispatcher.writable():
+                writers.append(dispatcher)
+        try:
+            readable,writable = self.poll(readers,writers,self.wait())
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        ready = {}
+        for source in readable:
+            if source in owners:
+                ready.setdefault(owners[source],[]).append(source)
+            elif source in self.readers:
+                try:
+                    self.readers[source]()
+                except Exception:
+                    logging.exception('Unable to handle {0}'.format(source))
+        for daemon,socks in ready.items():
+            try:
+                daemon.events(socks)
+            except Exception:
+                logging.exception('Pyro daemon failed to handle a request')
+        for poller in self.pollers:
+            try:
+                poller()
+            except Exception:
+                logging.exception('Poller failed')
+
+    def poll(self,readers,writers,timeout):
+        """ (readable,writable) out of readers and writers, waiting up to timeout seconds for one of them.
+            select can't take sockets numbered past FD_SETSIZE (1024), which a big farm gets to, so it's
+            only used where there's no poll
+        """
+        if not hasattr(select,'poll'):
+            return self.select(readers,writers,timeout)
+        sources = {}
+        events = {}
+        for mask,group in ((select.POLLIN|select.POLLPRI,readers),(select.POLLOUT,writers)):
+            for source in group:
+                fd = source.fileno()
+                sources[fd] = source
+                events[fd] = events.get(fd,0) | mask
+        poller = select.poll()
+        for fd,mask in events.iteritems():
+            poller.register(fd,mask)
+        readable = []
+        writable = []
+        for fd,event in poller.poll(timeout * 1000):
+            # A socket which hung up or failed wakes whoever's watching it, so they find out on the next call
+            if event & (select.POLLIN|select.POLLPRI|select.POLLHUP|select.POLLERR) and events[fd] & select.POLLIN:
+                readable.append(sources[fd])
+            if event & (select.POLLOUT|select.POLLHUP|select.POLLERR) and events[fd] & select.POLLOUT:
+                writable.append(sources[fd])
+        return readable,writable
+
+    def select(self,readers,writers,timeout):
+        """ poll for where there's only select """
+        try:
+            return select.select(readers,writers,[],timeout)[:2]
+        except ValueError:
+            pass
+        # More sockets than one select takes, rather than let the loop die go through them a chunk at a
+        # time without waiting, then rest a moment if none of them were ready
+        readable = []
+        writable = []
+        for i in xrange(0,max(len(readers),len(writers)),select_chunk):
+            someReaders = readers[i:i + select_chunk]
+            someWriters = writers[i:i + select_chunk]
+            try:
+                found = select.select(someReaders,someWriters,[],0)
+            except ValueError:
+                # One of them is numbered past what select takes at all, it waits until enough sockets
+                # ahead of it close but the rest are looked at one at a time
+                found = ([source for source in someReaders if self.ready([source],[])],
+                         [source for source in someWriters if self.ready([],[source])])
+            readable.extend(found[0])
+            writable.extend(found[1])
+        if not readable and not writable:
+            time.sleep(min(timeout,0.05))
+        return readable,writable
+
+    def ready(self,readers,writers):
+        """ Is anything in readers or writers ready right now, False if select can't take them """
+        try:
+            return any(select.select(readers,writers,[],0)[:2])
+        except ValueError:
+            return False
+
+    def run(self):
+        while True:
+            self.step()
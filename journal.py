@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+import os
+import struct
+import logging
+import threading
+import cPickle as pickle
+from encoder_cfg import journal_interval, journal_compact
+
+# Every record in the log is its length followed by the pickle
+header = struct.Struct('!I')
+
+class JournalError(Exception):
+    """ What sync was waiting on couldn't be written """
+    pass
+
+def fsyncDir(path):
+    """ Make a rename in path stick, not every platform lets you open a dir """
+    try:
+        fd = os.open(path,os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def writeFile(path,data):
+    """ Replace a file in one go, a crash leaves either the old one or the new one """
+    partial = path + '.tmp'
+    with open(partial,'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(path):
+        # Windows won't rename over an existing file
+        os.unlink(path)
+    os.rename(partial,path)
+    fsyncDir(os.path.dirname(path))
+
+class Journal(object):
+    """ Keeps the central server's task buckets on disk so a restart picks up where it left off
+            - The server marks tasks dirty whenever they change, a writer thread wakes up every
+              journal_interval seconds and appends the current state of everything dirty to the log
+              with a single fsync (group commit), so changes never wait on the disk
+            - Callers which have to know their change is on disk (i.e. adding tasks) can wait on sync
+            - A write which fails is tried again next time round, anyone waiting on it is told
+            - Once the log has more than journal_compact task states in it the whole state is written out
+              as a snapshot and the log starts again, so a restart only ever reads one snapshot and a
+              bounded log
+            - The snapshot and log carry a generation number, a log left over from before the latest
+              snapshot is ignored
+    """
+    def __init__(self,root):
+        self.root = root
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.snapshotPath = os.path.join(self.root,'snapshot')
+        self.logPath = os.path.join(self.root,'log')
+        self.generation = 0
+        self.log = None
+        self.logRecords = 0
+        # Names of the tasks which changed since the last write
+        self.dirty = set()
+        # How many times something has been marked dirty, and how many of those are on disk
+        self.marked = 0
+        self.synced = 0
+        # How many writes have failed, so sync can tell if one failed while it waited
+        self.failures = 0
+        # How many callers are stuck in sync, the writer doesn't hang about if anyone's waiting
+        self.waiting = 0
+        self.cond = threading.Condition()
+        self.server = None
+
+    def load(self):
+        """ Read the snapshot and the log, returns (revision,states) where states maps task name ->
+            (bucket name,bucket entry)
+        """
+        revision = 0
+        states = {}
+        if os.path.exists(self.snapshotPath):
+            with open(self.snapshotPath,'rb') as f:
+                self.generation,revision,states = pickle.load(f)
+        if os.path.exists(self.logPath):
+            with open(self.logPath,'rb') as f:
+                data = f.read()
+            offset = 0
+            generation = None
+            while offset + header.size <= len(data):
+                length, = header.unpack_from(data,offset)
+                end = offset + header.size + length
+                if end > len(data):
+                    # We died half way through writing this one
+                    break
+                record = pickle.loads(data[offset + header.size:end])
+                offset = end
+                if generation is None:
+                    generation = record
+                    if generation != self.generation:
+                        logging.info('Ignoring journal log from before the snapshot')
+                        break
+                    continue
+                revision,changes = record
+                for name,state in changes:
+                    if state is None:
+                        states.pop(name,None)
+                    else:
+                        states[name] = state
+        logging.info('Journal holds {0} tasks'.format(len(states)))
+        return revision,states
+
+    def start(self,server,revision,states):
+        """ Start journaling for server, compacting whatever load gave us first so the log starts
+            out empty
+        """
+        self.server = server
+        self.compact(revision,states)
+        self.writer = threading.Thread(target=self.writeLoop,name='Journal')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def mark(self,name):
+        """ Note that a task has changed, the writer will pick up its current state """
+        with self.cond:
+            self.dirty.add(name)
+            self.marked += 1
+
+    def sync(self):
+        """ Wait until everything marked so far is on disk, don't call this holding the server's lock.
+            Raises JournalError if a write fails first
+        """
+        with self.cond:
+            target = self.marked
+            failures = self.failures
+            self.waiting += 1
+            self.cond.notifyAll()
+            try:
+                while self.synced < target:
+                    if self.failures != failures:
+                        raise JournalError('Unable to write the journal')
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+
+    def writeLoop(self):
+        failed = False
+        while True:
+            with self.cond:
+                # A failing disk gets a rest between goes even if callers are waiting
+                if failed or not self.waiting:
+                    self.cond.wait(journal_interval)
+                names = self.dirty
+                self.dirty = set()
+                target = self.marked
+            failed = False
+            if names:
+                try:
+                    revision,changes = self.server.journalStates(names)
+                    self.append((revision,changes))
+                    if self.logRecords > journal_compact:
+                        self.compact(*self.server.journalSnapshot())
+                except Exception:
+                    logging.exception('Unable to write the journal')
+                    failed = True
+            with self.cond:
+                if failed:
+                    # None of it can be counted on, write it all again next time
+                    self.dirty |= names
+                    self.failures += 1
+                else:
+                    self.synced = max(self.synced,target)
+                self.cond.notifyAll()
+
+    def append(self,record):
+        revision,changes = record
+        data = pickle.dumps(record,pickle.HIGHEST_PROTOCOL)
+        self.log.write(header.pack(len(data)) + data)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.logRecords += len(changes)
+
+    def compact(self,revision,states):
+        """ Write the whole state out as a new snapshot and start a fresh log """
+        self.generation += 1
+        writeFile(self.snapshotPath,pickle.dumps((self.generation,revision,states),pickle.HIGHEST_PROTOCOL))
+        data = pickle.dumps(self.generation,pickle.HIGHEST_PROTOCOL)
+        writeFile(self.logPath,header.pack(len(data)) + data)
+        if self.log:
+            self.log.close()
+        self.log = open(self.logPath,'ab')
+        self.logRecords = 0
+        logging.info('Journal compacted, {0} tasks'.format(len(states)))
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+import os
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+# Default histogram buckets, in seconds
+default_buckets = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)
+
+def escape(value):
+    return str(value).replace('\\','\\\\').replace('\n','\\n').replace('"','\\"')
+
+def formatNumber(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def formatLabels(names,values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name,escape(value)) for name,value in zip(names,values)) + '}'
+
+class Metric(object):
+    """ A named metric with optional labels, each distinct set of label values is its own series """
+    kind = None
+
+    def __init__(self,name,help,labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        # label values -> value
+        self.values = {}
+
+    def key(self,labels):
+        return tuple(str(labels.get(name,'')) for name in self.labels)
+
+    def samples(self):
+        """ (suffix,label names,label values,value) for every series """
+        with self.lock:
+            return [('',self.labels,key,value) for key,value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name,self.help),'# TYPE {0} {1}'.format(self.name,self.kind)]
+        for suffix,names,values,value in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(self.name,suffix,formatLabels(names,values),formatNumber(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """ Only ever goes up """
+    kind = 'counter'
+
+    def inc(self,amount=1,**labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key,0) + amount
+
+class Gauge(Metric):
+    """ Goes up and down. Given a function it's worked out when scraped instead, the function returns
+        the value, or a dict of label values -> value if the gauge has labels
+    """
+    kind = 'gauge'
+
+    def __init__(self,name,help,labels=(),function=None):
+        Metric.__init__(self,name,help,labels)
+        self.function = function
+
+    def set(self,value,**labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self,amount=1,**labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key,0) + amount
+
+    def dec(self,amount=1,**labels):
+        self.inc(-amount,**labels)
+
+    def samples(self):
+        if not self.function:
+            return Metric.samples(self)
+        values = self.function()
+        if not self.labels:
+            values = {():values}
+        return [('',self.labels,tuple(str(x) for x in (key if isinstance(key,tuple) else (key,))),value)
+                for key,value in sorted(values.items()) if value is not None]
+
+class CallbackCounter(Gauge):
+    """ A counter whose running total is kept somewhere else, worked out when scraped """
+    kind = 'counter'
+
+class Histogram(Metric):
+    """ Counts observations into buckets, plus their sum and count """
+    kind = 'histogram'
+
+    def __init__(self,name,help,labels=(),buckets=default_buckets):
+        Metric.__init__(self,name,help,labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self,value,**labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.setdefault(key,[[0] * len(self.buckets),0.0,0])
+            entry[0][bisect.bisect_left(self.buckets,value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key,(counts,total,count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound,hits in zip(self.buckets,counts):
+                    cumulative += hits
+                    samples.append(('_bucket',self.labels + ('le',),key + (formatNumber(bound),),cumulative))
+                samples.append(('_sum',self.labels,key,total))
+                samples.append(('_count',self.labels,key,count))
+        return samples
+
+class Registry(object):
+    """ Every metric a process exposes, rendered in the Prometheus text format """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self,metric):
+        # Registering a name again replaces the old one, i.e. when the server object is recreated
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self,name,help,labels=()):
+        return self.register(Counter(name,help,labels))
+
+    def gauge(self,name,help,labels=(),function=None):
+        return self.register(Gauge(name,help,labels,function))
+
+    def callbackCounter(self,name,help,labels=(),function=None):
+        return self.register(CallbackCounter(name,help,labels,function))
+
+    def histogram(self,name,help,labels=(),buckets=default_buckets):
+        return self.register(Histogram(name,help,labels,buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(),key=lambda metric: metric.name)
+        output = []
+        for metric in metrics:
+            try:
+                output.append(metric.render())
+            except Exception:
+                logging.exception('Unable to render {0}'.format(metric.name))
+        return '\n'.join(output) + '\n'
+
+# Shared by everything in the process
+registry = Registry()
+registry.callbackCounter('process_cpu_seconds_total','CPU seconds used by this process',function=lambda: sum(os.times()[:2]))
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/','/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        # Scrapes come in every few seconds, they'd drown out everything else
+        pass
+
+def serve(port,host='',thread=True):
+    """ Serve the registry on http://host:port/metrics from a background thread, None turns it off.
+        Without a thread whoever called this has to call handle_request on the server whenever it's readable
+    """
+    if port is None:
+        return None
+    try:
+        server = BaseHTTPServer.HTTPServer((host,port),MetricsHandler)
+    except Exception:
+        logging.exception('Unable to serve metrics on port {0}'.format(port))
+        return None
+    if not thread:
+        return server
+    thread = threading.Thread(target=server.serve_forever,name='Metrics')
+    thread.daemon = True
+    thread.start()
+    return server
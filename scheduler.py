@@ -0,0 +1,372 @@
+#!/usr/bin/python
+
+import heapq
+import bisect
+import itertools
+import collections
+import time
+import threading
+from encoder_cfg import aging_interval, lease_time, schedule_mode, eta_window, eta_history
+
+class TaskQueue(object):
+    """ Heap backed queue of pending task names
+            - Higher priority tasks come out first, ties go to whichever was added first
+            - Waiting tasks age, every aging_interval seconds spent in the queue is worth
+              one priority level, so low priority work is never starved forever
+            - Removal is lazy, the heap entry is just marked dead and skipped when it surfaces
+
+        In 'lpt' mode (longest processing time first) it works off a second list which keeps the
+        tasks sorted by priority then estimated cost, biggest first. Each encoder is handed the task
+        that matches how fast it is, the fastest gets the biggest job of the top priority and the
+        slowest the smallest, so the long jobs aren't left stuck on slow boxes at the end of the
+        queue. There's no aging in this mode. Keeping that list sorted costs O(n) a push or pop, so
+        it's only kept while in lpt mode and built from scratch when switching to it (see setMode).
+    """
+    def __init__(self,aging=aging_interval,mode=schedule_mode):
+        self.aging = aging
+        self.mode = mode
+        self.heap = []
+        # name -> live heap entry
+        self.entries = {}
+        # Tie breaker so the heap never has to compare names
+        self.counter = itertools.count()
+        # name -> (-priority,-cost,added,name) for every queued task, and in lpt mode all of them sorted
+        self.rankings = {}
+        self.ranked = []
+
+    def key(self,task):
+        # Every waiting task ages at the same rate so aging never changes the relative order of two
+        # tasks, that means it can be baked into a fixed key instead of re-sorting as time passes
+        added = task.getAdded()
+        if self.aging:
+            return added - task.getPriority() * self.aging
+        return (-task.getPriority(),added)
+
+    def push(self,task):
+        self.remove(task.getName())
+        entry = [self.key(task),next(self.counter),task.getName()]
+        self.entries[task.getName()] = entry
+        heapq.heappush(self.heap,entry)
+        ranking = (-task.getPriority(),-(task.getCost() or 0),task.getAdded(),task.getName())
+        self.rankings[task.getName()] = ranking
+        if self.mode == 'lpt':
+            bisect.insort(self.ranked,ranking)
+
+    def remove(self,name):
+        entry = self.entries.pop(name,None)
+        if entry:
+            entry[-1] = None
+            self.unrank(name)
+            # Don't let dead entries pile up if lots of tasks are cancelled
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [x for x in self.heap if x[-1] is not None]
+                heapq.heapify(self.heap)
+            return True
+        return False
+
+    def peek(self):
+        while self.heap and self.heap[0][-1] is None:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][-1]
+        return None
+
+    def unrank(self,name):
+        ranking = self.rankings.pop(name)
+        if self.mode == 'lpt':
+            del self.ranked[bisect.bisect_left(self.ranked,ranking)]
+
+    def setMode(self,mode):
+        """ Switch between 'fifo' and 'lpt' """
+        if mode == 'lpt' and self.mode != 'lpt':
+            self.ranked = sorted(self.rankings.values())
+        elif mode != 'lpt':
+            self.ranked = []
+        self.mode = mode
+
+    def pop(self,rank=0.0):
+        """ Take the name of the next task to run off the queue, None if the queue is empty. In lpt mode
+            rank says how fast the encoder asking is compared to the others, 0 for the fastest up to 1 for
+            the slowest
+        """
+        if self.mode == 'lpt':
+            if not self.ranked:
+                return None
+            # Only the top priority tasks are in the running
+            top = self.ranked[0][0]
+            end = bisect.bisect_left(self.ranked,(top,float('inf')))
+            name = self.ranked[int(round(rank * (end - 1)))][-1]
+            self.remove(name)
+            return name
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            name = entry[-1]
+            if name is not None:
+                del self.entries[name]
+                self.unrank(name)
+                return name
+        return None
+
+    def ordered(self):
+        """ Every queued task name, in roughly the order they'll be handed out """
+        if self.mode == 'lpt':
+            return [ranking[-1] for ranking in self.ranked]
+        return [entry[-1] for entry in sorted(self.heap) if entry[-1] is not None]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self,name):
+        return name in self.entries
+
+class TaskStore(object):
+    """ Every task the central server knows about, keyed by name, along with the state it's in and the
+        encoder it's with (None for tasks which aren't with one)
+            - Each state has an index of its own so listing or counting the tasks in a state never
+              looks at the rest
+            - Moving a task is a single O(1) step under the lock, and can be made conditional on the
+              state it's in now so two threads can't both move the same task (i.e. hand it to two
+              encoders, or finish it and requeue it)
+            - The lock is re-entrant and the server shares it, so a caller can hold it over a few steps
+              which have to happen together
+    """
+    states = ('pending','encoding','reserved','segmented','joining','finished','error','cancel')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # name -> state
+        self.current = {}
+        # state -> {name: (task,encoder)}
+        self.indexes = dict((state,{}) for state in self.states)
+
+    def add(self,task,state,encoder=None):
+        """ Put a task into state, wherever it was before """
+        name = task.getName()
+        with self.lock:
+            old = self.current.get(name)
+            if old is not None:
+                del self.indexes[old][name]
+            self.current[name] = state
+            self.indexes[state][name] = (task,encoder)
+
+    def expected(self,state,expect):
+        if expect is None:
+            return True
+        if isinstance(expect,basestring):
+            return state == expect
+        return state in expect
+
+    def move(self,name,state,encoder=None,expect=None):
+        """ Move a task into state with encoder, returns the task. If expect (a state or tuple of
+            states) is given the task is only moved if it's in one of them, otherwise None is returned
+        """
+        with self.lock:
+            old = self.current.get(name)
+            if old is None or not self.expected(old,expect):
+                return None
+            task,_ = self.indexes[old].pop(name)
+            self.current[name] = state
+            self.indexes[state][name] = (task,encoder)
+            return task
+
+    def remove(self,name,expect=None):
+        """ Forget about a task, returns it, or None if it isn't there (or not in expect, see move) """
+        with self.lock:
+            old = self.current.get(name)
+            if old is None or not self.expected(old,expect):
+                return None
+            del self.current[name]
+            return self.indexes[old].pop(name)[0]
+
+    def get(self,name):
+        """ (state,task,encoder) for a task, None if it isn't there """
+        with self.lock:
+            state = self.current.get(name)
+            if state is None:
+                return None
+            return (state,) + self.indexes[state][name]
+
+    def state(self,name):
+        return self.current.get(name)
+
+    def task(self,name):
+        entry = self.get(name)
+        return entry[1] if entry else None
+
+    def encoder(self,name):
+        entry = self.get(name)
+        return entry[2] if entry else None
+
+    def entries(self,state):
+        """ (task,encoder) for every task in state """
+        with self.lock:
+            return self.indexes[state].values()
+
+    def names(self,state=None):
+        """ The names of the tasks in state, or of every task """
+        with self.lock:
+            if state is None:
+                return self.current.keys()
+            return self.indexes[state].keys()
+
+    def count(self,*states):
+        """ How many tasks are in any of states """
+        with self.lock:
+            return sum(len(self.indexes[state]) for state in states)
+
+    def counts(self):
+        """ state -> how many tasks are in it """
+        with self.lock:
+            return dict((state,len(index)) for state,index in self.indexes.items())
+
+    def __contains__(self,name):
+        return name in self.current
+
+    def __len__(self):
+        return len(self.current)
+
+class Leases(object):
+    """ Tracks how long each encoder has left on the tasks it's been given
+            - Handing out a task grants a lease, every progress report from the encoder renews it
+            - Leases which run out without being renewed mean the encoder has gone away
+            - Renewing only bumps the deadline, the heap entry is moved along when it surfaces, so
+              checking for expired leases only ever touches the ones which are actually due
+    """
+    def __init__(self,length=lease_time):
+        self.length = length
+        self.heap = []
+        # name -> current deadline
+        self.deadlines = {}
+
+    def grant(self,name,now=None):
+        deadline = (now or time.time()) + self.length
+        self.deadlines[name] = deadline
+        heapq.heappush(self.heap,(deadline,name))
+
+    def renew(self,name,now=None):
+        if name in self.deadlines:
+            self.deadlines[name] = (now or time.time()) + self.length
+        else:
+            self.grant(name,now)
+
+    def release(self,name):
+        self.deadlines.pop(name,None)
+
+    def expired(self,now=None):
+        """ Names of the tasks whose leases have run out, they're forgotten about once returned """
+        now = now or time.time()
+        names = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline,name = heapq.heappop(self.heap)
+            current = self.deadlines.get(name)
+            if current is None:
+                # Released
+                continue
+            if current > now:
+                # Renewed since, go back in line
+                heapq.heappush(self.heap,(current,name))
+                continue
+            del self.deadlines[name]
+            names.append(name)
+        return names
+
+    def __contains__(self,name):
+        return name in self.deadlines
+
+class ProgressHistory(object):
+    """ The last eta_window seconds of progress reports for every running task, used to work out when
+        each one will be done
+            - The ETA goes by how far the percentage has moved over the whole window rather than by
+              handbrake's own ETA, which jumps about with the speed of the last few frames. Until there
+              are two reports to go on handbrake's ETA is used as it is
+            - The ETA given as a task passes each 10% is remembered, once the task finishes they're
+              compared with when it really finished so the forecast's accuracy can be checked
+    """
+    def __init__(self,window=eta_window,history=eta_history):
+        self.window = window
+        # name -> deque of (time,percent completed)
+        self.samples = {}
+        # name -> the task's smoothed ETA in seconds as of its last report, and when that was
+        self.etas = {}
+        # name -> [(percent completed,predicted finish time)]
+        self.predictions = {}
+        # How the predictions for the last few finished tasks turned out
+        self.errors = collections.deque(maxlen=history)
+
+    def record(self,name,completed,eta=None,now=None):
+        """ Add a progress report, returns the task's smoothed ETA in seconds (None if there's nothing to go on) """
+        now = now or time.time()
+        try:
+            completed = float(completed or 0)
+        except ValueError:
+            completed = 0.0
+        samples = self.samples.get(name)
+        if samples is None or (samples and completed < samples[-1][1]):
+            # New, or it's been started over
+            samples = self.samples[name] = collections.deque()
+            self.predictions[name] = []
+        samples.append((now,completed))
+        # Keep one report from before the window so the window's always covered
+        while len(samples) > 2 and samples[1][0] <= now - self.window:
+            samples.popleft()
+        (start,first),(end,last) = samples[0],samples[-1]
+        if end > start and last > first:
+            eta = (100 - last) * (end - start) / (last - first)
+        self.etas[name] = (eta,now)
+        checkpoint = int(completed // 10) * 10
+        predictions = self.predictions[name]
+        if eta is not None and (not predictions or predictions[-1][0] < checkpoint):
+            predictions.append((checkpoint,now + eta))
+        return eta
+
+    def rate(self,name):
+        """ Percent a second a running task has got through over the window, None until there are two
+            reports to go on
+        """
+        samples = self.samples.get(name)
+        if not samples or len(samples) < 2:
+            return None
+        (start,first),(end,last) = samples[0],samples[-1]
+        if end <= start:
+            return None
+        return (last - first) / (end - start)
+
+    def eta(self,name,now=None):
+        """ Seconds until a running task should be done, None if we don't know """
+        eta,when = self.etas.get(name,(None,None))
+        if eta is None:
+            return None
+        return max(0.0,eta - ((now or time.time()) - when))
+
+    def finish(self,name,encoder,now=None):
+        """ A task we've been following is done, note how far out each of its ETAs was (positive means
+            it took longer than predicted)
+        """
+        now = now or time.time()
+        predictions = self.predictions.get(name)
+        if predictions:
+            self.errors.append({'name':name,'encoder':encoder,'finished':now,
+                                'errors':[(completed,now - predicted) for completed,predicted in predictions]})
+        self.forget(name)
+
+    def forget(self,name):
+        self.samples.pop(name,None)
+        self.etas.pop(name,None)
+        self.predictions.pop(name,None)
+
+    def prune(self,running):
+        """ Forget about tasks which aren't running any more, cancelled, requeued and so on """
+        for name in self.samples.keys():
+            if name not in running:
+                self.forget(name)
+
+    def getErrors(self):
+        """ The ETA errors (in seconds) of the last few finished tasks, and the mean absolute error of the
+            ETAs given at each 10%
+        """
+        errors = {}
+        for record in self.errors:
+            for completed,error in record['errors']:
+                errors.setdefault(completed,[]).append(abs(error))
+        return {'tasks':list(self.errors),
+                'mean':dict((completed,sum(values) / len(values)) for completed,values in errors.items())}
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+import os
+import time
+import socket
+import hashlib
+import logging
+import threading
+import contextlib
+from ftplib import FTP, error_perm
+from encoder_cfg import ftp_host, ftp_port, ftp_user, ftp_pass, storage_mode, shared_path
+from encoder_cfg import transfer_retries, transfer_backoff, ftp_sessions
+from metrics import registry
+
+# Read and hash files this many bytes at a time
+chunk_size = 1024 * 1024
+
+# direction is 'download' for videos coming from the central server, 'upload' for videos going to it
+transferBytes = registry.counter('handbrake_transfer_bytes_total','Bytes copied to or from the central server',['direction'])
+transferSeconds = registry.counter('handbrake_transfer_seconds_total','Seconds spent copying to or from the central server',['direction'])
+transferRetries = registry.counter('handbrake_transfer_retries_total','Transfers which failed and were tried again',['direction'])
+transferFailures = registry.counter('handbrake_transfer_failures_total','Transfers which were given up on',['direction'])
+
+def recordTransfer(direction,size,started):
+    transferBytes.inc(size,direction=direction)
+    transferSeconds.inc(time.time() - started,direction=direction)
+
+class TransferError(Exception):
+    """ A transfer finished but what arrived isn't what was sent """
+    pass
+
+class TransferCancelled(Exception):
+    """ Raised by a progress callback to stop a transfer, it isn't retried """
+    pass
+
+def stagingName(name,tag=None):
+    """ What an encoder calls an output in the master dir until the central server moves it into place,
+        tagged (with the host unless we're told otherwise) so two encoders working on the same thing don't
+        write over each other
+    """
+    return '.{0}.{1}'.format(tag or socket.gethostname(),name)
+
+def hashFile(path,digest,length=None):
+    """ Feed the first length bytes of a file (all of it if length is None) into digest """
+    with open(path,'rb') as f:
+        while length is None or length > 0:
+            data = f.read(chunk_size if length is None else min(chunk_size,length))
+            if not data:
+                break
+            digest.update(data)
+            if length is not None:
+                length -= len(data)
+    return digest
+
+def retry(attempt,what,direction):
+    """ Keep calling attempt(tries) until it works, backing off a little more after each failure.
+        Gives up and returns False after transfer_retries goes
+    """
+    delay = transfer_backoff
+    for tries in xrange(transfer_retries):
+        try:
+            return attempt(tries)
+        except TransferCancelled:
+            raise
+        except Exception:
+            logging.exception('Unable to {0} (attempt {1} of {2})'.format(what,tries + 1,transfer_retries))
+            if tries + 1 < transfer_retries:
+                transferRetries.inc(direction=direction)
+                time.sleep(delay)
+                delay *= 2
+    transferFailures.inc(direction=direction)
+    return False
+
+class FTPPool(object):
+    """ Logged in FTP sessions kept around between transfers so each one doesn't have to connect
+        and log in again. Holds on to at most size idle sessions, anything else is closed
+    """
+    def __init__(self,size=ftp_sessions):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        ftp = FTP()
+        ftp.connect(ftp_host,ftp_port)
+        ftp.login(ftp_user, ftp_pass)
+        # SIZE and REST only make sense in binary mode
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def get(self):
+        """ An idle session if there's one which still works, a new one if not """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                ftp = self.idle.pop()
+            try:
+                # The server may have timed it out while it sat there
+                ftp.voidcmd('NOOP')
+                return ftp
+            except Exception:
+                self.discard(ftp)
+        return self.connect()
+
+    def put(self,ftp):
+        """ Hand a session back once the transfer it was used for has gone through cleanly """
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(ftp)
+                return
+        self.discard(ftp)
+
+    def discard(self,ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+# Shared by every FTPStorage in the process
+sessions = FTPPool()
+
+class FTPStorage(object):
+    """ Copies videos to and from the central server's master dir over FTP
+            - Encoders download the source into the task's work dir, encode it there, then upload the output
+              under its staging name, the central server moves it into place if it's the copy that counts
+            - The UI uploads new sources
+            - A dropped connection is retried, picking up from the last byte that made it across
+            - Sessions are pooled, a session that had anything go wrong on it is closed rather than reused
+        tag is what outputs are staged under, see stagingName
+    """
+    def __init__(self,tag=None):
+        self.tag = tag
+
+    @contextlib.contextmanager
+    def session(self):
+        ftp = sessions.get()
+        try:
+            yield ftp
+        except:
+            sessions.discard(ftp)
+            raise
+        sessions.put(ftp)
+
+    def remoteSize(self,ftp,name):
+        try:
+            return ftp.size(name)
+        except error_perm:
+            # Not there
+            return None
+
+    def sourcePath(self,name,workDir):
+        """ Where handbrake reads the source from """
+        return os.path.join(workDir,name)
+
+    def outputPath(self,name,workDir):
+        """ Where handbrake writes the output to """
+        return os.path.join(workDir,name)
+
+    def fetch(self,name,workDir,digest=None):
+        """ Get the source ready for handbrake, if we're given the source's digest our copy has to match it """
+        path = self.sourcePath(name,workDir)
+        def attempt(tries):
+            started = time.time()
+            with self.session() as ftp:
+                size = self.remoteSize(ftp,name)
+                # Carry on from whatever made it across last time
+                offset = os.path.getsize(path) if os.path.exists(path) else 0
+                if size is None or offset > size:
+                    offset = 0
+                sha = hashlib.sha1()
+                if offset:
+                    hashFile(path,sha,offset)
+                with open(path,'r+b' if offset else 'wb') as f:
+                    f.seek(offset)
+                    f.truncate()
+                    def write(data):
+                        f.write(data)
+                        sha.update(data)
+                    ftp.retrbinary('RETR {0}'.format(name),write,rest=offset or None)
+            recordTransfer('download',os.path.getsize(path) - offset,started)
+            if size is not None and os.path.getsize(path) != size:
+                raise TransferError('Got {0} of {1} bytes of {2}'.format(os.path.getsize(path),size,name))
+            if digest and sha.hexdigest() != digest:
+                # No point resuming a corrupt copy, start again from scratch
+                os.unlink(path)
+                raise TransferError('Checksum mismatch on {0}'.format(name))
+            return True
+        return retry(attempt,'get {0}'.format(name),'download')
+
+    def send(self,path,name,sha=None,progress=None):
+        """ Upload a file to the master dir, the first go overwrites whatever's there, retries carry on
+            from however much the server has of what we've sent it. Returns the sha1 of the file if asked
+            for one. progress is called with the number of bytes the server has so far as they go
+        """
+        # The furthest into the file we've got, a retry never resumes past it so a stale file of the same
+        # name which was there before we got as far as STOR can't be taken for ours
+        sent = [0]
+        def attempt(tries):
+            started = time.time()
+            with self.session() as ftp:
+                offset = 0
+                if tries:
+                    offset = min(self.remoteSize(ftp,name) or 0,sent[0])
+                digest = None
+                if sha:
+                    digest = hashFile(path,hashlib.sha1(),offset)
+                done = [offset]
+                def callback(data):
+                    if digest:
+                        digest.update(data)
+                    done[0] += len(data)
+                    sent[0] = max(sent[0],done[0])
+                    if progress:
+                        progress(done[0])
+                with open(path,'rb') as f:
+                    f.seek(offset)
+                    try:
+                        ftp.storbinary('STOR {0}'.format(name),f,chunk_size,callback,rest=offset or None)
+                    except TransferCancelled:
+                        # This session is in no state to carry on, clear up the half sent file
+                        # from another one
+                        self.remove(name)
+                        raise
+                size = self.remoteSize(ftp,name)
+            recordTransfer('upload',(size or 0) - offset,started)
+            if size != os.path.getsize(path):
+                raise TransferError('Sent {0} of {1} bytes of {2}'.format(size,os.path.getsize(path),name))
+            if digest:
+                return digest.hexdigest()
+            return True
+        return retry(attempt,'send {0}'.format(name),'upload')
+
+    def store(self,name,workDir):
+        """ Hand a finished output over to the central server, returns the name it's staged under in the
+            master dir, False if it couldn't be sent
+        """
+        staged = stagingName(name,self.tag)
+        if not self.send(self.outputPath(name,workDir),staged):
+            return False
+        return staged
+
+    def discard(self,name,workDir):
+        """ Throw away a half written output, it lives in the work dir so there's nothing to do """
+        pass
+
+    def remove(self,name):
+        try:
+            with self.session() as ftp:
+                ftp.delete(name)
+        except Exception:
+            pass
+
+    def put(self,path,name,progress=None):
+        """ Used by the UI to send a new source to the central server, returns the source's sha1 so
+            the encoders can check their copies, None if there isn't one, False if it couldn't be sent
+        """
+        return self.send(path,name,True,progress)
+
+class SharedStorage(object):
+    """ Works straight off the master dir, for when it's mounted on every box (NFS, SMB, ...)
+            - Handbrake reads the source where it is, nothing gets copied to the encoder
+            - The output is written under a hidden name next to it, and the central server renames it into
+              place once the encoder says it's done, so the server never sees half an output and the losing
+              copy of a duplicated task never writes over the winner's
+            - The central server uses this over its own master dir whatever mode the farm is in
+        tag is what outputs are staged under, see stagingName
+    """
+    def __init__(self,root=shared_path,tag=None):
+        self.root = root
+        self.tag = tag
+
+    def path(self,name):
+        return os.path.join(self.root,name)
+
+    def exists(self,name):
+        return os.path.exists(self.path(name))
+
+    def remove(self,name):
+        try:
+            os.unlink(self.path(name))
+        except OSError:
+            pass
+
+    def sourcePath(self,name,workDir):
+        return self.path(name)
+
+    def outputPath(self,name,workDir):
+        return self.path(stagingName(name,self.tag))
+
+    def fetch(self,name,workDir,digest=None):
+        # Nothing is copied so there's nothing to check, reading the whole source to hash it
+        # would cost as much as the copy we're avoiding
+        return self.exists(name)
+
+    def store(self,name,workDir):
+        # Handbrake wrote it straight into the master dir, it's already staged
+        if not os.path.exists(self.outputPath(name,workDir)):
+            return False
+        return stagingName(name,self.tag)
+
+    def place(self,staged,name):
+        """ Used by the central server to move an output into place from where an encoder staged it """
+        try:
+            os.rename(self.path(staged),self.path(name))
+        except OSError:
+            # Windows won't rename over an existing file
+            self.remove(name)
+            os.rename(self.path(staged),self.path(name))
+
+    def discard(self,name,workDir):
+        try:
+            os.unlink(self.outputPath(name,workDir))
+        except OSError:
+            pass
+
+    def put(self,path,name,progress=None):
+        if os.path.abspath(path) == os.path.abspath(self.path(name)):
+            # Already sat in the master dir, hashing it would mean reading the whole thing for
+            # a digest nobody checks in this mode
+            return None
+        def attempt(tries):
+            started = time.time()
+            partial = self.path(stagingName(name,self.tag))
+            sha = hashlib.sha1()
+            done = 0
+            try:
+                with open(path,'rb') as src:
+                    with open(partial,'wb') as dst:
+                        while True:
+                            data = src.read(chunk_size)
+                            if not data:
+                                break
+                            dst.write(data)
+                            sha.update(data)
+                            done += len(data)
+                            if progress:
+                                progress(done)
+            except TransferCancelled:
+                os.unlink(partial)
+                raise
+            self.remove(name)
+            os.rename(partial,self.path(name))
+            recordTransfer('upload',done,started)
+            return sha.hexdigest()
+        return retry(attempt,'copy {0}'.format(name),'upload')
+
+def getStorage(tag=None):
+    """ The storage backend picked by storage_mode, staging outputs under tag """
+    if storage_mode == 'shared':
+        return SharedStorage(tag=tag)
+    return FTPStorage(tag)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+"""
+    Stands in for HandBrakeCLI when benchmarking (see benchmark.py). Takes the arguments the encoders
+    give handbrake, prints handbrake style progress lines at a steady frame rate and writes an output.
+    How it behaves comes from the environment:
+        STUB_FPS     frames a second it 'encodes' at (default 300)
+        STUB_LENGTH  seconds of video in a source, segments go by their --stop-at (default 60)
+        STUB_RATE    frame rate of the video (default 30)
+        STUB_RATIO   output size as a fraction of the source's size (default 0.5)
+"""
+
+import os
+import sys
+import time
+
+# How often progress is printed, handbrake updates a few times a second
+update_interval = 0.25
+
+def option(args,name,default=None):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return default
+
+def duration(value):
+    """ Seconds from a --start-at/--stop-at value, which look like duration:<seconds> """
+    if not value:
+        return None
+    return float(value.split(':',1)[-1])
+
+def writeOutput(path,size):
+    chunk = '\0' * (1024 * 1024)
+    with open(path,'wb') as f:
+        while size > 0:
+            f.write(chunk[:size])
+            size -= len(chunk)
+
+def main():
+    args = sys.argv[1:]
+    source = option(args,'-i')
+    output = option(args,'-o')
+    if not source or not output:
+        sys.stderr.write('Missing input or output\n')
+        return 1
+    if not os.path.exists(source):
+        sys.stderr.write('No such file {0}\n'.format(source))
+        return 1
+    fps = float(os.environ.get('STUB_FPS',300))
+    rate = float(os.environ.get('STUB_RATE',30))
+    ratio = float(os.environ.get('STUB_RATIO',0.5))
+    # The encoders give the stop point relative to the start point
+    length = duration(option(args,'--stop-at'))
+    if length is None:
+        length = max(0.0,float(os.environ.get('STUB_LENGTH',60)) - (duration(option(args,'--start-at')) or 0))
+    frames = length * rate
+    sys.stderr.write('[{0}] stub handbrake: {1:.0f} frames at {2:.0f} fps\n'.format(time.strftime('%H:%M:%S'),frames,fps))
+    started = time.time()
+    total = frames / fps
+    while True:
+        elapsed = time.time() - started
+        done = min(1.0,elapsed / total) if total else 1.0
+        eta = int(max(0,total - elapsed))
+        sys.stdout.write('Encoding: task 1 of 1, {0:.2f} % ({1:.2f} fps, avg {1:.2f} fps, ETA {2:02d}h{3:02d}m{4:02d}s)\r'.format(
+            done * 100,fps,eta // 3600,eta % 3600 // 60,eta % 60))
+        sys.stdout.flush()
+        if done >= 1.0:
+            break
+        time.sleep(min(update_interval,total - elapsed))
+    writeOutput(output,int(os.path.getsize(source) * ratio))
+    sys.stdout.write('\nEncode done!\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())